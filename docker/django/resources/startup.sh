@@ -23,6 +23,7 @@ fi
 
 python /elri/manage.py makemigrations accounts repository stats recommendations storage
 python /elri/manage.py migrate
+python /elri/manage.py add_missing_columns
 python /elri/manage.py rebuild_index --noinput
 python /elri/manage.py collectstatic --noinput
 
@@ -2,8 +2,7 @@
 
 import os
 import sys
-import traceback
-from zipfile import ZipFile
+import time
 import django
 # Magic python path, based on http://djangosnippets.org/snippets/281/
 from os.path import abspath, dirname
@@ -24,6 +23,26 @@ except ImportError:
       " an ImportError somehow.)\n" % __file__)
     sys.exit(1)
 
+def print_usage():
+    print "\n\tusage: {0} [--workers=n] [--manifest=file] [--since=file] " \
+      "[--live-export] <archive.zip> <upgrade-db>\n".format(sys.argv[0])
+    print "  --workers=n : number of worker processes which serialize the resources;"
+    print "                defaults to MAINTENANCE_WORKERS"
+    print "  --manifest=file : write a JSON manifest with the file name, checksum and"
+    print "                    digest checksum of each exported resource to file"
+    print "  --since=file : only export the resources whose digest checksum has changed"
+    print "                 since the export with the given manifest file"
+    print "  --live-export : export all resources again instead of writing the"
+    print "                  metadata XML kept in their storage objects where it is"
+    print "                  up-to-date"
+    print "\tWARNING: when providing the 'upgrade-db' switch, the " \
+      "database will be upgraded\n\tto the latest schema " \
+      "automatically. This step is not reversible which means the\n\t" \
+      "database cannot be used with older versions of the META-SHARE " \
+      "software anymore.\n"
+    print "\tYou have been warned.\n"
+    return
+
 if __name__ == "__main__":
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "metashare.settings")
     django.setup()
@@ -31,19 +50,50 @@ if __name__ == "__main__":
     PROJECT_HOME = os.path.normpath(os.getcwd() + "/..")
     sys.path.append(PROJECT_HOME)
     
+    # Check command line options for --workers, --manifest, --since and
+    # --live-export
+    workers = None
+    manifest_filename = None
+    previous_manifest = None
+    use_stored_metadata = True
+    arg_num = 1
+    while arg_num < len(sys.argv) and sys.argv[arg_num].startswith("--"):
+        if sys.argv[arg_num].startswith("--workers="):
+            try:
+                workers = int(sys.argv[arg_num][len("--workers="):])
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print "Incorrect option"
+                print_usage()
+                sys.exit(-1)
+        elif sys.argv[arg_num].startswith("--manifest="):
+            manifest_filename = sys.argv[arg_num][len("--manifest="):]
+            if len(manifest_filename) == 0:
+                print "Incorrect option"
+                print_usage()
+                sys.exit(-1)
+        elif sys.argv[arg_num].startswith("--since="):
+            previous_manifest = sys.argv[arg_num][len("--since="):]
+            if not os.path.isfile(previous_manifest):
+                print "Cannot find the manifest file {0}".format(
+                  previous_manifest)
+                print_usage()
+                sys.exit(-1)
+        elif sys.argv[arg_num] == "--live-export":
+            use_stored_metadata = False
+        else:
+            print "Unknown option"
+            print_usage()
+            sys.exit(-1)
+        arg_num = arg_num + 1
+
     # Check command line parameters first.
-    if len(sys.argv) < 2:
-        print "\n\tusage: {0} <archive.zip> <upgrade-db>\n".format(
-          sys.argv[0])
-        print "\tWARNING: when providing the 'upgrade-db' switch, the " \
-          "database will be upgraded\n\tto the latest schema " \
-          "automatically. This step is not reversible which means the\n\t" \
-          "database cannot be used with older versions of the META-SHARE " \
-          "software anymore.\n"
-        print "\tYou have been warned.\n"
+    if len(sys.argv) <= arg_num:
+        print_usage()
         sys.exit(-1)
     
-    if len(sys.argv) > 2 and sys.argv[2] == 'upgrade-db':
+    if len(sys.argv) > arg_num + 1 and sys.argv[arg_num + 1] == 'upgrade-db':
         # Automagically run syncdb to update database to the latest version.
         from django.core.management import execute_from_command_line
         execute_from_command_line(['manage.py', 'syncdb', '--noinput'])
@@ -70,32 +120,22 @@ if __name__ == "__main__":
     
         conn.close()
     
-    # Disable verbose debug output for the import process...
-    settings.DEBUG = True
+    # Disable verbose debug output for the export process...
+    settings.DEBUG = False
     
-    SUCCESSFUL_EXPORTS = 0
-    ERRONEOUS_EXPORTS = 0
-    RESOURCE_NO = 0
-    from metashare.repository.models import resourceInfoType_model
-    from metashare.xml_utils import to_xml_string
-    with ZipFile(sys.argv[1], 'w') as out:
-        for resource in resourceInfoType_model.objects.all():
-            # skip rsources marked as deleted
-            if resource.storage_object.deleted == True:
-                continue
-            try:
-                RESOURCE_NO += 1
-                root_node = resource.export_to_elementtree()
-                xml_string = to_xml_string(
-                  root_node, encoding="utf-8").encode('utf-8')
-                resource_filename = 'resource-{0}.xml'.format(RESOURCE_NO)
-                out.writestr(resource_filename, xml_string)
-                SUCCESSFUL_EXPORTS += 1
-            
-            except Exception:
-                ERRONEOUS_EXPORTS += 1
-                print 'Could not export resource id={0}!'.format(resource.id)
-                print traceback.format_exc()
+    from metashare.xml_utils import bulk_export_to_archive
+    start_time = time.time()
+    def _progress(processed, total):
+        _elapsed = max(time.time() - start_time, 0.001)
+        print "{0} of {1} resources processed ({2:.1f} resources/s)".format(
+          processed, total, processed / _elapsed)
+    SUCCESSFUL_EXPORTS, ERRONEOUS_IDS = bulk_export_to_archive(
+      sys.argv[arg_num], workers=workers, manifest_filename=manifest_filename,
+      previous_manifest=previous_manifest,
+      use_stored_metadata=use_stored_metadata, progress=_progress)
+    for resource_id in ERRONEOUS_IDS:
+        print 'Could not export resource id={0}!'.format(resource_id)
     
     print "Done. Successfully exported {0} files from the database, errors " \
-      "occured in {1} cases.".format(SUCCESSFUL_EXPORTS, ERRONEOUS_EXPORTS)
+      "occured in {1} cases.".format(SUCCESSFUL_EXPORTS, len(ERRONEOUS_IDS))
+    print "Exported in {0:.1f}s.".format(time.time() - start_time)
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import time
 import django
 # Magic python path, based on http://djangosnippets.org/snippets/281/
 from os.path import abspath, dirname
@@ -25,9 +26,13 @@ except ImportError:
 
 
 def print_usage():
-    print "\n\tusage: {0} [--id-file=idfile] <file.xml|archive.zip> [<file.xml|archive." \
+    print "\n\tusage: {0} [--id-file=idfile] [--bulk [--workers=n]] <file.xml|archive.zip> [<file.xml|archive." \
       "zip> ...]\n".format(sys.argv[0])
     print "  --id-file=idfile : print identifier of imported resources in idfile"
+    print "  --bulk : import all files with the bulk import, which parses the records"
+    print "           in worker processes and serializes them to the storage folder at the end"
+    print "  --workers=n : number of worker processes of the bulk import; defaults to"
+    print "                MAINTENANCE_WORKERS"
     return
 
 if __name__ == "__main__":
@@ -41,20 +46,38 @@ if __name__ == "__main__":
         print_usage()
         sys.exit(-1)
     
-    # Check command line options for --id-file
+    # Check command line options for --id-file, --bulk and --workers
     id_filename = None
+    bulk = False
+    workers = None
     arg_num=1
-    if sys.argv[arg_num].startswith("--id-file="):
-        opt_len = len("--id-file=")
-        id_filename = sys.argv[arg_num][opt_len:]
-        arg_num = arg_num + 1
-        if len(id_filename) == 0:
-            print "Incorrect option"
-            print_usage()
-            sys.exit(-1)
-        if len(sys.argv) < 3:
+    while arg_num < len(sys.argv) and sys.argv[arg_num].startswith("--"):
+        if sys.argv[arg_num].startswith("--id-file="):
+            opt_len = len("--id-file=")
+            id_filename = sys.argv[arg_num][opt_len:]
+            if len(id_filename) == 0:
+                print "Incorrect option"
+                print_usage()
+                sys.exit(-1)
+        elif sys.argv[arg_num] == "--bulk":
+            bulk = True
+        elif sys.argv[arg_num].startswith("--workers="):
+            try:
+                workers = int(sys.argv[arg_num][len("--workers="):])
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print "Incorrect option"
+                print_usage()
+                sys.exit(-1)
+        else:
+            print "Unknown option"
             print_usage()
             sys.exit(-1)
+        arg_num = arg_num + 1
+    if len(sys.argv) <= arg_num:
+        print_usage()
+        sys.exit(-1)
         
 
     # Check that SOLR is running, or else all resources will stay at status INTERNAL:
@@ -63,26 +86,47 @@ if __name__ == "__main__":
 
     # Disable verbose debug output for the import process...
     settings.DEBUG = False
-    os.environ['DISABLE_INDEXING_DURING_IMPORT'] = 'True'
+    # the bulk import indexes the imported resources in batches itself, the
+    # index is rebuilt after the other imports
+    if not bulk:
+        os.environ['DISABLE_INDEXING_DURING_IMPORT'] = 'True'
     
     successful_imports = []
     erroneous_imports = []
-    from metashare.xml_utils import import_from_file
+    from metashare.xml_utils import import_from_file, bulk_import_from_files
     from metashare.storage.models import PUBLISHED, MASTER
     from metashare.repository.supermodel import OBJECT_XML_CACHE
     
     # Clean cache before starting the import process.
     OBJECT_XML_CACHE.clear()
     
-    for filename in sys.argv[arg_num:]:
-        temp_file = open(filename, 'rb')
-        success, failure = import_from_file(temp_file, filename, PUBLISHED, MASTER)
-        successful_imports += success
-        erroneous_imports += failure
-        temp_file.close()
+    start_time = time.time()
+    if bulk:
+        # a phase starts when the previous one has reported its last progress
+        phase_start = {}
+        last_progress = [start_time]
+        def _progress(phase, processed, total):
+            _start = phase_start.setdefault(phase, last_progress[0])
+            last_progress[0] = time.time()
+            _elapsed = max(last_progress[0] - _start, 0.001)
+            print "{0}: {1} of {2} records processed ({3:.1f} records/s)" \
+              .format(phase, processed, total, processed / _elapsed)
+        successful_imports, erroneous_imports = bulk_import_from_files(
+            sys.argv[arg_num:], PUBLISHED, MASTER, workers=workers,
+            progress=_progress)
+    else:
+        for filename in sys.argv[arg_num:]:
+            temp_file = open(filename, 'rb')
+            success, failure = import_from_file(temp_file, filename, PUBLISHED, MASTER)
+            successful_imports += success
+            erroneous_imports += failure
+            temp_file.close()
+    elapsed = max(time.time() - start_time, 0.001)
     
     print "Done.  Successfully imported {0} files into the database, errors " \
       "occurred in {1} cases.".format(len(successful_imports), len(erroneous_imports))
+    print "Imported {0:.1f} records per second in {1:.1f}s.".format(
+      (len(successful_imports) + len(erroneous_imports)) / elapsed, elapsed)
     if len(erroneous_imports) > 0:
         print "The following files could not be imported:"
         for descriptor, exception in erroneous_imports:
@@ -102,9 +146,11 @@ if __name__ == "__main__":
         id_file.close()
 
     # Be nice and cleanup cache...
-    _cache_size = sum([len(x) for x in OBJECT_XML_CACHE.values()])
+    _stats = OBJECT_XML_CACHE.get_stats()
     OBJECT_XML_CACHE.clear()
-    print "Cleared OBJECT_XML_CACHE ({} bytes)".format(_cache_size)
+    print "Cleared OBJECT_XML_CACHE ({0} bytes, {1} hits, {2} misses)".format(
+      _stats['size'], _stats['hits'], _stats['misses'])
     
-    from haystack.management.commands import rebuild_index
-    rebuild_index.Command().handle(interactive=False)
+    if not bulk:
+        from haystack.management.commands import rebuild_index
+        rebuild_index.Command().handle(interactive=False)
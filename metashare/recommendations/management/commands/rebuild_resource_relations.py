@@ -0,0 +1,23 @@
+"""
+Management utility to recompute the precomputed creators and funding projects
+by which resources are related.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from metashare.recommendations.recommendations import rebuild_resource_relations
+
+class Command(BaseCommand):
+
+    help = 'Recompute the relations between resources with the same creators ' \
+        'or funding projects'
+
+    def handle(self, *args, **options):
+        """
+        Rebuild the resource relations.
+        """
+        start = time.time()
+        count = rebuild_resource_relations()
+        if int(options['verbosity']) >= 1:
+            self.stdout.write('stored {0} resource relation keys in {1:.1f}s'
+                              .format(count, time.time() - start))
@@ -2,16 +2,43 @@
 Management utility to check the recommendations for consistency and remove links
 to invalid documents.
 """
-from django.core.management.base import BaseCommand
-from metashare.recommendations.recommendations import repair_recommendations
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from metashare.recommendations.recommendations import \
+    remove_session_trackers, remove_orphaned_recommendations, \
+    REPAIR_SESSION_BATCH_SIZE
 
 class Command(BaseCommand):
-    
+
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', action='store', dest='batch_size',
+                    type='int', default=REPAIR_SESSION_BATCH_SIZE,
+                    help='number of sessions changed at once; defaults to {0}'
+                    .format(REPAIR_SESSION_BATCH_SIZE)),
+    )
+
     help = 'Check the recommendations for consistency and remove links to invalid documents'
-    
+
     def handle(self, *args, **options):
         """
         Repair recommendations.
         """
-        repair_recommendations()
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be positive.')
+        verbose = int(options['verbosity']) >= 1
+
+        start = time.time()
+        session_count = remove_session_trackers(options['batch_size'])
+        if verbose:
+            self.stdout.write('removed the trackers of {0} sessions in {1:.1f}s'
+                              .format(session_count, time.time() - start))
 
+        start = time.time()
+        dict_count, pair_count = remove_orphaned_recommendations()
+        if verbose:
+            self.stdout.write('removed {0} recommendations dictionaries and '
+                              '{1} recommendations entries in {2:.1f}s'
+                              .format(dict_count, pair_count,
+                                      time.time() - start))
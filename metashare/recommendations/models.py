@@ -1,4 +1,6 @@
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
 
 
 # the following code is based on http://djangosnippets.org/snippets/2451/
@@ -21,14 +23,63 @@ class TogetherManager(models.Model):
         """
         tells the manager that the given resources have appeared together
         """
+        self.addResourcePairs(res_1.storage_object.identifier,
+                              [res_2.storage_object.identifier])
+
+    def addResourcePairs(self, lrid, other_lrids):
+        """
+        tells the manager that the resource with the given storage object
+        identifier has appeared together with each of the resources with the
+        other given identifiers; all counts are updated with a few bulk queries
+        """
+        other_lrids = [_lrid for _lrid in set(other_lrids) if _lrid != lrid]
+        if not other_lrids:
+            return
+        for _attempt in range(2):
+            try:
+                with transaction.atomic():
+                    self._add_resource_pairs(lrid, other_lrids)
+                break
+            except IntegrityError:
+                # a concurrent request has created some of the pairs first;
+                # the whole update is rolled back, so it can simply be repeated
+                if _attempt:
+                    raise
+        cache.delete_many([get_recommendations_cache_key(self.name, _lrid)
+                           for _lrid in [lrid] + other_lrids])
+
+    def _add_resource_pairs(self, lrid, other_lrids):
+        """
+        increases the counts of the pairs of the resource with the given
+        identifier and each of the resources with the other given identifiers
+        in both directions
+        """
+        _lrids = [lrid] + other_lrids
         # pylint: disable-msg=E1101
-        res_count_dict_1 = self.resourcecountdict_set.get_or_create(
-          lrid=res_1.storage_object.identifier)[0]
-        res_count_dict_1.addResource(res_2)
-        # pylint: disable-msg=E1101
-        res_count_dict_2 = self.resourcecountdict_set.get_or_create(
-          lrid=res_2.storage_object.identifier)[0]
-        res_count_dict_2.addResource(res_1)
+        dict_ids = dict(self.resourcecountdict_set.filter(lrid__in=_lrids)
+                        .values_list('lrid', 'id'))
+        _missing = [_lrid for _lrid in _lrids if _lrid not in dict_ids]
+        if _missing:
+            ResourceCountDict.objects.bulk_create(
+                [ResourceCountDict(container=self, lrid=_lrid)
+                 for _lrid in _missing])
+            # pylint: disable-msg=E1101
+            dict_ids.update(self.resourcecountdict_set
+                .filter(lrid__in=_missing).values_list('lrid', 'id'))
+        _pairs = [(dict_ids[lrid], _lrid) for _lrid in other_lrids] \
+            + [(dict_ids[_lrid], lrid) for _lrid in other_lrids]
+        pair_ids = dict(((container_id, _lrid), pair_id)
+            for pair_id, container_id, _lrid in ResourceCountPair.objects
+                .filter(container__in=dict_ids.values(), lrid__in=_lrids)
+                .values_list('id', 'container', 'lrid'))
+        _existing = [pair_ids[pair] for pair in _pairs if pair in pair_ids]
+        if _existing:
+            ResourceCountPair.objects.filter(id__in=_existing) \
+                .update(count=F('count') + 1)
+        ResourceCountPair.objects.bulk_create(
+            [ResourceCountPair(container_id=container_id, lrid=_lrid, count=1)
+             for container_id, _lrid in _pairs
+             if (container_id, _lrid) not in pair_ids])
         
     def getTogetherCount(self, res_1, res_2):
         """
@@ -47,11 +98,12 @@ class TogetherManager(models.Model):
             return 0
         return res_count_pair.count
     
-    def getTogetherList(self, res, threshold):
+    def getTogetherList(self, res, threshold, limit=None):
         """
         returns a sorted list of resources that have appeared together with the
         given resource; appearance count must have at least the given threshold;
-        filters deleted and non-published resources
+        filters deleted and non-published resources; returns at most the given
+        number of resources, if any
         """
         from metashare.repository.models import resourceInfoType_model
         from metashare.storage.models import PUBLISHED   
@@ -59,20 +111,20 @@ class TogetherManager(models.Model):
         pairs = ResourceCountPair.objects\
           .filter(container__container__name=self.name)\
           .filter(container__lrid=res.storage_object.identifier)\
-          .filter(count__gte=threshold).order_by('-count')
-        # collect resources; skip unpublished and deleted resource
-        together_list = []
-        for pair in pairs:
-            try:
-                resource = resourceInfoType_model.objects.get(
-                  storage_object__identifier=pair.lrid)
-                if resource.storage_object.publication_status != PUBLISHED\
-                  or resource.storage_object.deleted:
-                    continue
-                together_list.append(resource)
-            except:
-                continue
-
+          .filter(count__gte=threshold)
+        # collect resources with a single query, independent of the number of
+        # pairs; skip unpublished and deleted resource
+        resources = dict((resource.storage_object.identifier, resource)
+          for resource in resourceInfoType_model.objects
+            .filter(storage_object__identifier__in=pairs.values('lrid'),
+                    storage_object__publication_status=PUBLISHED,
+                    storage_object__deleted=False)
+            .select_related('storage_object'))
+        together_list = [resources[lrid] for lrid in pairs
+            .order_by('-count', 'id').values_list('lrid', flat=True)
+            if lrid in resources]
+        if limit is not None:
+            together_list = together_list[:limit]
         return together_list
               
     def __unicode__(self):
@@ -149,3 +201,61 @@ class ResourceCountPair(models.Model):
         returns the Unicode representation for this pair
         """
         return u'{0}: {1}'.format(self.lrid, self.count)
+
+
+
+class ResourceRelationKey(models.Model):
+    """
+    precomputed key, i.e., the id of a creator or of a funding project, of a
+    resource; resources are related if they have a key of the same kind in
+    common
+    """
+    SAME_CREATORS = 'creators'
+    SAME_PROJECTS = 'projects'
+    KIND_CHOICES = (
+        (SAME_CREATORS, 'same creators'),
+        (SAME_PROJECTS, 'same projects'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    resource = models.ForeignKey('repository.resourceInfoType_model',
+                                 related_name='+')
+    key = models.IntegerField()
+
+    class Meta:
+        # also serves the lookups of the keys of a resource
+        unique_together = (("resource", "kind", "key"), )
+        # serves the lookups of the resources with the same keys
+        index_together = (("kind", "key"), )
+
+    def __unicode__(self):
+        """
+        returns the Unicode representation for this key
+        """
+        return u'{0} -{1}- {2}'.format(self.resource_id, self.kind, self.key)
+
+def get_recommendations_cache_key(name, lrid):
+    """
+    Returns the cache key of the ranked recommendations of the given
+    TogetherManager for the resource with the given storage object identifier.
+    """
+    return u'recommendations-{0}-{1}'.format(name, lrid)
+
+
+def invalidate_recommendations(lrids):
+    """
+    Discards the cached recommendations of the resources with the given
+    storage object identifiers and of all resources which have appeared
+    together with them, e.g., because the resources have been published,
+    unpublished or deleted; must be called before the recommendations of the
+    resources are deleted
+    """
+    lrids = set(lrids)
+    # the pairs are symmetric, so the resources which may recommend the given
+    # resources are the ones which the given resources may recommend
+    lrids.update(ResourceCountPair.objects.filter(container__lrid__in=lrids)
+                 .values_list('lrid', flat=True))
+    cache.delete_many([get_recommendations_cache_key(name, lrid)
+                       for name in TogetherManager.objects
+                           .values_list('name', flat=True)
+                       for lrid in lrids])
@@ -1,11 +1,16 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
 from metashare import settings
 from metashare.recommendations.models import TogetherManager, ResourceCountDict, \
-    ResourceCountPair
+    ResourceCountPair, ResourceRelationKey, get_recommendations_cache_key
 from metashare.repository.models import resourceInfoType_model
 from metashare.settings import LOG_HANDLER
 from metashare.storage.models import StorageObject
+import base64
 import datetime
 import logging
+import operator
 import threading
 import multiprocessing
 
@@ -13,6 +18,20 @@ import multiprocessing
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(LOG_HANDLER)
 
+# the number of sessions whose resource trackers are removed at once when
+# repairing the recommendations
+REPAIR_SESSION_BATCH_SIZE = 500
+
+
+# the kinds of resource relations and the lookups of the creators and of the
+# funding projects which define them
+_RELATION_LOOKUPS = (
+    (ResourceRelationKey.SAME_CREATORS,
+     'resourceCreationInfo__resourceCreator'),
+    (ResourceRelationKey.SAME_PROJECTS,
+     'resourceCreationInfo__fundingProject'),
+)
+
 
 # viewed and downloaded resources are tracked
 class Resource:
@@ -40,20 +59,35 @@ class SessionResourcesTracker:
     
     def __init__(self):
         
-        # set of resources that have been downloaded together; 
-        # time intervals between downloads are not longer than MAX_DOWNLOAD_INTERVAL     
+        # set of the storage object identifiers of resources that have been
+        # downloaded together; time intervals between downloads are not
+        # longer than MAX_DOWNLOAD_INTERVAL; only identifiers are kept so that
+        # the tracker stays small in the session
         self.downloads = set()
         
         # time of last download
         self.last_download = None
         
-        # set of resources that have been viewed together; 
-        # time intervals between downloads are not longer than MAX_VIEW_INTERVAL
+        # set of the storage object identifiers of resources that have been
+        # viewed together; time intervals between downloads are not longer
+        # than MAX_VIEW_INTERVAL
         self.views = set()
         
         # time of last view
         self.last_view = None
 
+    def __setstate__(self, state):
+        """
+        Restores a pickled tracker; trackers of older versions kept the
+        resources themselves instead of their identifiers.
+        """
+        self.__dict__.update(state)
+        for _name in ('views', 'downloads'):
+            setattr(self, _name, set(
+              getattr(res, 'storage_object', None) is not None
+                and res.storage_object.identifier or res
+              for res in getattr(self, _name)))
+
 
     def add_view(self, resource, time):
         """
@@ -68,7 +102,7 @@ class SessionResourcesTracker:
         if time > _expiration_date:
             # init new 'together' set
             self.views = set()
-            self.views.add(resource)
+            self.views.add(resource.storage_object.identifier)
         else:
             # update TogetherManager
             self._add_resource_to_set(self.views, resource, Resource.VIEW)
@@ -89,7 +123,7 @@ class SessionResourcesTracker:
         if time > _expiration_date:
             # init new 'together' set
             self.downloads = set()
-            self.downloads.add(resource)
+            self.downloads.add(resource.storage_object.identifier)
         else:
             # update TogetherManager
             self._add_resource_to_set(self.downloads, resource, Resource.DOWNLOAD)
@@ -98,18 +132,18 @@ class SessionResourcesTracker:
         
     def _add_resource_to_set(self, res_set, res, res_type):  
         """
-        Adds the given resource to the given resource set; 
+        Adds the given resource to the given set of resource identifiers; 
         resource is of the given resource type, 
         either Resource.VIEW or Resource.DOWNLOAD.
         """  
-        if not res in res_set:
+        lrid = res.storage_object.identifier
+        if not lrid in res_set:
             # update TogetherManager with new pairs but make sure that only one
             # thread updates the TogetherManager at a time 
             with SessionResourcesTracker.lock:
                 man = TogetherManager.getManager(res_type)
-                for _res in res_set:
-                    man.addResourcePair(_res, res)
-                res_set.add(res)
+                man.addResourcePairs(lrid, res_set)
+                res_set.add(lrid)
             
             
     def _get_expiration_date(self, seconds, time):
@@ -124,22 +158,46 @@ class SessionResourcesTracker:
         return _expiration_date
     
 
-def get_view_recommendations(resource):
+def get_view_recommendations(resource, limit=None):
     """
-    Returns a list of ranked view recommendations for the given resource.
+    Returns a list of ranked view recommendations for the given resource;
+    returns at most the given number of recommendations, if any.
     """
     # TODO: decide what threshold to use; may restrict recommendation to top X resources of the list
-    return TogetherManager.getManager(Resource.VIEW)\
-      .getTogetherList(resource, 0)
+    return _get_recommendations(Resource.VIEW, resource, limit)
     
 
-def get_download_recommendations(resource):
+def get_download_recommendations(resource, limit=None):
     """
-    Returns a list of ranked download recommendations for the given resource.
+    Returns a list of ranked download recommendations for the given resource;
+    returns at most the given number of recommendations, if any.
     """
     # TODO: decide what threshold to use; may restrict recommendation to top X resources of the list 
-    return TogetherManager.getManager(Resource.DOWNLOAD)\
-      .getTogetherList(resource, 0)
+    return _get_recommendations(Resource.DOWNLOAD, resource, limit)
+
+
+def _get_recommendations(res_type, resource, limit):
+    """
+    Returns a list of ranked recommendations of the given resource type for
+    the given resource.
+
+    The ids of the ranked resources are cached; the cache entries are
+    discarded when new pairs are added for the resource and when one of the
+    ranked resources is published, unpublished or deleted.
+    """
+    _key = get_recommendations_cache_key(res_type,
+                                         resource.storage_object.identifier)
+    resource_ids = cache.get(_key)
+    if resource_ids is None:
+        result = TogetherManager.getManager(res_type) \
+          .getTogetherList(resource, 0)
+        cache.set(_key, [res.pk for res in result],
+                  settings.RECOMMENDATIONS_CACHE_TIMEOUT)
+        return result[:limit]
+    resource_ids = resource_ids[:limit]
+    resources = resourceInfoType_model.objects \
+      .select_related('storage_object').in_bulk(resource_ids)
+    return [resources[pk] for pk in resource_ids if pk in resources]
 
 
 def get_more_from_same_creators(resource):
@@ -147,11 +205,7 @@ def get_more_from_same_creators(resource):
     Returns all resources where at least one of the creators of the given
     resource is also an assigned creator.
     """
-    # get all creators of the resource; this includes persons and organizations
-    creation_info = resource.resourceCreationInfo
-    if creation_info:
-        return tuple(get_more_from_same_creators_qs(resource))
-    return ()
+    return tuple(get_more_from_same_creators_qs(resource))
 
 
 def get_more_from_same_creators_qs(resource):
@@ -159,14 +213,8 @@ def get_more_from_same_creators_qs(resource):
     Returns a query set of all resources where at least one of the creators of
     the given resource is also an assigned creator.
     """
-    # get all creators of the resource; this includes persons and organizations
-    creation_info = resource.resourceCreationInfo
-    if creation_info:
-        return resourceInfoType_model.objects.exclude(pk=resource.pk) \
-                    .filter(resourceCreationInfo__resourceCreator__in=
-                                creation_info.resourceCreator.all()) \
-                    .distinct()
-    return resourceInfoType_model.objects.none()
+    return resourceInfoType_model.objects.filter(pk__in=
+        get_related_resource_ids(resource, ResourceRelationKey.SAME_CREATORS))
 
 
 def get_more_from_same_projects(resource):
@@ -174,11 +222,7 @@ def get_more_from_same_projects(resource):
     Returns all resources where at least one of the projects of the given
     resource is also an assigned project.
     """
-    # get all projects of the resource
-    creation_info = resource.resourceCreationInfo
-    if creation_info:
-        return tuple(get_more_from_same_projects_qs(resource))
-    return ()
+    return tuple(get_more_from_same_projects_qs(resource))
 
 
 def get_more_from_same_projects_qs(resource):
@@ -186,42 +230,156 @@ def get_more_from_same_projects_qs(resource):
     Returns a query set of all resources where at least one of the projects of
     the given resource is also an assigned project.
     """
-    # get all projects of the resource
-    creation_info = resource.resourceCreationInfo
-    if creation_info:
-        return resourceInfoType_model.objects.exclude(pk=resource.pk) \
-                    .filter(resourceCreationInfo__fundingProject__in=
-                                creation_info.fundingProject.all()) \
-                    .distinct()
-    return resourceInfoType_model.objects.none()
-    
+    return resourceInfoType_model.objects.filter(pk__in=
+        get_related_resource_ids(resource, ResourceRelationKey.SAME_PROJECTS))
+
+
+def get_related_resource_ids(resource, kind):
+    """
+    Returns the ids of the resources which are related to the given resource
+    by the given kind of relation, i.e., which have a `ResourceRelationKey` of
+    this kind in common with it.
+    """
+    return ResourceRelationKey.objects.filter(kind=kind,
+            key__in=ResourceRelationKey.objects
+                .filter(resource=resource, kind=kind).values('key')) \
+        .exclude(resource=resource).values_list('resource', flat=True) \
+        .distinct()
+
+
+def get_resource_relation_kinds(resource):
+    """
+    Returns the set of the kinds of relations by which the given resource is
+    related to at least one other resource.
+    """
+    return set(kind for kind, _lookup in _RELATION_LOOKUPS
+               if get_related_resource_ids(resource, kind).exists())
+
+
+def update_resource_relations(resource):
+    """
+    Recomputes the `ResourceRelationKey`s of the given resource, e.g., after
+    its creators or funding projects have changed.
+    """
+    for kind, lookup in _RELATION_LOOKUPS:
+        keys = set(resourceInfoType_model.objects
+            .filter(pk=resource.pk, **{lookup + '__isnull': False})
+            .values_list(lookup, flat=True))
+        if keys == set(ResourceRelationKey.objects
+                .filter(resource=resource, kind=kind)
+                .values_list('key', flat=True)):
+            continue
+        with transaction.atomic():
+            ResourceRelationKey.objects.filter(resource=resource, kind=kind) \
+                .delete()
+            ResourceRelationKey.objects.bulk_create(
+                _create_resource_relation_keys(kind,
+                    [(resource.pk, _key) for _key in keys]))
 
-def repair_recommendations():
+
+def rebuild_resource_relations():
+    """
+    Recomputes the `ResourceRelationKey`s of all resources.
+
+    Returns the number of keys.
+    """
+    relation_keys = []
+    for kind, lookup in _RELATION_LOOKUPS:
+        relation_keys.extend(_create_resource_relation_keys(kind,
+            set(resourceInfoType_model.objects
+                .filter(**{lookup + '__isnull': False})
+                .values_list('pk', lookup))))
+    with transaction.atomic():
+        ResourceRelationKey.objects.all().delete()
+        ResourceRelationKey.objects.bulk_create(relation_keys)
+    return len(relation_keys)
+
+
+def _create_resource_relation_keys(kind, pairs):
+    """
+    Returns unsaved `ResourceRelationKey`s of the given kind for the given
+    pairs of a resource id and a key.
+    """
+    return [ResourceRelationKey(kind=kind, resource_id=_id, key=_key)
+            for _id, _key in pairs]
+
+
+def repair_recommendations(batch_size=REPAIR_SESSION_BATCH_SIZE):
     """
     Checks if the recommendations contain links to documents no longer
     available. Removes those links when found.
     """
+    remove_session_trackers(batch_size)
+    remove_orphaned_recommendations()
+
+
+def remove_session_trackers(batch_size=REPAIR_SESSION_BATCH_SIZE):
+    """
+    Removes the resource trackers from all sessions stored in the database;
+    the sessions are changed in chunks of the given size.
+
+    Returns the number of changed sessions.
+    """
     from django.contrib.sessions.models import Session
     from django.contrib.sessions.backends.db import SessionStore
-    for session in Session.objects.all():
-        session_dict = session.get_decoded()
-        if 'tracker' in session_dict:
-            LOGGER.info("removing tracker for session '{}'"
-                .format(session.session_key))
-            del session_dict['tracker']
-            session.session_data = SessionStore().encode(session_dict)
-            session.save()
-    for _dict in ResourceCountDict.objects.all():
-        try:
-            StorageObject.objects.get(identifier=_dict.lrid)
-        except StorageObject.DoesNotExist:
-            # remove recommendation
-            LOGGER.info("removing recommendations dictionary for {}".format(_dict.lrid))
-            _dict.delete()
-    for _pair in ResourceCountPair.objects.all():
-        try:
-            StorageObject.objects.get(identifier=_pair.lrid)
-        except StorageObject.DoesNotExist:
-            # remove recommendation
-            LOGGER.info("removing recommendations entry for {}".format(_pair.lrid))
-            _pair.delete()
+    store = SessionStore()
+    # the session data is base64 encoded, so instead of decoding all sessions
+    # only the ones whose encoded data contains a pickled tracker are decoded
+    session_keys = list(Session.objects.filter(reduce(operator.or_,
+            [Q(session_data__contains=_pattern) for _pattern
+             in _get_base64_patterns(SessionResourcesTracker.__name__)])) \
+        .values_list('session_key', flat=True))
+    result = 0
+    for i in range(0, len(session_keys), batch_size):
+        with transaction.atomic():
+            for _key, _data in Session.objects \
+                    .filter(session_key__in=session_keys[i:i + batch_size]) \
+                    .values_list('session_key', 'session_data'):
+                session_dict = store.decode(_data)
+                if 'tracker' in session_dict:
+                    LOGGER.debug("removing tracker for session '{}'"
+                        .format(_key))
+                    del session_dict['tracker']
+                    Session.objects.filter(session_key=_key) \
+                        .update(session_data=store.encode(session_dict))
+                    result += 1
+    LOGGER.info("removed the trackers of {} sessions".format(result))
+    return result
+
+
+def remove_orphaned_recommendations():
+    """
+    Removes the recommendation dictionaries and entries of resources which do
+    not exist anymore.
+
+    Returns the number of removed dictionaries and entries.
+    """
+    lrids = StorageObject.objects.values('identifier')
+    with transaction.atomic():
+        # the entries of removed dictionaries are removed with them
+        orphaned_dicts = ResourceCountDict.objects.exclude(lrid__in=lrids)
+        orphaned_pairs = ResourceCountPair.objects.exclude(lrid__in=lrids) \
+            .exclude(container__in=orphaned_dicts)
+        dict_count = orphaned_dicts.count()
+        pair_count = orphaned_pairs.count()
+        orphaned_pairs.delete()
+        ResourceCountPair.objects.filter(container__in=orphaned_dicts).delete()
+        orphaned_dicts.delete()
+    LOGGER.info("removed {} recommendations dictionaries and {} recommendations "
+                "entries".format(dict_count, pair_count))
+    return dict_count, pair_count
+
+
+def _get_base64_patterns(text):
+    """
+    Returns the three strings one of which is contained in the base64
+    encoding of any string that contains the given text, one for each
+    possible offset of the text modulo 3.
+    """
+    result = []
+    for _offset in range(3):
+        _encoded = base64.b64encode('\0' * _offset + text)
+        # only keep the characters which are fully determined by the text
+        result.append(_encoded[(8 * _offset + 5) // 6
+                               :8 * (_offset + len(text)) // 6])
+    return result
@@ -6,10 +6,10 @@ from django.core.urlresolvers import reverse
 from django.test.client import Client
 from metashare import test_utils, settings
 from metashare.recommendations.models import TogetherManager, ResourceCountPair, \
-    ResourceCountDict
+    ResourceCountDict, ResourceRelationKey
 from metashare.recommendations.recommendations import Resource, \
     SessionResourcesTracker, get_more_from_same_creators,\
-    get_more_from_same_projects
+    get_more_from_same_projects, get_view_recommendations
 from metashare.repository import views
 from metashare.settings import ROOT_PATH, LOG_HANDLER
 from metashare.storage.models import PUBLISHED, INGESTED, StorageObject
@@ -161,6 +161,24 @@ class SimpleTogetherManagerTest(django.test.TestCase):
         self.assertEquals(0, len(ResourceCountPair.objects.all()))
         self.assertEquals(1, len(ResourceCountDict.objects.all()))
         
+    def test_repair_removes_session_trackers(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        tracked = SessionStore()
+        tracked['tracker'] = SessionResourcesTracker()
+        tracked['tracker'].add_view(self.res_1, datetime.datetime.now())
+        tracked['other'] = 'value'
+        tracked.save()
+        untracked = SessionStore()
+        untracked['other'] = 'value'
+        untracked.save()
+        call_command('repair_recommendations', interactive=False,
+                     batch_size=1, verbosity=0)
+        tracked = SessionStore(session_key=tracked.session_key)
+        self.assertNotIn('tracker', tracked)
+        self.assertEqual('value', tracked['other'])
+        self.assertEqual('value',
+            SessionStore(session_key=untracked.session_key)['other'])
+
     def test_unique_together_constraint(self):
         man = TogetherManager.getManager(Resource.VIEW)
         man.addResourcePair(self.res_1, self.res_2)
@@ -273,6 +291,27 @@ class TogetherManagerTest(django.test.TestCase):
         self.assertEquals(self.res_3, sorted_res[0])
         self.assertEquals(self.res_4, sorted_res[1])
 
+    def test_cached_recommendations(self):
+        self.assertEqual([self.res_3, self.res_2, self.res_4],
+                         get_view_recommendations(self.res_1))
+        self.assertEqual([self.res_3, self.res_2],
+                         get_view_recommendations(self.res_1, 2))
+        # unpublishing a recommended resource discards the cached list
+        self.res_3.storage_object.publication_status = INGESTED
+        self.res_3.storage_object.save()
+        self.assertEqual([self.res_2, self.res_4],
+                         get_view_recommendations(self.res_1))
+        # so does adding new pairs
+        man = TogetherManager.getManager(Resource.VIEW)
+        for _ in range(3):
+            man.addResourcePairs(self.res_1.storage_object.identifier,
+                                 [self.res_4.storage_object.identifier])
+        self.assertEqual([self.res_4, self.res_2],
+                         get_view_recommendations(self.res_1))
+        # and deleting a recommended resource
+        self.res_4.delete_deep()
+        self.assertEqual([self.res_2], get_view_recommendations(self.res_1))
+
     def test_delete_deep(self):
         man = TogetherManager.getManager(Resource.VIEW)
         sorted_res = man.getTogetherList(self.res_2, 0)
@@ -637,5 +676,31 @@ class CreatorTest(django.test.TestCase):
         self.assertEquals(1, len(get_more_from_same_projects(self.res_3)))
         self.assertEquals(2, len(get_more_from_same_projects(self.res_4)))
         self.assertEquals(0, len(get_more_from_same_projects(self.res_5)))
-        
-    
\ No newline at end of file
+
+    def test_rebuild_resource_relations(self):
+        ResourceRelationKey.objects.all().delete()
+        self.assertEquals(0, len(get_more_from_same_creators(self.res_1)))
+        call_command('rebuild_resource_relations', verbosity=0)
+        self.test_creator()
+        self.test_project()
+
+    def test_relations_follow_metadata_changes(self):
+        _other_keys = sorted(ResourceRelationKey.objects
+            .exclude(resource=self.res_4).values_list('id', flat=True))
+        # the relations follow the changes right away, without a storage
+        # update
+        creation_info = self.res_4.resourceCreationInfo
+        creation_info.fundingProject.clear()
+        # only the keys of the changed resource itself are replaced
+        self.assertEquals(_other_keys, sorted(ResourceRelationKey.objects
+            .exclude(resource=self.res_4).values_list('id', flat=True)))
+        self.assertEquals(0, len(get_more_from_same_projects(self.res_4)))
+        self.assertEquals(0, len(get_more_from_same_projects(self.res_2)))
+        self.assertEquals(0, len(get_more_from_same_projects(self.res_3)))
+        creation_info.fundingProject.add(*self.res_2.resourceCreationInfo
+                                         .fundingProject.all())
+        self.assertEquals(1, len(get_more_from_same_projects(self.res_4)))
+        self.assertEquals(1, len(get_more_from_same_projects(self.res_2)))
+        # deleting a resource removes its relations
+        self.res_1.delete_deep()
+        self.assertEquals(0, len(get_more_from_same_creators(self.res_2)))
@@ -42,6 +42,8 @@ from metashare.repository.editor.inlines import ReverseInlineFormSet, \
 from metashare.repository.editor.schemamodel_mixin import encode_as_inline
 from metashare.repository.editor.superadmin import SchemaModelAdmin
 from metashare.repository.editor.widgets import OneToManyWidget
+from metashare.repository.metadata_access import get_metadata_elementtree, \
+    get_metadata_xml
 from metashare.repository.models import resourceComponentTypeType_model, \
     corpusInfoType_model, languageDescriptionInfoType_model, \
     lexicalConceptualResourceInfoType_model, toolServiceInfoType_model, \
@@ -507,7 +509,7 @@ class ResourceModelAdmin(SchemaModelAdmin):
                         reviewers = [u.email for u in User.objects.filter(groups__name__in=['reviewers'])] #,groups__name__in=groups_name)]
                         group_reviewers = [u.email for u in User.objects.filter(groups__name__in=groups_name, email__in=reviewers)]
                         ####
-                        resource_info=obj.export_to_elementtree()
+                        resource_info=get_metadata_elementtree(obj)
                         #LOGGER.info(to_xml_string(obj.export_to_elementtree(), encoding="utf-8").encode("utf-8"))
                         r_languages=[]
                         for lang in resource_info.iter('languageInfo'):
@@ -742,7 +744,7 @@ class ResourceModelAdmin(SchemaModelAdmin):
                         add_files2zip(resource_other_path,processed_zip)
                         
                         #add licence file
-                        resource_info=obj.export_to_elementtree()
+                        resource_info=get_metadata_elementtree(obj)
                         resource_name=[u.find('resourceName').text for u in resource_info.iter('identificationInfo')]
                         
                         user_membership = _get_user_membership(request.user) 
@@ -801,7 +803,7 @@ class ResourceModelAdmin(SchemaModelAdmin):
                             #if there are other files: add them as well
                             add_files2zip(resource_other_path,processed_zip)
                             #add licence file
-                            resource_info=obj.export_to_elementtree()
+                            resource_info=get_metadata_elementtree(obj)
                             resource_name=[u.find('resourceName').text for u in resource_info.iter('identificationInfo')]
                             
                             user_membership = _get_user_membership(request.user) 
@@ -897,7 +899,7 @@ class ResourceModelAdmin(SchemaModelAdmin):
                     saveLRStats(obj, UPDATE_STAT, request)
                     
                     #If successfully published, add to the archive.zip file the license documentation 
-                    resource_info=obj.export_to_elementtree()
+                    resource_info=get_metadata_elementtree(obj)
                     ## DEBUG
                     #LOGGER.info(to_xml_string(obj.export_to_elementtree(),encoding="utf-8").encode("utf-8"))
 
@@ -1066,9 +1068,9 @@ class ResourceModelAdmin(SchemaModelAdmin):
                 #change_resource_status(obj, status=PROCESSING, precondition_status=INTERNAL): 
                     successful += 1
                     saveLRStats(obj, INGEST_STAT, request)
-                    resource_info.append(obj.export_to_elementtree())
+                    resource_info.append(get_metadata_elementtree(obj))
                     #get resource name to include in the email
-                    resource_name=[u.find('resourceName').text for u in obj.export_to_elementtree().iter('identificationInfo')]
+                    resource_name=[u.find('resourceName').text for u in resource_info[-1].iter('identificationInfo')]
                     resource_names.append(resource_name[0])
                     groups_name=[]
                     for g in obj.groups.all():
@@ -1136,15 +1138,13 @@ class ResourceModelAdmin(SchemaModelAdmin):
         from StringIO import StringIO
         from zipfile import ZipFile
         from django import http
-        from metashare.xml_utils import to_xml_string
 
         zipfilename = "resources_export.zip"
         in_memory = StringIO()
         with ZipFile(in_memory, 'w') as zipfile:
             for obj in queryset:
                 try:
-                    xml_string = to_xml_string(obj.export_to_elementtree(),
-                                               encoding="utf-8").encode("utf-8")
+                    xml_string = get_metadata_xml(obj).encode("utf-8")
                     resource_filename = \
                         'resource-{0}.xml'.format(obj.storage_object.id)
                     zipfile.writestr(resource_filename, xml_string)
@@ -1992,12 +1992,10 @@ class ResourceModelAdmin(SchemaModelAdmin):
             return HttpResponseNotFound(_('%(name)s object with primary key %(key)s does not exist anymore.') \
               % {'name': force_unicode(opts.verbose_name), 'key': escape(object_id)})
 
-        from metashare.xml_utils import to_xml_string
         from django import http
 
         try:
-            root_node = obj.export_to_elementtree()
-            xml_string = to_xml_string(root_node, encoding="utf-8").encode('utf-8')
+            xml_string = get_metadata_xml(obj).encode('utf-8')
             resource_filename = 'resource-{0}.xml'.format(object_id)
 
             response = http.HttpResponse(xml_string, content_type='text/xml')
@@ -1,7 +1,7 @@
 import xmltodict
 import json
 from collections import OrderedDict
-from metashare.xml_utils import to_xml_string
+from metashare.repository.metadata_access import get_metadata_xml
 
 
 def xml_to_json(obj):
@@ -10,7 +10,7 @@ def xml_to_json(obj):
                    'attributionText', 'iprHolder', 'contactPerson', 'surname']
 
     # get xml representation
-    xml_string = to_xml_string(obj.export_to_elementtree(), encoding="utf-8").encode("utf-8")
+    xml_string = get_metadata_xml(obj).encode("utf-8")
 
     # parse xml to dict
     dict_repr = xmltodict.parse(xml_string, force_list=list_fields)
@@ -6,8 +6,8 @@ from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
-from metashare.recommendations.recommendations import get_more_from_same_creators, \
-    get_more_from_same_projects
+from metashare.recommendations.models import ResourceRelationKey
+from metashare.recommendations.recommendations import get_related_resource_ids
 from metashare.repository.models import resourceInfoType_model
 from metashare.repository.search_indexes import resourceInfoType_modelIndex
 from metashare.settings import LOG_HANDLER
@@ -130,16 +130,15 @@ def _process_special_query(query):
             resource_id, query_type)
         return []
     
-    # get related resources
+    # get the internal ids of the related resources
     if query_type == MORE_FROM_SAME_CREATORS:
-        rel_res = get_more_from_same_creators(res)
+        kind = ResourceRelationKey.SAME_CREATORS
     elif query_type == MORE_FROM_SAME_PROJECTS:
-        rel_res = get_more_from_same_projects(res)
+        kind = ResourceRelationKey.SAME_PROJECTS
     else:
         LOGGER.info('Ignoring unknown special query type "%s".', query_type)
         return []
-    # return internal ids from related resources
-    return [x.id for x in rel_res]
+    return list(get_related_resource_ids(res, kind))
     
 
 class LicenseSelectionForm(forms.Form):
@@ -4,11 +4,12 @@ import shutil
 from datetime import date, datetime
 from django.utils.encoding import smart_str
 
+from metashare.repository.metadata_access import get_metadata_xml
 from metashare.repository.models import resourceInfoType_model, versionInfoType_model, targetResourceInfoType_model, \
     relationInfoType_model, projectInfoType_model
 from metashare.settings import DJANGO_URL
 from metashare.storage.models import INGESTED, MASTER
-from metashare.xml_utils import to_xml_string, import_from_string
+from metashare.xml_utils import import_from_string
 from lxml import etree
 import os
 import zipfile
@@ -186,8 +187,7 @@ def extract_source_resource_metadata(res_id):
     res_owners = res.owners.all()
     view_path = res.get_absolute_url()
     try:
-        root_node = res.export_to_elementtree()
-        xml_string = to_xml_string(root_node, encoding="utf-8").encode('utf-8')
+        xml_string = get_metadata_xml(res).encode('utf-8')
         return {
             "resource": res,
             "uri": "{}{}".format(DJANGO_URL, view_path),
@@ -0,0 +1,124 @@
+"""
+A queue for search index updates of language resources.
+
+Updates which are scheduled for the same resource are coalesced and a
+background thread sends them to the search backend in batches, so that
+requests never have to wait for the search backend.
+"""
+import atexit
+import logging
+import os
+import threading
+
+from django import db
+
+from metashare import settings
+from metashare.settings import LOG_HANDLER
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(LOG_HANDLER)
+
+
+class IndexUpdateQueue(object):
+    """
+    A process-wide queue of the ids of the resources whose search index
+    entries have to be updated.
+    """
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._stopped = False
+
+    def add(self, resource_id):
+        """
+        Schedules an update of the search index entry of the resource with the
+        given id; several updates of the same resource are coalesced.
+        """
+        with self._lock:
+            self._ensure_worker()
+            self._pending.add(resource_id)
+            if len(self._pending) >= settings.SEARCH_INDEX_QUEUE_BATCH_SIZE:
+                self._wakeup.set()
+
+    def flush(self):
+        """
+        Sends all pending updates to the search backend.
+        """
+        from metashare.repository.search_indexes import update_lr_index_entries
+        with self._lock:
+            _ids = list(self._pending)
+            self._pending.clear()
+        _batch_size = settings.SEARCH_INDEX_QUEUE_BATCH_SIZE
+        for i in range(0, len(_ids), _batch_size):
+            update_lr_index_entries(_ids[i:i + _batch_size])
+
+    def stop(self):
+        """
+        Stops the background worker thread of this process after a final
+        flush of all pending updates; the thread is started again by the
+        next add().
+        """
+        if self._pid != os.getpid():
+            return
+        self._stopped = True
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join()
+        with self._lock:
+            self._worker = None
+            self._stopped = False
+        self.flush()
+
+    def _ensure_worker(self):
+        """
+        Starts the background worker thread if it is not running in this
+        process, yet; must be called while holding the lock.
+        """
+        if self._pid != os.getpid():
+            # a forked process does not inherit the worker thread, nor should
+            # it flush the updates scheduled by its parent
+            self._pid = os.getpid()
+            self._pending = set()
+            self._worker = None
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run,
+                                            name='index-update-queue')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        """
+        The main loop of the background worker thread.
+        """
+        while not self._stopped:
+            self._wakeup.wait(settings.SEARCH_INDEX_QUEUE_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except:
+                LOGGER.error('Could not update the search index.',
+                             exc_info=True)
+            finally:
+                # the worker must not keep a database connection open between
+                # two flushes
+                db.connection.close()
+
+
+# the index update queue of this process
+INDEX_UPDATE_QUEUE = IndexUpdateQueue()
+
+
+@atexit.register
+def _flush_on_exit():
+    """
+    Sends the updates which are still pending to the search backend when the
+    process exits.
+    """
+    try:
+        INDEX_UPDATE_QUEUE.stop()
+    except:
+        LOGGER.error('Could not update the search index.', exc_info=True)
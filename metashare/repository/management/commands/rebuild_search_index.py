@@ -0,0 +1,106 @@
+"""
+Management utility to rebuild the search index of all language resources in
+parallel.
+"""
+import logging
+from optparse import make_option
+
+from django import db
+from django.core.management.base import BaseCommand, CommandError
+
+from haystack import connections as haystack_connections, \
+    connection_router as haystack_connection_router
+
+from metashare import settings
+from metashare.repository.models import resourceInfoType_model
+from metashare.utils import WorkerPool
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', action='store', dest='workers',
+                    type='int', default=settings.MAINTENANCE_WORKERS,
+                    help='number of worker processes; defaults to '
+                    'MAINTENANCE_WORKERS'),
+        make_option('-b', '--batch-size', action='store', dest='batch_size',
+                    type='int', default=settings.SEARCH_INDEX_QUEUE_BATCH_SIZE,
+                    help='number of resources indexed with a single request; '
+                    'defaults to SEARCH_INDEX_QUEUE_BATCH_SIZE'),
+        make_option('-c', '--clear', action='store_true', dest='clear',
+                    default=False, help='clear the search index first'),
+    )
+
+    help = 'Rebuilds the search index of all language resources in parallel'
+
+    def handle(self, *args, **options):
+        """
+        Rebuilds the search index.
+        """
+        workers = options['workers']
+        batch_size = options['batch_size']
+        if workers < 1 or batch_size < 1:
+            raise CommandError('The number of workers and the batch size must '
+                               'be positive.')
+        using = haystack_connection_router.for_write()
+        if hasattr(using, '__iter__'):
+            using = using[0]
+        index = haystack_connections[using].get_unified_index() \
+            .get_index(resourceInfoType_model)
+        if options['clear']:
+            haystack_connections[using].get_backend().clear(
+                models=[resourceInfoType_model])
+
+        # the resources are split into chunks of primary keys instead of
+        # slices of the queryset so that no worker has to skip over the
+        # resources of the chunks before its own
+        resource_ids = list(index.index_queryset(using=using) \
+                            .order_by('pk').values_list('pk', flat=True))
+        total = len(resource_ids)
+        chunks = [(using, resource_ids[i:i + batch_size])
+                  for i in range(0, total, batch_size)]
+
+        pool = None
+        if workers > 1 and len(chunks) > 1:
+            # the worker processes must not share the database connections of
+            # this process
+            for _conn in db.connections.all():
+                _conn.close()
+            pool = WorkerPool(processes=workers)
+            results = pool.imap_unordered(_index_chunk, chunks)
+        else:
+            results = (_index_chunk(chunk) for chunk in chunks)
+        indexed = 0
+        try:
+            for _count in results:
+                indexed += _count
+                if int(options['verbosity']) >= 1:
+                    self.stdout.write('{0} of {1} resources indexed'
+                                      .format(indexed, total))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+
+def _index_chunk(args):
+    """
+    Indexes the resources with the given ids in the search backend with the
+    given name.
+
+    Returns the number of indexed resources.
+    """
+    using, resource_ids = args
+    # do not reuse a search backend connection of the parent process
+    haystack_connections.reload(using)
+    index = haystack_connections[using].get_unified_index() \
+        .get_index(resourceInfoType_model)
+    resources = list(index.indexing_queryset(using=using) \
+                     .filter(pk__in=resource_ids))
+    haystack_connections[using].get_backend().update(index, resources)
+    db.reset_queries()
+    return len(resources)
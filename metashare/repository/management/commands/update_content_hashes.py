@@ -0,0 +1,104 @@
+"""
+Management utility to compute the missing content hashes of all metadata
+objects in parallel.
+"""
+import logging
+from optparse import make_option
+
+from django import db
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from metashare import settings
+from metashare.repository.supermodel import SchemaModel
+from metashare.utils import WorkerPool
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', action='store', dest='workers',
+                    type='int', default=settings.MAINTENANCE_WORKERS,
+                    help='number of worker processes; defaults to '
+                    'MAINTENANCE_WORKERS'),
+        make_option('-b', '--batch-size', action='store', dest='batch_size',
+                    type='int', default=settings.MAINTENANCE_CHUNK_SIZE,
+                    help='number of objects handed to a worker at once; '
+                    'defaults to MAINTENANCE_CHUNK_SIZE'),
+        make_option('-a', '--all', action='store_true', dest='all',
+                    default=False, help='recompute all content hashes, not '
+                    'only the missing ones'),
+    )
+
+    help = 'Computes the missing content hashes of all metadata objects in ' \
+        'parallel'
+
+    def handle(self, *args, **options):
+        """
+        Computes the content hashes.
+        """
+        workers = options['workers']
+        batch_size = options['batch_size']
+        if workers < 1 or batch_size < 1:
+            raise CommandError('The number of workers and the batch size must '
+                               'be positive.')
+        chunks = []
+        for model in apps.get_app_config('repository').get_models():
+            # the hashes of subclass instances are stored with their super
+            # class instances
+            if not issubclass(model, SchemaModel) or \
+                    model._meta.get_field('content_hash').model is not model:
+                continue
+            _objects = model.objects.all()
+            if not options['all']:
+                _objects = _objects.filter(content_hash__isnull=True)
+            _ids = list(_objects.order_by('pk').values_list('pk', flat=True))
+            chunks.extend((model._meta.model_name, _ids[i:i + batch_size])
+                          for i in range(0, len(_ids), batch_size))
+        total = sum(len(_ids) for _, _ids in chunks)
+
+        pool = None
+        if workers > 1 and len(chunks) > 1:
+            # the worker processes must not share the database connections of
+            # this process
+            for _conn in db.connections.all():
+                _conn.close()
+            pool = WorkerPool(processes=workers)
+            results = pool.imap_unordered(_hash_chunk, chunks)
+        else:
+            results = (_hash_chunk(chunk) for chunk in chunks)
+        done = 0
+        try:
+            for _count in results:
+                done += _count
+                if int(options['verbosity']) >= 1:
+                    self.stdout.write('{0} of {1} objects processed'
+                                      .format(done, total))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+
+def _hash_chunk(args):
+    """
+    Computes the content hashes of the objects of the model with the given
+    name and the given ids.
+
+    Returns the number of processed objects.
+    """
+    model_name, object_ids = args
+    model = apps.get_model('repository', model_name)
+    for _object in model.objects.filter(pk__in=object_ids):
+        try:
+            _object.update_content_hash()
+        # pylint: disable-msg=W0703
+        except Exception:
+            LOGGER.error('Could not compute the content hash of {0} {1}.'
+                         .format(model_name, _object.pk), exc_info=True)
+    db.reset_queries()
+    return len(object_ids)
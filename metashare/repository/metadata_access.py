@@ -0,0 +1,141 @@
+"""
+Read access to the metadata XML of resources.
+
+The metadata XML which `StorageObject.check_metadata()` keeps in the storage
+object of an ingested or published resource is used instead of exporting the
+resource again, unless the metadata of the resource has been changed since the
+XML has been checked; parsed metadata XML is cached.
+"""
+import copy
+import logging
+import threading
+from collections import OrderedDict
+
+from lxml import etree
+
+from metashare import settings
+from metashare.settings import LOG_HANDLER
+from metashare.storage.models import INTERNAL
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(LOG_HANDLER)
+
+
+class _ElementTreeCache(object):
+    """
+    Caches the parsed metadata XML of the most recently used storage objects
+    together with the XML it has been parsed from, so that outdated entries
+    are never returned.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, metadata):
+        """
+        Returns the ElementTree cached under the given key if it has been
+        parsed from the given metadata XML, otherwise None.
+        """
+        with self._lock:
+            _entry = self._entries.pop(key, None)
+            if _entry is None or _entry[0] != metadata:
+                return None
+            self._entries[key] = _entry
+            return _entry[1]
+
+    def set(self, key, metadata, element_tree):
+        """
+        Caches the given ElementTree parsed from the given metadata XML.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.size:
+                # evict the least recently used entry
+                self._entries.popitem(last=False)
+            self._entries[key] = (metadata, element_tree)
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+ELEMENT_TREE_CACHE = _ElementTreeCache(settings.METADATA_TREE_CACHE_SIZE)
+
+
+def is_metadata_dirty(storage_object):
+    """
+    Returns True if the metadata XML kept in the given storage object may be
+    outdated, i.e., if it is not maintained at all (for internal resources),
+    or if the metadata of the resource had been changed since it has been
+    checked when the storage object was loaded.
+    """
+    return storage_object.publication_status == INTERNAL \
+        or not storage_object.metadata or storage_object.metadata_dirty
+
+
+def get_metadata_xml(resource):
+    """
+    Returns the metadata XML of the given resource as a Unicode string with
+    character entities for all non-ASCII characters, just like it is kept in
+    the storage object.
+    """
+    storage_object = resource.storage_object
+    if not is_metadata_dirty(storage_object):
+        return storage_object.metadata
+    # only import on demand as metashare.xml_utils depends on the statistics
+    # which depend on this module
+    from metashare.xml_utils import to_xml_string
+    return to_xml_string(resource.export_to_elementtree(), encoding="ASCII")
+
+
+def get_metadata_elementtree(resource, pretty=False):
+    """
+    Returns the metadata of the given resource as an ElementTree without any
+    namespace information in the tags, like export_to_elementtree() does.
+
+    The returned ElementTree is a copy which may be changed freely.  It is an
+    lxml ElementTree unless the metadata had to be exported.  In contrast to
+    an export, it does not contain the `groups` elements, which are not part
+    of the metadata schema, and elements of empty values have no text unless
+    the tree is pretty.
+
+    pretty (optional): if True, the elements include the 'pretty' attributes
+        of export_to_elementtree(pretty=True).
+    """
+    storage_object = resource.storage_object
+    if is_metadata_dirty(storage_object):
+        return resource.export_to_elementtree(pretty=pretty)
+    metadata = storage_object.metadata
+    _key = (storage_object.pk, pretty)
+    element_tree = ELEMENT_TREE_CACHE.get(_key, metadata)
+    if element_tree is None:
+        try:
+            element_tree = _parse_metadata(metadata)
+        # pylint: disable-msg=W0703
+        except Exception:
+            LOGGER.error('Could not parse the metadata XML of storage object '
+                         '{0}.'.format(storage_object.identifier),
+                         exc_info=True)
+            return resource.export_to_elementtree(pretty=pretty)
+        if pretty:
+            type(resource).add_pretty_names(element_tree)
+        ELEMENT_TREE_CACHE.set(_key, metadata, element_tree)
+    return copy.deepcopy(element_tree)
+
+
+def _parse_metadata(metadata):
+    """
+    Parses the given metadata XML string and removes all namespace
+    information from the tags of the result.
+    """
+    # the XML declaration refers to the encoded string
+    element_tree = etree.fromstring(metadata.encode('utf-8'))
+    for _element in element_tree.iter(tag=etree.Element):
+        _element.tag = _element.tag.split('}')[-1]
+    etree.cleanup_namespaces(element_tree)
+    return element_tree
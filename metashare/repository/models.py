@@ -25,7 +25,7 @@ from metashare.settings import DJANGO_BASE, LOG_HANDLER, DJANGO_URL
 from metashare.stats.model_utils import saveLRStats, DELETE_STAT, UPDATE_STAT
 from metashare.storage.models import StorageObject, MASTER, COPY_CHOICES
 from metashare.recommendations.models import ResourceCountPair, \
-    ResourceCountDict
+    ResourceCountDict, invalidate_recommendations
 # from metashare.repository.language_choices import LANGUAGENAME_CHOICES
 from metashare.repository.dataformat_choices import TEXTFORMATINFOTYPE_DATAFORMAT_CHOICES
 # MIMETYPELABEL_TO_MIMETYPEVALUE
@@ -225,6 +225,7 @@ class resourceInfoType_model(SchemaModel):
             # delete statistics
             saveLRStats(self, DELETE_STAT)
             # delete recommendations
+            invalidate_recommendations([self.storage_object.identifier])
             ResourceCountPair.objects.filter(lrid=self.storage_object.identifier).delete()
             ResourceCountDict.objects.filter(lrid=self.storage_object.identifier).delete()
 
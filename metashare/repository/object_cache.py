@@ -0,0 +1,142 @@
+"""
+A bounded cache for the canonical XML serializations of metadata objects.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class ObjectXMLCache(object):
+    """
+    Caches the canonical XML serializations of metadata objects by model and
+    primary key.
+
+    By default the serializations of the most recently used objects are kept
+    in the memory of each process; entries which are older than the timeout
+    are discarded, too.  If the name of a Django cache is given, the
+    serializations are kept in that cache instead, so that they are shared by
+    all processes and an invalidation in one process is seen by all others.
+
+    The cache is safe to use from several threads and a process which has
+    been forked from another one starts with an empty in-memory cache.
+    """
+    def __init__(self, size, timeout, backend=None):
+        self.size = size
+        self.timeout = timeout
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # maps cache keys to pairs of serializations and expiry times
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def get_key(obj):
+        """
+        Returns the cache key of the given metadata object.
+
+        Instances of subclasses share the key of their super class instance,
+        as both are serialized the same way.
+        """
+        _model = obj._meta.get_field('content_hash').model
+        return u'object_xml_{0}_{1}'.format(_model.__name__.lower(), obj.pk)
+
+    def get(self, obj):
+        """
+        Returns the cached serialization of the given metadata object or None
+        if it is not cached.
+        """
+        _key = self.get_key(obj)
+        if self.backend:
+            _value = caches[self.backend].get(_key)
+            with self._lock:
+                self._count(_value is not None)
+            return _value
+        with self._lock:
+            self._check_pid()
+            _value, _expiry = self._entries.pop(_key, (None, None))
+            if _value is not None and _expiry > time.time():
+                self._entries[_key] = (_value, _expiry)
+            else:
+                _value = None
+            self._count(_value is not None)
+        return _value
+
+    def set(self, obj, value):
+        """
+        Caches the given serialization of the given metadata object.
+        """
+        _key = self.get_key(obj)
+        if self.backend:
+            caches[self.backend].set(_key, value, self.timeout)
+            return
+        with self._lock:
+            self._check_pid()
+            self._entries.pop(_key, None)
+            if len(self._entries) >= self.size:
+                # evict the least recently used entry
+                self._entries.popitem(last=False)
+            self._entries[_key] = (value, time.time() + self.timeout)
+
+    def invalidate(self, obj):
+        """
+        Removes the serialization of the given metadata object from the cache.
+        """
+        _key = self.get_key(obj)
+        if self.backend:
+            caches[self.backend].delete(_key)
+            return
+        with self._lock:
+            self._check_pid()
+            self._entries.pop(_key, None)
+
+    def clear(self):
+        """
+        Removes all serializations from the in-memory cache and resets the
+        hit and miss counters; a shared cache is left untouched.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the number of cache hits and misses and the
+        number and total length of the serializations in the in-memory cache.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'size': sum(len(_value)
+                            for _value, _ in self._entries.itervalues()),
+            }
+
+    def _count(self, hit):
+        """
+        Counts a cache hit or miss; must be called while holding the lock.
+        """
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def _check_pid(self):
+        """
+        Empties the in-memory cache if this is a new process which has been
+        forked from the one that filled the cache, as the entries may be
+        invalidated in the other process without notice; must be called while
+        holding the lock.
+        """
+        _pid = os.getpid()
+        if _pid != self._pid:
+            self._pid = _pid
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,167 @@
+"""
+The metadata of the search facets which is required for rendering the
+filters/facets of the META-SHARE search.
+
+The facet metadata is compiled once from the fields of the resource search
+index instead of on every search request.
+"""
+import re
+
+from django.utils.http import urlquote
+
+from metashare.repository.search_fields import LabeledField
+
+# the words of a camel case facet value
+_CAMEL_CASE_WORD = re.compile(r'[A-Z\_]*[^A-Z]*')
+
+# the maximum number of facet values whose labels, query string parameters and
+# sub facets are cached
+FACET_VALUE_CACHE_SIZE = 10000
+
+_FACET_VALUE_LABELS = {}
+_FACET_TARGETS = {}
+
+
+def get_facet_value_label(value):
+    """
+    Returns the display label of the given facet value, i.e., the value with
+    its camel case words separated by spaces.
+    """
+    try:
+        return _FACET_VALUE_LABELS[value]
+    except KeyError:
+        label = u' '.join(_CAMEL_CASE_WORD.findall(
+            value[0].capitalize() + value[1:]))[:-1]
+        if len(_FACET_VALUE_LABELS) < FACET_VALUE_CACHE_SIZE:
+            _FACET_VALUE_LABELS[value] = label
+        return label
+
+
+def encode_facet_target(name, value):
+    """
+    Returns the query string parameter which selects the given value of the
+    search facet with the given (exact) name.
+    """
+    try:
+        return _FACET_TARGETS[(name, value)]
+    except KeyError:
+        target = u'&selected_facets={0}'.format(
+            urlquote(u'{0}:{1}'.format(name, value)))
+        if len(_FACET_TARGETS) < FACET_VALUE_CACHE_SIZE:
+            _FACET_TARGETS[(name, value)] = target
+        return target
+
+
+class Facet(object):
+    """
+    A search facet, i.e., a labeled filter field of the search index.
+    """
+    def __init__(self, name, label, facet_id, parent_id):
+        self.name = name
+        self.name_exact = u'{0}_exact'.format(name)
+        self.label = label
+        self.facet_id = facet_id
+        self.parent_id = parent_id
+        # the sub facets of this facet sorted by their facet ids
+        self.subfacets = []
+        self._subfacets_by_value = {}
+
+    def get_value_subfacets(self, value):
+        """
+        Returns the sub facets of this facet which belong to the given value
+        of this facet.
+
+        By convention, the name of a sub facet starts with the facet value it
+        belongs to.
+        """
+        try:
+            return self._subfacets_by_value[value]
+        except KeyError:
+            result = [facet for facet in self.subfacets if value in facet.name]
+            if len(self._subfacets_by_value) < FACET_VALUE_CACHE_SIZE:
+                self._subfacets_by_value[value] = result
+            return result
+
+
+class FacetRegistry(object):
+    """
+    The search facets of a search index.
+    """
+    def __init__(self, index_fields):
+        self.facets = sorted((Facet(name, field.label, field.facet_id,
+                                    field.parent_id)
+                              for name, field in index_fields.iteritems()
+                              if name.endswith('Filter')
+                              and isinstance(field, LabeledField)),
+                             key=lambda facet: facet.facet_id)
+        # the top level facets sorted by their facet ids
+        self.top_level_facets = [facet for facet in self.facets
+                                 if facet.parent_id == 0]
+        for facet in self.top_level_facets:
+            facet.subfacets = [subfacet for subfacet in self.facets
+                               if subfacet.parent_id == facet.facet_id]
+
+
+_FACET_REGISTRY = None
+
+
+def get_facet_registry():
+    """
+    Returns the search facets of the resource search index.
+    """
+    global _FACET_REGISTRY
+    if _FACET_REGISTRY is None:
+        from metashare.repository.search_indexes import \
+            resourceInfoType_modelIndex
+        # pylint: disable-msg=E1101
+        _FACET_REGISTRY = FacetRegistry(resourceInfoType_modelIndex.fields)
+    return _FACET_REGISTRY
+
+
+class SelectedFacets(object):
+    """
+    The facet values which are selected in a search request.
+
+    The query string parameters which select the facet values are encoded only
+    once per request so that the targets of the facet values can be built with
+    a single string concatenation.
+    """
+    def __init__(self, selected_facets):
+        """
+        `selected_facets` maps the exact facet names to lists of the selected
+        values.
+        """
+        self._values = dict((name, set(values))
+                            for name, values in selected_facets.iteritems())
+        self._params = [(name, value, encode_facet_target(name, value))
+                        for name, values in selected_facets.iteritems()
+                        for value in values]
+        self._query = u''.join(param for _name, _value, param in self._params)
+
+    def __nonzero__(self):
+        return bool(self._params)
+
+    def __contains__(self, name_exact):
+        return name_exact in self._values
+
+    def is_selected(self, name_exact, value):
+        """
+        Returns whether the given value of the given facet is selected.
+        """
+        return value in self._values.get(name_exact, ())
+
+    def get_adding_target(self, name_exact, value):
+        """
+        Returns the query string which selects the given facet value in
+        addition to the selected facet values.
+        """
+        return self._query + encode_facet_target(name_exact, value)
+
+    def get_removing_target(self, name_exact, value, excluded_names=()):
+        """
+        Returns the query string which selects all selected facet values but
+        the given one and the values of the facets with the given exact names.
+        """
+        return u''.join(param for name, _value, param in self._params
+                        if (name != name_exact or _value != value)
+                        and name not in excluded_names)
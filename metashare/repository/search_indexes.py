@@ -8,7 +8,9 @@ from haystack.indexes import CharField as VanillaCharField, \
 from haystack import indexes, connections as haystack_connections, \
     connection_router as haystack_connection_router
 
-from django.db.models import signals
+from django.core.cache import cache
+from django.db.models import signals, Sum
+from django.db.models.query import prefetch_related_objects
 from django.utils.translation import ugettext as _, activate as i18n_activate
 
 from metashare.repository import model_utils
@@ -18,9 +20,11 @@ from metashare.repository.models import resourceInfoType_model, \
     toolServiceInfoType_model, lexicalConceptualResourceInfoType_model, \
     languageDescriptionInfoType_model
 from metashare.repository.search_fields import LabeledMultiValueField, LabeledCharField
+from metashare import settings
 from metashare.settings import LOG_HANDLER, LANGUAGE_CODE
 from metashare.storage.models import StorageObject, INGESTED, PUBLISHED, INTERNAL
 from metashare.stats.model_utils import DOWNLOAD_STAT, VIEW_STAT
+from metashare.stats.models import LRStats
 
 
 # Setup logging support.
@@ -49,8 +53,14 @@ def update_lr_index_entry(res_obj):
     Updates/creates the search index entry for the given language resource
     object.
     
-    The appropriate search index is automatically chosen.
+    The appropriate search index is automatically chosen. If the
+    SEARCH_INDEX_QUEUE_ENABLED setting is True, the update is only scheduled
+    and sent to the search backend later on by a background thread.
     """
+    if settings.SEARCH_INDEX_QUEUE_ENABLED:
+        from metashare.repository.index_queue import INDEX_UPDATE_QUEUE
+        INDEX_UPDATE_QUEUE.add(res_obj.id)
+        return
     router_name = haystack_connection_router.for_write()
     if hasattr(router_name, '__iter__'):
         router_name = router_name[0]
@@ -58,6 +68,165 @@ def update_lr_index_entry(res_obj):
         .get_unified_index().get_index(resourceInfoType_model) \
         .update_object(res_obj)
 
+
+def update_lr_index_entries(resource_ids, using=None):
+    """
+    Updates/creates the search index entries for the language resources with
+    the given ids with a single request to the search backend.
+
+    Resources which are not to be indexed (anymore) are skipped.
+    """
+    if os.environ.get('DISABLE_INDEXING_DURING_IMPORT', False) == 'True':
+        return
+    if using is None:
+        using = haystack_connection_router.for_write()
+        if hasattr(using, '__iter__'):
+            using = using[0]
+    index = haystack_connections[using].get_unified_index() \
+        .get_index(resourceInfoType_model)
+    resources = list(index.indexing_queryset(using=using) \
+                     .filter(pk__in=resource_ids))
+    if resources:
+        LOGGER.info("Reindexing {0} resources.".format(len(resources)))
+        haystack_connections[using].get_backend().update(index, resources)
+
+
+def _get_group_filter_cache_key(user_id):
+    """
+    Returns the cache key of the search filter query of the user with the
+    given id.
+    """
+    return 'search-group-filter-{0}'.format(user_id)
+
+
+def get_group_filter_query(user):
+    """
+    Returns the search filter query which restricts the search results to the
+    published resources which are shared with one of the groups of the given
+    user, or None if the user is not member of any group.
+
+    The filter query of a user is cached until the group membership of the
+    user changes.
+    """
+    if not user.is_authenticated():
+        return None
+    cache_key = _get_group_filter_cache_key(user.id)
+    query = cache.get(cache_key)
+    if query is None:
+        group_ids = sorted(user.groups.values_list('id', flat=True))
+        if group_ids:
+            query = u'publicationStatusFilter_exact:published AND ' \
+                u'sharingGroups:({0})'.format(u' OR '.join(str(_id)
+                                                          for _id in group_ids))
+        else:
+            # an empty query is cached for users without any group
+            query = u''
+        cache.set(cache_key, query, settings.SEARCH_GROUP_FILTER_CACHE_TIMEOUT)
+    return query or None
+
+
+def invalidate_group_filter_queries(user_ids):
+    """
+    Removes the cached search filter queries of the users with the given ids.
+    """
+    cache.delete_many([_get_group_filter_cache_key(_id) for _id in user_ids])
+
+
+# the relations of a resource which are loaded together with the resource when
+# it is indexed; the subclass relations of the resource component avoid the
+# queries of `as_subclass()`
+RESOURCE_SELECT_RELATED = ('storage_object', 'identificationInfo',
+    'resourceComponentType__corpusinfotype_model__corpusMediaType',
+    'resourceComponentType__lexicalconceptualresourceinfotype_model'
+        '__lexicalConceptualResourceMediaType'
+        '__lexicalConceptualResourceTextInfo__lingualityInfo',
+    'resourceComponentType__lexicalconceptualresourceinfotype_model'
+        '__lexicalConceptualResourceEncodingInfo',
+    'resourceComponentType__languagedescriptioninfotype_model'
+        '__languageDescriptionMediaType'
+        '__languageDescriptionTextInfo__lingualityInfo',
+    'resourceComponentType__languagedescriptioninfotype_model'
+        '__languageDescriptionEncodingInfo',
+    'resourceComponentType__toolserviceinfotype_model__inputInfo',
+    'resourceComponentType__toolserviceinfotype_model__outputInfo',
+    'resourceComponentType__toolserviceinfotype_model'
+        '__toolServiceEvaluationInfo')
+
+RESOURCE_PREFETCH_RELATED = ('distributioninfotype_model_set__licenceInfo',
+                             'validationinfotype_model_set', 'groups')
+
+# the relations of the text infos of a resource which are loaded at once for
+# all text infos
+TEXT_INFO_PREFETCH_RELATED = ('languageinfotype_model_set',
+    'textformatinfotype_model_set', 'domaininfotype_model_set')
+CORPUS_TEXT_INFO_PREFETCH_RELATED = TEXT_INFO_PREFETCH_RELATED + (
+    'annotationinfotype_model_set', 'textclassificationinfotype_model_set')
+
+
+class ResourceIndexData(object):
+    """
+    The data of a single resource which is shared by all prepare_* methods of
+    the search index while the search index document of the resource is
+    prepared.
+
+    The parts of the resource graph which are required by the prepare_*
+    methods are loaded once with a few queries.
+    """
+    def __init__(self, resource):
+        # pylint: disable-msg=E1101
+        prefetch_related_objects([resource], list(RESOURCE_PREFETCH_RELATED))
+        self.resource = resource
+        self.component = resource.resourceComponentType.as_subclass()
+        self.input_output_infos = []
+        # the corpus text infos or the single text info of lexical conceptual
+        # resources and language descriptions
+        self.text_infos = []
+        if isinstance(self.component, corpusInfoType_model):
+            self.text_infos = list(self.component.corpusMediaType \
+                .corpustextinfotype_model_set.select_related('lingualityInfo') \
+                .prefetch_related(*CORPUS_TEXT_INFO_PREFETCH_RELATED))
+        elif isinstance(self.component, lexicalConceptualResourceInfoType_model):
+            _text_info = self.component.lexicalConceptualResourceMediaType \
+                .lexicalConceptualResourceTextInfo
+            if _text_info:
+                self.text_infos = [_text_info]
+        elif isinstance(self.component, languageDescriptionInfoType_model):
+            _text_info = self.component.languageDescriptionMediaType \
+                .languageDescriptionTextInfo
+            if _text_info:
+                self.text_infos = [_text_info]
+        elif isinstance(self.component, toolServiceInfoType_model):
+            self.input_output_infos = [_info for _info in
+                (self.component.inputInfo, self.component.outputInfo) if _info]
+            prefetch_related_objects(self.input_output_infos,
+                                     ['languagesetinfotype_model_set'])
+        if self.text_infos and not isinstance(self.component,
+                                              corpusInfoType_model):
+            prefetch_related_objects(self.text_infos,
+                                     list(TEXT_INFO_PREFETCH_RELATED))
+        self._cache = {}
+
+    def get(self, name, func):
+        """
+        Returns the value with the given name, computing it with the given
+        function only once.
+        """
+        if not name in self._cache:
+            self._cache[name] = func()
+        return self._cache[name]
+
+    def get_stat_count(self, stats_action):
+        """
+        Returns the count of the given stats action for the resource; the
+        counts of all stats actions are read with a single query.
+        """
+        def _get_counts():
+            return dict(LRStats.objects \
+                .filter(lrid=self.resource.storage_object.identifier) \
+                .values_list('action').annotate(Sum('count')))
+        return self.get('stat_counts', _get_counts).get(stats_action) or 0
+
+
 # pylint: disable-msg=C0103
 class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
     """
@@ -195,6 +364,12 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         label=_('Publication Status'), facet_id=57, parent_id=0,
         faceted=True)
 
+    # the ids of the groups with which a resource is shared; used for
+    # restricting the search results to the resources which are visible to
+    # a user; unlike the fields above, this is not a search facet and its name
+    # must therefore not end with "Filter"
+    sharingGroups = indexes.MultiValueField(stored=False)
+
     # Start sub filters
     textTextGenreFilter = LabeledMultiValueField(
         label=_('Text Genre'), facet_id=35, parent_id=3,
@@ -235,6 +410,49 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         return self.get_model().objects.filter(storage_object__deleted=False,
                                                storage_object__publication_status__in=[INGESTED, PUBLISHED])
 
+    def indexing_queryset(self, using=None):
+        """
+        Returns the QuerySet of resources to index, loading the related
+        objects which are required for indexing together with the resources.
+        """
+        return self.index_queryset(using=using) \
+            .select_related(*RESOURCE_SELECT_RELATED) \
+            .prefetch_related(*RESOURCE_PREFETCH_RELATED)
+
+    def build_queryset(self, using=None, start_date=None, end_date=None):
+        """
+        Returns the QuerySet of resources to index when doing a full index
+        update, loading the related objects which are required for indexing
+        together with the resources.
+        """
+        return super(resourceInfoType_modelIndex, self).build_queryset(
+            using=using, start_date=start_date, end_date=end_date) \
+            .select_related(*RESOURCE_SELECT_RELATED) \
+            .prefetch_related(*RESOURCE_PREFETCH_RELATED)
+
+    def full_prepare(self, obj):
+        """
+        Prepares the search index document for the given resource.
+
+        The data which is required by the prepare_* methods is extracted from
+        the resource graph only once per document.
+        """
+        obj._index_data = ResourceIndexData(obj)
+        try:
+            return super(resourceInfoType_modelIndex, self).full_prepare(obj)
+        finally:
+            del obj._index_data
+
+    @staticmethod
+    def get_index_data(obj):
+        """
+        Returns the shared index data of the given resource.
+        """
+        data = getattr(obj, '_index_data', None)
+        if data is None:
+            data = ResourceIndexData(obj)
+        return data
+
     def should_update(self, instance, **kwargs):
         '''
         Only index resources that are at least ingested.
@@ -278,7 +496,8 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
 
         # we better recreate our resource instance from the DB as otherwise it
         # has happened for some reason that the instance was not up-to-date
-        instance = self.get_model().objects.get(pk=instance.id)
+        instance = self.get_model().objects \
+            .select_related(*RESOURCE_SELECT_RELATED).get(pk=instance.id)
         LOGGER.info("Resource #{0} scheduled for reindexing." \
                     .format(instance.id))
         super(resourceInfoType_modelIndex, self) \
@@ -299,15 +518,13 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Returns the download count for the given resource object.
         """
-        return model_utils.get_lr_stat_action_count(
-            obj.storage_object.identifier, DOWNLOAD_STAT)
+        return self.get_index_data(obj).get_stat_count(DOWNLOAD_STAT)
 
     def prepare_view_count(self, obj):
         """
         Returns the view count for the given resource object.
         """
-        return model_utils.get_lr_stat_action_count(
-            obj.storage_object.identifier, VIEW_STAT)
+        return self.get_index_data(obj).get_stat_count(VIEW_STAT)
 
     def prepare_resourceNameSort(self, obj):
         """
@@ -387,42 +604,20 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Language Name
         """
-        result = []
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
-                result.extend([lang.languageName for lang in
-                               corpus_info.languageinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
-            lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
-            if lcr_media_type.lexicalConceptualResourceTextInfo:
-                result.extend([lang.languageName for lang in lcr_media_type \
-                              .lexicalConceptualResourceTextInfo.languageinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, languageDescriptionInfoType_model):
-            ld_media_type = corpus_media.languageDescriptionMediaType
-            if ld_media_type.languageDescriptionTextInfo:
-                result.extend([lang.languageName for lang in ld_media_type \
-                              .languageDescriptionTextInfo.languageinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.extend([lang.languageName for lang in
-                               corpus_media.inputInfo.languagesetinfotype_model_set.all()])
-            if corpus_media.outputInfo:
-                result.extend([lang.languageName for lang in
-                               corpus_media.outputInfo.languagesetinfotype_model_set.all()])
-
-        return result
+        data = self.get_index_data(obj)
+        def _get_language_names():
+            result = [lang.languageName for text_info in data.text_infos
+                      for lang in text_info.languageinfotype_model_set.all()]
+            result.extend([lang.languageName for info in data.input_output_infos
+                           for lang in info.languagesetinfotype_model_set.all()])
+            return result
+        return list(data.get('languageNames', _get_language_names))
 
     def prepare_resourceTypeFilter(self, obj):
         """
         Collect the data to filter the resources on Resource Type
         """
-        resType = obj.resourceComponentType.as_subclass().resourceType
+        resType = self.get_index_data(obj).component.resourceType
         if resType:
             return [resType]
         return []
@@ -431,7 +626,13 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Media Type
         """
-        return model_utils.get_resource_media_types(obj)
+        data = self.get_index_data(obj)
+        def _get_media_types():
+            result = [text_info.mediaType for text_info in data.text_infos]
+            result.extend([info.get_mediaType_display()
+                           for info in data.input_output_infos])
+            return [res.lower() for res in result]
+        return list(data.get('mediaTypes', _get_media_types))
 
     def prepare_availabilityFilter(self, obj):
         """
@@ -466,80 +667,32 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Linguality Type
         """
-        return model_utils.get_resource_linguality_infos(obj)
+        return [text_info.lingualityInfo.get_lingualityType_display()
+                for text_info in self.get_index_data(obj).text_infos]
 
     def prepare_multilingualityTypeFilter(self, obj):
         """
         Collect the data to filter the resources on Multilinguality Type
         """
         result = []
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
-                mtf = corpus_info.lingualityInfo \
-                    .get_multilingualityType_display()
-                if mtf != '':
-                    result.append(mtf)
-
-        elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
-            lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
-            if lcr_media_type.lexicalConceptualResourceTextInfo:
-                mtf = lcr_media_type.lexicalConceptualResourceTextInfo \
-                    .lingualityInfo.get_multilingualityType_display()
-                if mtf != '':
-                    result.append(mtf)
-
-        elif isinstance(corpus_media, languageDescriptionInfoType_model):
-            ld_media_type = corpus_media.languageDescriptionMediaType
-            if ld_media_type.languageDescriptionTextInfo:
-                mtf = ld_media_type.languageDescriptionTextInfo \
-                    .lingualityInfo.get_multilingualityType_display()
-                if mtf != '':
-                    result.append(mtf)
-
+        for text_info in self.get_index_data(obj).text_infos:
+            mtf = text_info.lingualityInfo.get_multilingualityType_display()
+            if mtf != '':
+                result.append(mtf)
         return result
 
     def prepare_dataFormatFilter(self, obj):
         """
         Collect the data to filter the resources on Mime Type
         """
-        dataFormat_list = []
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
-                dataFormat_list.extend([MIMETYPEVALUE_TO_MIMETYPELABEL[dataFormat.dataFormat]
-                                        if dataFormat.dataFormat in MIMETYPEVALUE_TO_MIMETYPELABEL
-                                        else dataFormat.dataFormat for dataFormat in
-                                        corpus_info.textformatinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
-            lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
-            if lcr_media_type.lexicalConceptualResourceTextInfo:
-                dataFormat_list.extend([MIMETYPEVALUE_TO_MIMETYPELABEL[dataFormat.dataFormat]
-                                        if dataFormat.dataFormat in MIMETYPEVALUE_TO_MIMETYPELABEL
-                                        else dataFormat.dataFormat for dataFormat in
-                                        lcr_media_type.lexicalConceptualResourceTextInfo \
-                                       .textformatinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, languageDescriptionInfoType_model):
-            ld_media_type = corpus_media.languageDescriptionMediaType
-            if ld_media_type.languageDescriptionTextInfo:
-                dataFormat_list.extend([MIMETYPEVALUE_TO_MIMETYPELABEL[dataFormat.dataFormat]
-                                        if dataFormat.dataFormat in MIMETYPEVALUE_TO_MIMETYPELABEL
-                                        else dataFormat.dataFormat for dataFormat in
-                                        ld_media_type.languageDescriptionTextInfo \
-                                       .textformatinfotype_model_set.all()])
-
-        elif isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                dataFormat_list.extend(corpus_media.inputInfo.dataFormat)
-            if corpus_media.outputInfo:
-                dataFormat_list.extend(corpus_media.outputInfo.dataFormat)
-
+        data = self.get_index_data(obj)
+        dataFormat_list = [MIMETYPEVALUE_TO_MIMETYPELABEL[dataFormat.dataFormat]
+                           if dataFormat.dataFormat in MIMETYPEVALUE_TO_MIMETYPELABEL
+                           else dataFormat.dataFormat
+                           for text_info in data.text_infos for dataFormat in
+                           text_info.textformatinfotype_model_set.all()]
+        for info in data.input_output_infos:
+            dataFormat_list.extend(info.dataFormat)
         return dataFormat_list
 
     def prepare_bestPracticesFilter(self, obj):
@@ -547,11 +700,11 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         Collect the data to filter the resources on Best Practices
         """
         result = []
-        corpus_media = obj.resourceComponentType.as_subclass()
+        data = self.get_index_data(obj)
+        corpus_media = data.component
 
         if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
+            for corpus_info in data.text_infos:
                 for annotation_info in corpus_info.annotationinfotype_model_set.all():
                     result.extend(annotation_info.get_conformanceToStandardsBestPractices_display_list())
 
@@ -565,13 +718,8 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
                 result.extend(corpus_media.languageDescriptionEncodingInfo \
                               .get_conformanceToStandardsBestPractices_display_list())
 
-        elif isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.extend(corpus_media.inputInfo \
-                              .get_conformanceToStandardsBestPractices_display_list())
-            if corpus_media.outputInfo:
-                result.extend(corpus_media.outputInfo \
-                              .get_conformanceToStandardsBestPractices_display_list())
+        for info in data.input_output_infos:
+            result.extend(info.get_conformanceToStandardsBestPractices_display_list())
 
         return result
 
@@ -579,43 +727,20 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Domain
         """
-        result = []
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
-                result.extend([domain_info.domain for domain_info in
-                               corpus_info.domaininfotype_model_set.all()])
-
-        elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
-            lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
-            if lcr_media_type.lexicalConceptualResourceTextInfo:
-                result.extend([domain_info.domain for domain_info in
-                               lcr_media_type.lexicalConceptualResourceTextInfo \
-                              .domaininfotype_model_set.all()])
-
-        elif isinstance(corpus_media, languageDescriptionInfoType_model):
-            ld_media_type = corpus_media.languageDescriptionMediaType
-            if ld_media_type.languageDescriptionTextInfo:
-                result.extend([domain_info.domain for domain_info in
-                               ld_media_type.languageDescriptionTextInfo \
-                              .domaininfotype_model_set.all()])
-
-        return result
+        return [domain_info.domain
+                for text_info in self.get_index_data(obj).text_infos
+                for domain_info in text_info.domaininfotype_model_set.all()]
 
     def prepare_corpusAnnotationTypeFilter(self, obj):
         """
         Collect the data to filter the resources on Resource Type children
         """
         result = []
-
-        corpus_media = obj.resourceComponentType.as_subclass()
+        data = self.get_index_data(obj)
 
         # Filter for corpus
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
+        if isinstance(data.component, corpusInfoType_model):
+            for corpus_info in data.text_infos:
                 for annotation_info in corpus_info.annotationinfotype_model_set.all():
                     result.append(annotation_info.get_annotationType_display())
 
@@ -625,7 +750,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Resource Type children
         """
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
         if isinstance(corpus_media, languageDescriptionInfoType_model):
             return [corpus_media.get_languageDescriptionType_display()]
         return []
@@ -634,7 +759,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Resource Type children
         """
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
         if isinstance(corpus_media, languageDescriptionInfoType_model) \
                 and corpus_media.languageDescriptionEncodingInfo:
             return corpus_media.languageDescriptionEncodingInfo \
@@ -647,7 +772,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         result = []
 
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
 
         # Filter for lexicalConceptual
         if isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
@@ -661,7 +786,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         result = []
 
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
 
         # Filter for lexicalConceptual
         if isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
@@ -677,7 +802,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         result = []
 
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
 
         # Filter for lexicalConceptual
         if isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
@@ -693,7 +818,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         result = []
 
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
 
         # Filter for toolService
         if isinstance(corpus_media, toolServiceInfoType_model):
@@ -722,7 +847,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         result = []
 
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
 
         # Filter for toolService
         if isinstance(corpus_media, toolServiceInfoType_model):
@@ -734,53 +859,24 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Resource Type children
         """
-        result = []
-
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        # Filter for toolService
-        if isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.extend(
-                    corpus_media.inputInfo.get_resourceType_display_list())
-            if corpus_media.outputInfo:
-                result.extend(
-                    corpus_media.outputInfo.get_resourceType_display_list())
-
-        return result
+        return [resource_type
+                for info in self.get_index_data(obj).input_output_infos
+                for resource_type in info.get_resourceType_display_list()]
 
     def prepare_toolServiceInputOutputMediaTypeFilter(self, obj):
         """
         Collect the data to filter the resources on Resource Type children
         """
-        result = []
-
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        # Filter for toolService
-        if isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.append(corpus_media.inputInfo.get_mediaType_display())
-            if corpus_media.outputInfo:
-                result.append(corpus_media.outputInfo.get_mediaType_display())
-
-        return result
+        return [info.get_mediaType_display()
+                for info in self.get_index_data(obj).input_output_infos]
 
     def prepare_toolServiceAnnotationTypeFilter(self, obj):
         """
         Collect the data to filter the resources on Resource Type children
         """
-        result = []
-
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.extend(corpus_media.inputInfo.get_annotationType_display_list())
-            if corpus_media.outputInfo:
-                result.extend(corpus_media.outputInfo.get_annotationType_display_list())
-
-        return result
+        return [annotation_type
+                for info in self.get_index_data(obj).input_output_infos
+                for annotation_type in info.get_annotationType_display_list()]
 
     def prepare_toolServiceEvaluatedFilter(self, obj):
         """
@@ -788,7 +884,7 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         result = []
 
-        corpus_media = obj.resourceComponentType.as_subclass()
+        corpus_media = self.get_index_data(obj).component
 
         # Filter for toolService
         if isinstance(corpus_media, toolServiceInfoType_model):
@@ -802,13 +898,11 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         Collect the data to filter the resources on Media Type children
         """
         result = []
-
-        corpus_media = obj.resourceComponentType.as_subclass()
+        data = self.get_index_data(obj)
 
         # Filter for corpus
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
+        if isinstance(data.component, corpusInfoType_model):
+            for corpus_info in data.text_infos:
                 result.extend([text_classification_info.textGenre \
                                for text_classification_info in corpus_info.textclassificationinfotype_model_set.all()])
 
@@ -819,13 +913,11 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         Collect the data to filter the resources on Media Type children
         """
         result = []
-
-        corpus_media = obj.resourceComponentType.as_subclass()
+        data = self.get_index_data(obj)
 
         # Filter for corpus
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
+        if isinstance(data.component, corpusInfoType_model):
+            for corpus_info in data.text_infos:
                 result.extend([text_classification_info.textType \
                                for text_classification_info in corpus_info.textclassificationinfotype_model_set.all()])
 
@@ -835,38 +927,13 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         """
         Collect the data to filter the resources on Language Variety
         """
-        result = []
-        corpus_media = obj.resourceComponentType.as_subclass()
-
-        if isinstance(corpus_media, corpusInfoType_model):
-            media_type = corpus_media.corpusMediaType
-            for corpus_info in media_type.corpustextinfotype_model_set.all():
-                for lang in corpus_info.languageinfotype_model_set.all():
-                    result.extend([variety.languageVarietyName for variety in
-                                   lang.languageVarietyInfo.all()])
-
-        elif isinstance(corpus_media, lexicalConceptualResourceInfoType_model):
-            lcr_media_type = corpus_media.lexicalConceptualResourceMediaType
-            if lcr_media_type.lexicalConceptualResourceTextInfo:
-                for lang in lcr_media_type.lexicalConceptualResourceTextInfo. \
-                        languageinfotype_model_set.all():
-                    result.extend([variety.languageVarietyName for variety in
-                                   lang.languageVarietyInfo.all()])
-
-        elif isinstance(corpus_media, languageDescriptionInfoType_model):
-            ld_media_type = corpus_media.languageDescriptionMediaType
-            if ld_media_type.languageDescriptionTextInfo:
-                for lang in ld_media_type.languageDescriptionTextInfo. \
-                        languageinfotype_model_set.all():
-                    result.extend([variety.languageVarietyName for variety in
-                                   lang.languageVarietyInfo.all()])
-
-        elif isinstance(corpus_media, toolServiceInfoType_model):
-            if corpus_media.inputInfo:
-                result.extend(corpus_media.inputInfo.languageVarietyName)
-            if corpus_media.outputInfo:
-                result.extend(corpus_media.outputInfo.languageVarietyName)
-
+        data = self.get_index_data(obj)
+        result = [variety.languageVarietyName
+                  for text_info in data.text_infos
+                  for lang in text_info.languageinfotype_model_set.all()
+                  for variety in lang.languageVarietyInfo.all()]
+        for info in data.input_output_infos:
+            result.extend(info.languageVarietyName)
         return result
 
     def prepare_appropriatenessForDSIFilter(self, obj):
@@ -880,3 +947,10 @@ class resourceInfoType_modelIndex(SearchIndex, indexes.Indexable):
         Collect the data to filter the resources on publication status
         """
         return obj.publication_status()
+
+    def prepare_sharingGroups(self, obj):
+        """
+        Collect the data to filter the resources on the groups with which
+        they are shared
+        """
+        return [group.pk for group in obj.groups.all()]
@@ -1,13 +1,18 @@
+from django.contrib.auth.models import Group, User
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db.models.signals import post_save, post_delete, pre_delete
+from django.db.models.signals import post_save, post_delete, pre_delete, \
+    m2m_changed, post_init
 from django.dispatch import receiver
 
 from haystack.exceptions import NotHandled
 from haystack.signals import BaseSignalProcessor
 
+from metashare.recommendations.models import invalidate_recommendations
+from metashare.recommendations.recommendations import update_resource_relations
 from metashare.storage.models import StorageObject, INGESTED, PUBLISHED
-from metashare.repository.models import resourceInfoType_model
+from metashare.repository.models import resourceInfoType_model, \
+    resourceCreationInfoType_model
 from project_management.models import ManagementObject
 
 
@@ -20,8 +25,9 @@ class PatchedSignalProcessor(BaseSignalProcessor):
 
     def setup(self):
         """
-        Register the ``StorageOject`` model post_save signal
-        and the ``resourceInfoType_model`` model post_delete signal.
+        Register the ``StorageOject`` model post_save signal,
+        the ``resourceInfoType_model`` model post_delete signal and the
+        m2m_changed signal of the sharing groups of ``resourceInfoType_model``.
         """
         models.signals.post_save.connect(self.handle_save,
                                          sender=StorageObject)
@@ -29,10 +35,14 @@ class PatchedSignalProcessor(BaseSignalProcessor):
         models.signals.post_delete.connect(self.handle_delete,
                                            sender=resourceInfoType_model)
 
+        models.signals.m2m_changed.connect(self.handle_groups_change,
+            sender=resourceInfoType_model.groups.through)
+
     def teardown(self):
         """
-        Unregister the ``StorageOject`` model post_save signal
-        and the ``resourceInfoType_model`` model post_delete signal.
+        Unregister the ``StorageOject`` model post_save signal,
+        the ``resourceInfoType_model`` model post_delete signal and the
+        m2m_changed signal of the sharing groups of ``resourceInfoType_model``.
         """
         models.signals.post_save.disconnect(self.handle_save,
                                             sender=StorageObject)
@@ -40,6 +50,9 @@ class PatchedSignalProcessor(BaseSignalProcessor):
         models.signals.post_delete.disconnect(self.handle_delete,
                                               sender=resourceInfoType_model)
 
+        models.signals.m2m_changed.disconnect(self.handle_groups_change,
+            sender=resourceInfoType_model.groups.through)
+
     def handle_save(self, sender, instance, **kwargs):
         """
         Given a StorageObject model instance, determine which backends the
@@ -58,6 +71,35 @@ class PatchedSignalProcessor(BaseSignalProcessor):
                     # TODO: Maybe log it or let the exception bubble?
                     pass
 
+    def handle_groups_change(self, sender, instance, action, reverse, pk_set,
+                             **kwargs):
+        """
+        Updates the index entries of the resources whose sharing groups have
+        changed, as the groups restrict the visibility of a resource in the
+        search; the update is not queued so that a resource is never shown
+        to the members of a group which it is no longer shared with.
+        """
+        if not reverse:
+            resource_ids = [instance.pk]
+        elif action == 'pre_clear':
+            # the resources of a group cannot be found anymore after clearing
+            instance._cleared_resource_ids = list(instance \
+                .resourceinfotype_model_set.values_list('id', flat=True))
+            return
+        elif action == 'post_clear':
+            resource_ids = getattr(instance, '_cleared_resource_ids', [])
+        else:
+            resource_ids = pk_set
+        if action not in ('post_add', 'post_remove', 'post_clear') \
+                or not resource_ids:
+            return
+        # only import on demand as this module is loaded by Haystack before
+        # the app registry is ready, which the search indexes require
+        from metashare.repository.search_indexes import \
+            update_lr_index_entries
+        # only ingested and published resources are indexed
+        update_lr_index_entries(list(resource_ids))
+
 
 # PROJECT MANAGEMENT
 @receiver(post_save, sender=resourceInfoType_model)
@@ -76,3 +118,116 @@ def delete_management_object(sender, instance, **kwargs):
         mng_obj.delete()
     except ObjectDoesNotExist:
         pass
+
+
+# RECOMMENDATIONS
+@receiver(post_init, sender=StorageObject)
+def remember_recommendable_state(sender, instance, **kwargs):
+    """
+    Remembers whether the resource of the given storage object can be
+    recommended, i.e., whether it is published and not deleted.
+    """
+    instance._recommendable = instance.publication_status == PUBLISHED \
+        and not instance.deleted
+
+
+@receiver(post_save, sender=StorageObject)
+def invalidate_recommendations_on_status_change(sender, instance, **kwargs):
+    """
+    Discards the cached recommendations which may include the resource of the
+    given storage object when the resource is published, unpublished or
+    deleted.
+    """
+    _recommendable = instance.publication_status == PUBLISHED \
+        and not instance.deleted
+    if _recommendable != getattr(instance, '_recommendable', None):
+        invalidate_recommendations([instance.identifier])
+    instance._recommendable = _recommendable
+
+
+@receiver(post_save, sender=resourceInfoType_model)
+def update_resource_relations_on_save(sender, instance, **kwargs):
+    """
+    Recomputes the relations of the given resource to the resources with the
+    same creators or funding projects when the resource is saved, e.g., as
+    its resource creation information may have been replaced.
+    """
+    update_resource_relations(instance)
+
+
+# the many-to-many fields of the resource creation information which define
+# the relations between resources, by their intermediary models
+_RELATION_FIELDS = dict(
+    (getattr(resourceCreationInfoType_model, _name).through, _name)
+    for _name in ('resourceCreator', 'fundingProject'))
+
+
+@receiver(m2m_changed)
+def update_resource_relations_on_creators_change(sender, instance, action,
+                                                 reverse, pk_set, **kwargs):
+    """
+    Recomputes the relations of the resources to the resources with the same
+    creators or funding projects when the creators or funding projects of
+    their resource creation information change, e.g., in the editor.
+    """
+    if not sender in _RELATION_FIELDS:
+        return
+    if not reverse:
+        creation_info_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # the creation information cannot be found anymore after clearing
+        instance._cleared_creation_info_ids = list(
+            resourceCreationInfoType_model.objects.filter(
+                **{_RELATION_FIELDS[sender]: instance})
+            .values_list('pk', flat=True))
+        return
+    elif action == 'post_clear':
+        creation_info_ids = getattr(instance, '_cleared_creation_info_ids', [])
+    else:
+        creation_info_ids = pk_set
+    if action not in ('post_add', 'post_remove', 'post_clear') \
+            or not creation_info_ids:
+        return
+    for resource in resourceInfoType_model.objects \
+            .filter(resourceCreationInfo__in=list(creation_info_ids)):
+        update_resource_relations(resource)
+
+
+# SEARCH
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_filter_on_membership_change(sender, instance, action,
+                                                 reverse, pk_set, **kwargs):
+    """
+    Discards the cached search filter queries of the users whose group
+    membership has changed.
+    """
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # the members of a group cannot be found anymore after clearing
+        instance._cleared_user_ids = list(instance.user_set \
+            .values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        user_ids = getattr(instance, '_cleared_user_ids', [])
+    else:
+        user_ids = pk_set
+    if action in ('post_add', 'post_remove', 'post_clear') and user_ids:
+        # only import on demand, see handle_groups_change()
+        from metashare.repository.search_indexes import \
+            invalidate_group_filter_queries
+        invalidate_group_filter_queries(user_ids)
+
+
+@receiver(pre_delete)
+def invalidate_group_filter_on_group_deletion(sender, instance, **kwargs):
+    """
+    Discards the cached search filter queries of the members of a group which
+    is deleted.
+    """
+    if sender is Group:
+        # only import on demand, see handle_groups_change()
+        from metashare.repository.search_indexes import \
+            invalidate_group_filter_queries
+        invalidate_group_filter_queries(
+            instance.user_set.values_list('id', flat=True))
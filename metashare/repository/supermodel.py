@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import logging
 import re
 import urllib
@@ -12,15 +13,20 @@ from django.core.exceptions import ValidationError, ObjectDoesNotExist, \
     ImproperlyConfigured
 from django.db import models, IntegrityError
 from django.db.models.fields import related
+from django.db.models.signals import pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.db.models.fields.related import ForeignRelatedObjectsDescriptor, \
     OneToOneField
 
 import metashare.repository.models
 from metashare.repository.fields import MultiSelectField, MultiTextField, \
     MetaBooleanField, DictField
+from metashare.repository.object_cache import ObjectXMLCache
 from metashare.settings import LOG_HANDLER, \
-    CHECK_FOR_DUPLICATE_INSTANCES
-from metashare.storage.models import MASTER
+    CHECK_FOR_DUPLICATE_INSTANCES, OBJECT_XML_CACHE_SIZE, \
+    OBJECT_XML_CACHE_TIMEOUT, OBJECT_XML_CACHE_BACKEND
+from metashare.storage.models import MASTER, StorageObject, \
+    mark_metadata_dirty
 from metashare.utils import SimpleTimezone, prettify_camel_case_string
 
 
@@ -47,7 +53,9 @@ SCHEMA_URL = 'http://www.elrc-share.eu/ELRC-SHARE_SCHEMA/v{0}/' \
 METASHARE_ID_REGEXP = re.compile('<metashareId>.+</metashareId>',
   re.I|re.S|re.U)
 
-OBJECT_XML_CACHE = {}
+# the canonical XML serializations of metadata objects, see get_canonical_xml()
+OBJECT_XML_CACHE = ObjectXMLCache(OBJECT_XML_CACHE_SIZE,
+  OBJECT_XML_CACHE_TIMEOUT, OBJECT_XML_CACHE_BACKEND)
 
 # This import is required for at least an `eval` in the `_classify` function:
 # pylint: disable-msg=W0611
@@ -134,6 +142,14 @@ class SchemaModel(models.Model):
     __schema_attrs__ = ()
     __schema_classes__ = {}
     __schema_parent__ = None
+
+    # the SHA-1 hash of the canonical XML serialization of this object, see
+    # get_canonical_xml(); used for finding duplicates with a single indexed
+    # query; None if the hash has not been computed since the last change of
+    # this object or of any object contained in it; the column is added to
+    # existing tables by the add_missing_columns command
+    content_hash = models.CharField(max_length=40, null=True, blank=True,
+                                    editable=False, db_index=True)
     
     class Meta:
         """
@@ -531,23 +547,167 @@ class SchemaModel(models.Model):
         # using: xml.etree.ElementTree.tostring(_root, encoding="utf-8")
         return _root
 
+    @classmethod
+    def add_pretty_names(cls, element_tree):
+        """
+        Adds the 'pretty' attributes which export_to_elementtree(pretty=True)
+        would create to the given ElementTree, which must be a namespace-free
+        export of an instance of this class, and prettifies the values of
+        choice fields and sets the text of empty values in the same way.
+
+        This allows to use a parsed metadata XML serialization instead of
+        exporting the instance again.
+        """
+        try:
+            element_tree.attrib["pretty"] = cls._meta.verbose_name
+        except AttributeError:
+            element_tree.attrib["pretty"] = element_tree.tag
+        for _child in element_tree:
+            cls._add_pretty_names_to_field(_child, [_child.tag])
+        return element_tree
+
+    @classmethod
+    def _add_pretty_names_to_field(cls, element, path):
+        """
+        Adds the 'pretty' attributes to the given element of the schema field
+        with the given (partial) element path and to its descendants.
+        """
+        _fields = [(_xsd_field.split('/'), _model_field)
+                   for _xsd_field, _model_field, _not_used
+                   in cls.__schema_fields__
+                   if _xsd_field.split('/')[:len(path)] == path]
+        if not _fields:
+            LOGGER.debug(u'Unknown element {0} in {1}'.format(path,
+              cls.__schema_name__))
+            element.attrib["pretty"] = element.tag
+            return
+
+        # all elements which are created for a field get its pretty name; an
+        # intermediate element of an element path is created for the field of
+        # its first child
+        _model_field = _fields[0][1]
+        if len(_fields[0][0]) > len(path) and len(element):
+            _model_field = ([_field for _xsd_path, _field in _fields
+                             if _xsd_path[len(path):len(path) + 1]
+                             == [element[0].tag]]
+                            or [_model_field])[0]
+        element.attrib["pretty"] = cls.get_verbose_name(_model_field)
+        if len(_fields[0][0]) > len(path):
+            # an intermediate element of an element path
+            for _child in element:
+                cls._add_pretty_names_to_field(_child, path + [_child.tag])
+            return
+
+        _sub_cls = None
+        if path[-1] in cls.__schema_classes__:
+            _sub_cls = _classify(cls.__schema_classes__[path[-1]])
+        if _sub_cls is not None and _sub_cls.__schema_name__ != "STRINGMODEL":
+            for _child in element:
+                _sub_cls._add_pretty_names_to_field(_child, [_child.tag])
+        elif element.text is None:
+            element.text = u''
+        elif cls.is_choice(_model_field):
+            element.text = prettify_camel_case_string(element.text)
+
+    def get_canonical_xml(self):
+        """
+        Returns the XML serialization of this object without any META-SHARE
+        ids; two objects are duplicates of each other if their canonical XML
+        serializations are equal.
+
+        The serialization is cached in OBJECT_XML_CACHE until this object is
+        changed.
+        """
+        _value = OBJECT_XML_CACHE.get(self)
+        if _value is None:
+            _object = self
+            if isinstance(self, SubclassableModel):
+                # the hash of a subclass instance is stored in the table of its
+                # super class, so it must not depend on the class it is read
+                # from
+                _object = self.as_subclass()
+            _value = METASHARE_ID_REGEXP.sub('',
+              tostring(_object.export_to_elementtree()))
+            OBJECT_XML_CACHE.set(self, _value)
+        return _value
+
+    def update_content_hash(self, canonical_xml=None):
+        """
+        Computes and stores the content hash of this object from the given or
+        its current canonical XML serialization without saving any other
+        field.
+
+        Returns the content hash.
+        """
+        if canonical_xml is None:
+            canonical_xml = self.get_canonical_xml()
+        self.content_hash = hashlib.sha1(canonical_xml).hexdigest()
+        type(self).objects.filter(pk=self.pk) \
+            .update(content_hash=self.content_hash)
+        return self.content_hash
+
     @classmethod
     def _check_for_duplicates(cls, _object):
         """
         Checks if the given _object is a redundant copy of another object.
 
-        Returns a list containing all existing objects that are equal to the
-        given _object instance, sorted by the primary key.
+        Returns a list of existing objects that are equal to the given _object
+        instance, sorted by the primary key, or an empty list if there is no
+        such object.  Candidates with a stored content hash are only compared
+        until the first real duplicate, so the list need not contain all
+        duplicates.
+
+        The content hashes of the given _object and of the candidates are
+        stored, so that each of them is serialized only once as long as it is
+        not changed.
         """
         if not CHECK_FOR_DUPLICATE_INSTANCES:
             return []
 
-        _was_duplicate = False
-        _related_objects = []
+        # the serialization does not cover all fields, e.g., the values of
+        # string models, so only objects with equal fields are candidates
+        query_set = cls.objects.filter(
+          **cls._get_duplicate_constraints(_object)).exclude(pk=_object.pk)
+        if not query_set.exists():
+            return []
+
+        _obj_value = _object.get_canonical_xml()
+        _hash = _object.update_content_hash(_obj_value)
+
+        # the stored hashes of the candidates are cleared whenever they or any
+        # of their contained objects change, but they may still be outdated
+        # after changes which bypass the models, e.g., queryset updates, so
+        # the (cached) serializations are compared until the first real
+        # duplicate is found
+        _duplicates = []
+        for _candidate in query_set.filter(content_hash=_hash).order_by('pk'):
+            _check = _candidate.get_canonical_xml()
+            if _check == _obj_value:
+                _duplicates.append(_candidate)
+                break
+            _candidate.update_content_hash(_check)
+
+        # candidates which have been changed since their hash has been
+        # computed (or which have been created before there were content
+        # hashes) have no hash; it is computed and stored once for each of them
+        for _candidate in query_set.filter(content_hash__isnull=True):
+            if _candidate.update_content_hash() == _hash:
+                _duplicates.append(_candidate)
+        _duplicates.sort(key=lambda _candidate: _candidate.pk)
 
+        return _duplicates
+
+    @classmethod
+    def _get_duplicate_constraints(cls, _object):
+        """
+        Returns the QuerySet lookup constraints which all existing objects
+        that are equal to the given _object instance fulfil.
+        """
         # We collect all value constraints in a dictionary.
         kwargs = {}
 
+        _related_objects = []
+
         # Build list of field names for this class type.  Using introspection
         # with cls._meta.get_all_field_names() would not work as it contains
         # additional fields such as primary field and related fields that would
@@ -629,51 +789,7 @@ class SchemaModel(models.Model):
                 LOGGER.debug(u'Skipping {0}={1} ({2})'.format(field_name,
                   _value, type(_field)))
 
-        # Use **magic to create a constrained QuerySet from kwargs.
-        query_set = cls.objects.filter(**kwargs).order_by('pk')
-
-        _duplicates = []
-        if query_set.count() > 1:
-            # We now know that there may exist at least one duplicate for the
-            # given _object;  we have to check the related objects to be sure.
-            
-            # Convert the current object into its serialised XML String and
-            # remove any META-SHARE related id from this String.
-            cache_key = '{}_{}'.format(type(_object).__name__.lower(),
-              _object._get_pk_val())
-
-            if OBJECT_XML_CACHE.has_key(cache_key):
-                _obj_value = OBJECT_XML_CACHE[cache_key]
-            
-            else:
-                _obj_value = tostring(_object.export_to_elementtree())
-                _obj_value = METASHARE_ID_REGEXP.sub('', _obj_value)
-                OBJECT_XML_CACHE[cache_key] = _obj_value
-
-            # Iterate over all potential duplicates, ordered by increasing
-            # primary key.
-            for _candidate in query_set.iterator():
-                # Skip the current candidate if it is our _object itself.
-                if _candidate == _object:
-                    continue
-
-                # Convert candidate into XML String and remove META-SHARE id.
-                cache_key = '{}_{}'.format(type(_candidate).__name__.lower(),
-                  _candidate._get_pk_val())
-
-                if OBJECT_XML_CACHE.has_key(cache_key):
-                    _check = OBJECT_XML_CACHE[cache_key]
-
-                else:
-                    _check = tostring(_candidate.export_to_elementtree())
-                    _check = METASHARE_ID_REGEXP.sub('', _check)
-                    OBJECT_XML_CACHE[cache_key] = _check
-
-                # If both XML Strings are equal, we have found a duplicate!
-                if _obj_value == _check:
-                    _duplicates.append(_candidate)
-
-        return _duplicates
+        return kwargs
 
     @staticmethod
     def _cleanup(objects, only_remove_duplicates=False):
@@ -705,12 +821,6 @@ class SchemaModel(models.Model):
             if obj._get_pk_val():
                 try:
                     LOGGER.debug(u'Deleting object {0}'.format(obj))
-                    cache_key = '{}_{}'.format(type(obj).__name__.lower(),
-                      obj._get_pk_val())
-
-                    if OBJECT_XML_CACHE.has_key(cache_key):
-                        OBJECT_XML_CACHE.pop(cache_key)
-
                     if obj.__schema_name__ == "resourceInfo":
                         storage_object = obj.storage_object
                         storage_object.delete()
@@ -1303,9 +1413,16 @@ class SchemaModel(models.Model):
         '''
         Override the superclass method to trigger cache updating.
         '''
+        # the content hash is computed again when it is needed next time
+        self.content_hash = None
+        _adding = self._state.adding
         super(SchemaModel, self).save(force_insert, force_update, using)
         cache_key = '{}_{}'.format(self.__schema_name__, self._get_pk_val())
         cache.delete(cache_key)
+        OBJECT_XML_CACHE.invalidate(self)
+        # the serializations of the objects containing this object and the
+        # metadata XML of the resources containing it may have changed
+        _invalidate_containers(_get_containers(self, new=_adding))
 
 
     def delete_deep(self, keep_stats=False):
@@ -1378,3 +1495,156 @@ class SubclassableModel(SchemaModel):
 
     class Meta:
         abstract = True
+
+
+# the relations through which the instances of each metadata model may be
+# contained in other metadata objects, see _get_container_relations()
+_CONTAINER_RELATIONS = {}
+
+# the maximum number of ids in a single database lookup of containers
+_CONTAINER_LOOKUP_SIZE = 500
+
+
+def _get_container_relations(model):
+    """
+    Returns the relations through which instances of the given metadata model
+    may be contained in other metadata objects, as a list of triples of the
+    containing model, the name of the relating field and a flag which is True
+    if the field is a "back_to_" foreign key of the given model instead of a
+    field of the containing model.
+    """
+    if not model in _CONTAINER_RELATIONS:
+        _relations = [(_field.rel.to, _field.name, True)
+                      for _field in model._meta.fields
+                      if _field.name.startswith('back_to_')]
+        for _rel in model._meta.get_all_related_objects() \
+                + model._meta.get_all_related_many_to_many_objects():
+            # the reverse relations of "back_to_" foreign keys lead to
+            # contained objects
+            if issubclass(_rel.model, SchemaModel) \
+                    and not _rel.field.name.startswith('back_to_'):
+                _relations.append((_rel.model, _rel.field.name, False))
+        _CONTAINER_RELATIONS[model] = _relations
+    return _CONTAINER_RELATIONS[model]
+
+
+def _get_containers(obj, new=False):
+    """
+    Returns the metadata objects which contain the given metadata object,
+    i.e., the objects which are reached by following the containing objects
+    upwards up to the resources, including the given object itself, as a
+    dictionary which maps the concrete models to the sets of the ids of their
+    instances.
+
+    new (optional): if True, the object has just been created, so only its own
+        "back_to_" foreign keys may refer to containing objects
+    """
+    from metashare.repository.models import resourceInfoType_model
+    _model = obj._meta.concrete_model
+    if new and not issubclass(_model, resourceInfoType_model):
+        visited = {_model: set([obj.pk])}
+        pending = {}
+        for _container, _name, _is_forward in _get_container_relations(_model):
+            _pk = _is_forward and getattr(obj,
+                _model._meta.get_field(_name).attname)
+            if _pk:
+                pending.setdefault(_container, set()).add(_pk)
+    else:
+        visited = {}
+        pending = {_model: set([obj.pk])}
+    # the containers are looked up level by level for all objects of a model
+    while pending:
+        _model, _pks = pending.popitem()
+        _pks = list(_pks - visited.setdefault(_model, set()))
+        if not _pks:
+            continue
+        visited[_model].update(_pks)
+        if issubclass(_model, resourceInfoType_model):
+            continue
+        for _container, _name, _is_forward in _get_container_relations(_model):
+            _found = pending.setdefault(_container, set())
+            for i in range(0, len(_pks), _CONTAINER_LOOKUP_SIZE):
+                _chunk = _pks[i:i + _CONTAINER_LOOKUP_SIZE]
+                if _is_forward:
+                    _found.update(_model.objects.filter(pk__in=_chunk,
+                          **{'{0}__isnull'.format(_name): False})
+                        .values_list(_name, flat=True))
+                else:
+                    _found.update(_container.objects.filter(
+                          **{'{0}__in'.format(_name): _chunk})
+                        .values_list('pk', flat=True))
+            if not _found:
+                del pending[_container]
+    return visited
+
+
+def _invalidate_containers(containers):
+    """
+    Discards the cached serializations and the content hashes of the given
+    metadata objects, as returned by _get_containers(), and marks the
+    metadata XML of the resources among them as possibly outdated.
+    """
+    from metashare.repository.models import resourceInfoType_model
+    for _model, _pks in containers.iteritems():
+        _pks = list(_pks)
+        for _pk in _pks:
+            OBJECT_XML_CACHE.invalidate(_model(pk=_pk))
+        for i in range(0, len(_pks), _CONTAINER_LOOKUP_SIZE):
+            _chunk = _pks[i:i + _CONTAINER_LOOKUP_SIZE]
+            _model.objects.filter(pk__in=_chunk, content_hash__isnull=False) \
+                .update(content_hash=None)
+            if issubclass(_model, resourceInfoType_model):
+                mark_metadata_dirty(StorageObject.objects.filter(
+                  resourceinfotype_model__in=_chunk))
+
+
+@receiver(pre_delete)
+def _find_deleted_metadata_containers(sender, instance, **kwargs):
+    """
+    Remembers the objects containing a metadata object which is about to be
+    deleted, as they can no longer be found after the deletion.
+    """
+    if isinstance(instance, SchemaModel):
+        instance._containers = _get_containers(instance)
+
+
+@receiver(post_delete)
+def _track_metadata_deletion(sender, instance, **kwargs):
+    """
+    Discards the cached serializations and content hashes of a metadata
+    object and of all objects containing it and marks the metadata XML of the
+    resources containing it as outdated whenever the object is deleted,
+    including deletions by cascade or on querysets.
+    """
+    if isinstance(instance, SchemaModel):
+        OBJECT_XML_CACHE.invalidate(instance)
+        _invalidate_containers(getattr(instance, '_containers', {}))
+
+
+@receiver(m2m_changed)
+def _track_metadata_relation_change(sender, instance, action, **kwargs):
+    """
+    Discards the cached serializations and content hashes of the objects
+    whose many-to-many relations are changed and of all objects containing
+    them and marks the metadata XML of the resources containing them as
+    outdated.
+    """
+    if not isinstance(instance, SchemaModel):
+        return
+    if action == 'pre_clear' and kwargs.get('reverse'):
+        # the objects on the other side can no longer be found afterwards
+        instance._containers = _get_containers(instance)
+    if not action.startswith('post_'):
+        return
+    if not kwargs.get('reverse'):
+        _invalidate_containers(_get_containers(instance))
+    elif action == 'post_clear':
+        _invalidate_containers(getattr(instance, '_containers', {}))
+    else:
+        # the relation has been changed from the other side
+        _containers = {}
+        for _pk in kwargs.get('pk_set') or ():
+            for _model, _pks in _get_containers(
+                    kwargs['model'](pk=_pk)).iteritems():
+                _containers.setdefault(_model, set()).update(_pks)
+        _invalidate_containers(_containers)
@@ -1,5 +1,10 @@
+import json
 import os
 import logging
+import shutil
+import tempfile
+from hashlib import md5
+from zipfile import ZipFile
 
 from django.contrib.auth.models import User
 from django.test import TestCase
@@ -8,8 +13,11 @@ from django.test.client import Client
 from metashare import test_utils
 from metashare.accounts.models import EditorGroup
 from metashare.repository.models import documentUnstructuredString_model, \
-    documentInfoType_model
+    documentInfoType_model, personInfoType_model, resourceInfoType_model
 from metashare.settings import DJANGO_BASE, ROOT_PATH, LOG_HANDLER
+from metashare.storage.models import StorageObject, PUBLISHED, MASTER
+from metashare import xml_utils
+from metashare.xml_utils import bulk_import_from_files, bulk_export_to_archive
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -92,6 +100,120 @@ class ImportTest(TestCase):
         self.assertEqual(1, len(failures), 'Could not import file {} -- successes is {}, failures is {}'.format(_currfile, successes, failures))
         self.assertEquals('broken.xml', failures[0][0])
 
+    def test_bulk_import(self):
+        _files = ['{}/repository/fixtures/{}'.format(ROOT_PATH, _name)
+                  for _name in ('tworesources.zip', 'onegood_onebroken.zip',
+                                'broken.xml', 'testfixture.xml')]
+        successes, failures = bulk_import_from_files(_files, PUBLISHED, MASTER,
+                                                     workers=1, chunk_size=2)
+        self.assertEqual(4, len(successes))
+        self.assertEqual(['{}:broken.xml'.format(_files[1]), _files[2]],
+                         [_descriptor for _descriptor, _ in failures])
+        for resource in successes:
+            storage_object = StorageObject.objects.get(
+                pk=resource.storage_object_id)
+            self.assertEqual(PUBLISHED, storage_object.publication_status)
+            # the metadata has been serialized in the final phase
+            self.assertIn('<resourceInfo', storage_object.metadata)
+            self.assertTrue(os.path.isfile(
+                storage_object._digest_archive_path()))
+
+    def test_bulk_import_storage_failure(self):
+        _files = ['{}/repository/fixtures/{}'.format(ROOT_PATH, _name)
+                  for _name in ('tworesources.zip', 'testfixture.xml')]
+        _update_imported_storage = xml_utils._update_imported_storage
+        def _fail_for_fixture(storage_object, dry_run):
+            # the resource of the XML file is imported last
+            if storage_object.pk == \
+                    StorageObject.objects.order_by('-pk')[0].pk:
+                raise Exception('no space left on device')
+            return _update_imported_storage(storage_object, dry_run)
+        xml_utils._update_imported_storage = _fail_for_fixture
+        try:
+            successes, failures = bulk_import_from_files(_files, PUBLISHED,
+                MASTER, workers=1, chunk_size=2)
+        finally:
+            xml_utils._update_imported_storage = _update_imported_storage
+        # the resource which could not be serialized is reported as erroneous
+        self.assertEqual(2, len(successes))
+        self.assertEqual([_files[1]],
+                         [_descriptor for _descriptor, _ in failures])
+
+    def test_bulk_export(self):
+        resources = bulk_import_from_files(
+            ['{}/repository/fixtures/tworesources.zip'.format(ROOT_PATH)],
+            PUBLISHED, MASTER, workers=1)[0]
+        _folder = tempfile.mkdtemp()
+        try:
+            _archive = os.path.join(_folder, 'full.zip')
+            _manifest = os.path.join(_folder, 'full.json')
+            self.assertEqual((2, []), bulk_export_to_archive(_archive,
+                workers=1, chunk_size=1, manifest_filename=_manifest))
+            with open(_manifest) as _file:
+                _entries = json.load(_file)['resources']
+            for resource in resources:
+                storage_object = StorageObject.objects.get(
+                    pk=resource.storage_object_id)
+                _entry = _entries[storage_object.identifier]
+                self.assertEqual(storage_object.digest_checksum,
+                                 _entry['digest_checksum'])
+                with ZipFile(_archive) as _zip:
+                    self.assertEqual(_entry['md5'],
+                        md5(_zip.read(_entry['file'])).hexdigest())
+
+            # nothing has changed since the full export
+            _archive = os.path.join(_folder, 'incremental.zip')
+            self.assertEqual((0, []), bulk_export_to_archive(_archive,
+                workers=1, previous_manifest=_manifest))
+            # only the changed resource is exported, with its stored XML
+            StorageObject.objects.filter(pk=resources[0].storage_object_id) \
+                .update(digest_checksum='changed')
+            self.assertEqual((1, []), bulk_export_to_archive(_archive,
+                workers=1, manifest_filename=_manifest,
+                previous_manifest=_manifest, use_stored_metadata=True))
+            storage_object = StorageObject.objects.get(
+                pk=resources[0].storage_object_id)
+            with ZipFile(_archive) as _zip:
+                self.assertEqual([u'resource-{0}.xml'.format(
+                    storage_object.identifier)], _zip.namelist())
+                self.assertEqual(storage_object.metadata, _zip.read(
+                    _zip.namelist()[0]).decode('utf-8'))
+            with open(_manifest) as _file:
+                _entries = json.load(_file)['resources']
+            self.assertEqual(2, len(_entries))
+            self.assertEqual('incremental.zip',
+                             _entries[storage_object.identifier]['archive'])
+        finally:
+            shutil.rmtree(_folder)
+
+    def test_duplicate_detection(self):
+        _currfile = '{}/repository/fixtures/testfixture.xml'.format(ROOT_PATH)
+        test_utils.import_xml_or_zip(_currfile)
+        _person_count = personInfoType_model.objects.count()
+        self.assertTrue(_person_count > 0)
+        test_utils.import_xml_or_zip(_currfile)
+        # the persons of the second import are duplicates of the existing ones
+        self.assertEqual(1, resourceInfoType_model.objects.count())
+        self.assertEqual(_person_count, personInfoType_model.objects.count())
+        # the content hashes of the compared persons have been stored
+        _person = personInfoType_model.objects.all()[0]
+        self.assertEqual(40, len(_person.content_hash))
+        self.assertEqual(1, personInfoType_model.objects.filter(
+            content_hash=_person.content_hash).count())
+        # saving an object invalidates its content hash
+        _person.save()
+        self.assertIsNone(personInfoType_model.objects.get(pk=_person.pk)
+                          .content_hash)
+        # so does changing any of its contained objects or relations
+        _person.update_content_hash()
+        _person.communicationInfo.save()
+        self.assertIsNone(personInfoType_model.objects.get(pk=_person.pk)
+                          .content_hash)
+        _person.update_content_hash()
+        _person.affiliation.clear()
+        self.assertIsNone(personInfoType_model.objects.get(pk=_person.pk)
+                          .content_hash)
+
     def test_import_bug_1(self):
         """
         This constellation caused an import error with a Postgres DB backend.
@@ -10,7 +10,11 @@ from xml.etree.ElementTree import fromstring, register_namespace
 from metashare import test_utils
 from metashare.repository.models import resourceInfoType_model, \
     SCHEMA_NAMESPACE, lingualityInfoType_model
+from metashare.repository.metadata_access import ELEMENT_TREE_CACHE, \
+    get_metadata_elementtree, get_metadata_xml, is_metadata_dirty
 from metashare.repository.model_utils import get_root_resources
+from metashare.repository.object_cache import ObjectXMLCache
+from metashare.repository.supermodel import OBJECT_XML_CACHE
 from metashare.settings import ROOT_PATH, LOG_HANDLER
 from metashare.xml_utils import to_xml_string
 
@@ -225,3 +229,156 @@ class ModelUtilsTest(TestCase):
                 + list(self.test_res_2.contactPerson.all())
                 + [self.test_res_1.identificationInfo,
                    self.test_res_2.identificationInfo])))
+
+
+class ObjectXMLCacheTest(TestCase):
+    """
+    Tests the cache of the serializations of metadata objects.
+    """
+    @classmethod
+    def setUpClass(cls):
+        LOGGER.info("running '{}' tests...".format(cls.__name__))
+        test_utils.set_index_active(False)
+
+    @classmethod
+    def tearDownClass(cls):
+        test_utils.set_index_active(True)
+        LOGGER.info("finished '{}' tests".format(cls.__name__))
+
+    def tearDown(self):
+        """
+        Cleans the database after a test.
+        """
+        test_utils.clean_resources_db()
+        test_utils.clean_storage()
+
+    def test_lru(self):
+        _cache = ObjectXMLCache(2, 60)
+        _objects = [lingualityInfoType_model(pk=_pk) for _pk in range(3)]
+        for _obj in _objects:
+            _cache.set(_obj, u'<x>{0}</x>'.format(_obj.pk))
+        # the least recently used object has been evicted
+        self.assertIsNone(_cache.get(_objects[0]))
+        self.assertEqual(u'<x>1</x>', _cache.get(_objects[1]))
+        _cache.set(_objects[0], u'<x>0</x>')
+        self.assertIsNone(_cache.get(_objects[2]))
+        self.assertEqual(u'<x>1</x>', _cache.get(_objects[1]))
+        _cache.invalidate(_objects[1])
+        self.assertIsNone(_cache.get(_objects[1]))
+        self.assertEqual({'hits': 2, 'misses': 3, 'entries': 1, 'size': 8},
+                         _cache.get_stats())
+        # expired entries are discarded
+        _cache = ObjectXMLCache(2, -1)
+        _cache.set(_objects[0], u'<x>0</x>')
+        self.assertIsNone(_cache.get(_objects[0]))
+
+    def test_shared_backend(self):
+        _cache = ObjectXMLCache(2, 60, 'default')
+        _other_cache = ObjectXMLCache(2, 60, 'default')
+        _obj = lingualityInfoType_model(pk=1)
+        _cache.set(_obj, u'<x/>')
+        self.assertEqual(u'<x/>', _other_cache.get(_obj))
+        _other_cache.invalidate(_obj)
+        self.assertIsNone(_cache.get(_obj))
+
+    def test_invalidation(self):
+        test_utils.setup_test_storage()
+        resource = test_utils.import_xml(
+            '{0}/repository/fixtures/testfixture.xml'.format(ROOT_PATH))
+        _xml = resource.get_canonical_xml()
+        self.assertEqual(_xml, OBJECT_XML_CACHE.get(resource))
+        resource.save()
+        self.assertIsNone(OBJECT_XML_CACHE.get(resource))
+        # changed relations discard the serialization, too
+        resource.get_canonical_xml()
+        resource.contactPerson.remove(resource.contactPerson.all()[0])
+        self.assertIsNone(OBJECT_XML_CACHE.get(resource))
+        self.assertNotEqual(_xml, resource.get_canonical_xml())
+
+
+class MetadataAccessTest(TestCase):
+    """
+    Tests the read access to the stored metadata XML of resources.
+    """
+    @classmethod
+    def setUpClass(cls):
+        LOGGER.info("running '{}' tests...".format(cls.__name__))
+        test_utils.set_index_active(False)
+
+    @classmethod
+    def tearDownClass(cls):
+        test_utils.set_index_active(True)
+        LOGGER.info("finished '{}' tests".format(cls.__name__))
+
+    def setUp(self):
+        test_utils.setup_test_storage()
+        ELEMENT_TREE_CACHE.clear()
+        self.resource = test_utils.import_xml_or_zip(
+            '{0}/repository/fixtures/testfixture.xml'.format(ROOT_PATH))[0][0]
+
+    def tearDown(self):
+        """
+        Cleans the database after a test.
+        """
+        test_utils.clean_resources_db()
+        test_utils.clean_storage()
+
+    @staticmethod
+    def _get_elements(element_tree):
+        return [(_element.tag, _element.get('pretty'), _element.text or u'')
+                for _element in element_tree.iter() if _element.tag != 'groups']
+
+    def test_stored_metadata(self):
+        storage_object = self.resource.storage_object
+        self.assertFalse(is_metadata_dirty(storage_object))
+        self.assertEqual(storage_object.metadata,
+                         get_metadata_xml(self.resource))
+        for _pretty in (False, True):
+            self.assertEqual(self._get_elements(
+                    self.resource.export_to_elementtree(pretty=_pretty)),
+                self._get_elements(
+                    get_metadata_elementtree(self.resource, pretty=_pretty)))
+        # changing a returned tree does not change the cached one
+        _tree = get_metadata_elementtree(self.resource)
+        _tree.remove(_tree[0])
+        self.assertNotEqual(self._get_elements(_tree), self._get_elements(
+            get_metadata_elementtree(self.resource)))
+
+    def test_pretty_names_of_fixtures(self):
+        """
+        Tests that the pretty names which are added to the stored metadata XML
+        are the ones of a pretty export for resources of all types.
+        """
+        for _name in ('fixtures/full-resources/full-lang-description.xml',
+                      'fixtures/full-resources/full-lex-conceptual.xml',
+                      'fixtures/full-resources/full-tool-service.xml',
+                      'fixtures/ILSP10.xml', 'fixtures/roundtrip.xml',
+                      'fixtures/downloadable_3_licenses.xml',
+                      'test_fixtures/published-corpus-text-English.xml'):
+            resource = test_utils.import_xml_or_zip(
+                '{0}/repository/{1}'.format(ROOT_PATH, _name))[0][0]
+            resource = resourceInfoType_model.objects.get(pk=resource.pk)
+            self.assertFalse(is_metadata_dirty(resource.storage_object))
+            self.assertEqual(
+                self._get_elements(resource.export_to_elementtree(pretty=True)),
+                self._get_elements(
+                    get_metadata_elementtree(resource, pretty=True)),
+                'The pretty names of {0} differ'.format(_name))
+
+    def test_dirty_metadata(self):
+        _name = self.resource.identificationInfo.resourceName
+        _name['en'] = u'Changed resource name'
+        self.resource.identificationInfo.save()
+        # the stored metadata XML is outdated until the next storage update
+        self.resource = resourceInfoType_model.objects.get(pk=self.resource.pk)
+        self.assertTrue(is_metadata_dirty(self.resource.storage_object))
+        self.assertIn(u'Changed resource name',
+                      get_metadata_xml(self.resource))
+        for _pretty in (False, True):
+            self.assertIn(u'Changed resource name', [_element.text
+                for _element in get_metadata_elementtree(self.resource,
+                    pretty=_pretty).iter('resourceName')])
+        self.resource.storage_object.update_storage()
+        self.assertFalse(is_metadata_dirty(self.resource.storage_object))
+        self.assertEqual(self.resource.storage_object.metadata,
+                         get_metadata_xml(self.resource))
@@ -91,10 +91,9 @@ class PersistenceTest(TestCase):
             _storage_object._storage_folder())))
         # ingested resource has digest zip in storage folder
         self.assertTrue(
-          os.path.isfile('{0}/resource.zip'.format(
-            _storage_object._storage_folder())))
+          os.path.isfile(_storage_object.get_digest_archive()))
         # digest zip contains metadata.xml and storage-global.json
-        _zf_name = '{0}/resource.zip'.format( _storage_object._storage_folder())
+        _zf_name = _storage_object.get_digest_archive()
         _zf = zipfile.ZipFile(_zf_name, mode='r')
         self.assertTrue('metadata.xml' in _zf.namelist())
         self.assertTrue('storage-global.json' in _zf.namelist())
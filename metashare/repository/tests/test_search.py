@@ -1,16 +1,26 @@
 import os
 import logging
+import time
 
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.test.client import Client
+from django.db import connection
+from django.test.client import Client, RequestFactory
 from django.test.testcases import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from haystack.management.commands import clear_index
 from haystack.query import SearchQuerySet
 
 from metashare import test_utils, settings
-from metashare.repository import views
+from metashare.accounts.models import Organization
+from metashare.repository import search_indexes, views
+from metashare.repository.index_queue import IndexUpdateQueue
+from metashare.repository.search_facets import get_facet_registry
+from metashare.repository.models import resourceInfoType_model
+from metashare.repository.search_indexes import resourceInfoType_modelIndex, \
+    RESOURCE_SELECT_RELATED, get_group_filter_query
 from metashare.settings import DJANGO_BASE, ROOT_PATH, LOG_HANDLER
 from metashare.stats.models import LRStats
 from metashare.storage.models import INGESTED, PUBLISHED
@@ -47,11 +57,15 @@ class SearchIndexUpdateTests(test_utils.IndexAwareTestCase):
         test_utils.setup_test_storage()
         clear_index.Command().handle(using=[settings.TEST_MODE_NAME,],
                                      interactive=False)
+        self.queue = None
         
     def tearDown(self):
         """
         Clean up the test
         """
+        if self.queue:
+            # stop the background worker of a test queue
+            self.queue.stop()
         test_utils.clean_resources_db()
         test_utils.clean_storage()
         
@@ -128,6 +142,52 @@ class SearchIndexUpdateTests(test_utils.IndexAwareTestCase):
         self.assertEqual(SearchQuerySet().count(), 0,
             "After a resource is deleted, the index must automatically change.")
 
+    def test_queued_index_updates(self):
+        """
+        Verifies that queued index updates are coalesced per resource and sent
+        to the search backend when the queue is flushed.
+        """
+        resource = self.init_index_with_a_resource()
+        clear_index.Command().handle(using=[settings.TEST_MODE_NAME,],
+                                     interactive=False)
+        self.assert_index_is_empty()
+        _interval = settings.SEARCH_INDEX_QUEUE_FLUSH_INTERVAL
+        # make sure that the background worker does not get in our way
+        settings.SEARCH_INDEX_QUEUE_FLUSH_INTERVAL = 3600
+        try:
+            self.queue = queue = IndexUpdateQueue()
+            queue.add(resource.id)
+            queue.add(resource.id)
+            self.assertEqual(set([resource.id]), queue._pending)
+            self.assert_index_is_empty()
+            queue.flush()
+        finally:
+            settings.SEARCH_INDEX_QUEUE_FLUSH_INTERVAL = _interval
+        self.assertEqual(set(), queue._pending)
+        self.assertEqual(SearchQuerySet().count(), 1,
+            "After flushing the queue, the index must contain the resource.")
+
+    def test_index_document_query_count(self):
+        """
+        Benchmarks the number of database queries which are required for
+        preparing the search index document of a resource.
+        """
+        resource = test_utils.import_xml(SearchIndexUpdateTests.RES_PATH_2)
+        index = resourceInfoType_modelIndex()
+        expected = index.full_prepare(
+            resourceInfoType_model.objects.get(pk=resource.id))
+        resource = resourceInfoType_model.objects \
+            .select_related(*RESOURCE_SELECT_RELATED).get(pk=resource.id)
+        with CaptureQueriesContext(connection) as queries:
+            prepared = index.full_prepare(resource)
+        LOGGER.info('Preparing the search index document of {0} required {1} '
+                    'queries.'.format(resource, len(queries.captured_queries)))
+        self.assertEqual(expected, prepared)
+        # 47 queries were required before the index data was shared between
+        # the prepare_* methods
+        self.assertLessEqual(len(queries.captured_queries), 25)
+        self.assertFalse(hasattr(resource, '_index_data'))
+
     def assert_index_is_empty(self):
         """
         Asserts that the search index is empty.
@@ -157,6 +217,133 @@ class SearchIndexUpdateTests(test_utils.IndexAwareTestCase):
           "have changed and contain that resource.")
         return resource
 
+
+class SearchGroupFilterTests(TestCase):
+    """
+    Tests the restriction of the search results to the resources which are
+    shared with the groups of a user.
+    """
+    @classmethod
+    def setUpClass(cls):
+        LOGGER.info("running '{}' tests...".format(cls.__name__))
+
+    @classmethod
+    def tearDownClass(cls):
+        LOGGER.info("finished '{}' tests".format(cls.__name__))
+
+    def setUp(self):
+        test_utils.setup_test_storage()
+        self.organization = Organization.objects.create(name='test_org')
+        self.user = create_user('normaluser', 'normal@example.com', 'secret')
+        self.user.save()
+        cache.clear()
+
+    def tearDown(self):
+        test_utils.clean_resources_db()
+        test_utils.clean_storage()
+        test_utils.clean_user_db()
+
+    def test_groups_filter_is_indexed(self):
+        """
+        Verifies that the ids of the sharing groups of a resource are indexed.
+        """
+        resource = test_utils.import_xml(SearchIndexUpdateTests.RES_PATH_1)
+        index = resourceInfoType_modelIndex()
+        self.assertEqual([],
+                         index.full_prepare(resource).get('sharingGroups'))
+        resource.groups.add(self.organization)
+        self.assertEqual([self.organization.pk],
+                         index.full_prepare(resource)['sharingGroups'])
+
+    def test_group_changes_are_not_queued(self):
+        """
+        Verifies that the index entry of a resource is updated right away when
+        its sharing groups change, even if index updates are queued.
+        """
+        resource = test_utils.import_xml(SearchIndexUpdateTests.RES_PATH_1)
+        _updated = []
+        _update = search_indexes.update_lr_index_entries
+        _queue_enabled = settings.SEARCH_INDEX_QUEUE_ENABLED
+        search_indexes.update_lr_index_entries = _updated.append
+        settings.SEARCH_INDEX_QUEUE_ENABLED = True
+        try:
+            resource.groups.add(self.organization)
+            self.organization.resourceinfotype_model_set.clear()
+        finally:
+            search_indexes.update_lr_index_entries = _update
+            settings.SEARCH_INDEX_QUEUE_ENABLED = _queue_enabled
+        self.assertEqual([[resource.id], [resource.id]], _updated)
+
+    def test_group_filter_query_follows_group_membership(self):
+        """
+        Verifies that the cached filter query of a user is discarded when the
+        group membership of the user changes.
+        """
+        self.assertIsNone(get_group_filter_query(self.user))
+        self.user.groups.add(self.organization)
+        query = get_group_filter_query(self.user)
+        self.assertIn('sharingGroups:({0})'.format(self.organization.pk), query)
+        self.assertIn('publicationStatusFilter_exact:published', query)
+        self.organization.user_set.clear()
+        self.assertIsNone(get_group_filter_query(self.user))
+        self.organization.user_set.add(self.user)
+        self.assertEqual(query, get_group_filter_query(self.user))
+        self.organization.delete()
+        self.assertIsNone(get_group_filter_query(self.user))
+
+
+class SearchFacetsTests(TestCase):
+    """
+    Tests the creation of the filters/facets structure of the search sidebar.
+    """
+    @classmethod
+    def setUpClass(cls):
+        LOGGER.info("running '{}' tests...".format(cls.__name__))
+
+    @classmethod
+    def tearDownClass(cls):
+        LOGGER.info("finished '{}' tests".format(cls.__name__))
+
+    def test_filters_structure_with_many_selected_facets(self):
+        """
+        Benchmarks the creation of the filters structure of a search with
+        many selected facets and verifies the targets of the facet values.
+        """
+        values = [u'text', u'audio', u'corpus', u'toolService', u'a&b'] \
+            + [u'value{0}'.format(i) for i in range(50)]
+        facets = get_facet_registry().facets
+        facet_fields = dict((facet.name, [(value, 1) for value in values])
+                            for facet in facets)
+        selected = [u'{0}:{1}'.format(facet.name_exact, value)
+                    for facet in facets for value in values[:2]]
+        view = views.MetashareFacetedSearchView()
+        view.request = RequestFactory().get(_SEARCH_PAGE_PATH,
+            {'q': 'test', 'selected_facets': selected})
+        start = time.time()
+        for _ in range(10):
+            filters = view._create_filters_structure(facet_fields)
+        LOGGER.info('Creating the filters structure with {0} selected facets '
+                    'took {1:.4f} seconds.'.format(len(selected),
+                                                   (time.time() - start) / 10))
+
+        languages = filters[0]
+        self.assertEqual(get_facet_registry().top_level_facets[0].label,
+                         languages['label'])
+        self.assertEqual([u'Text', u'Audio'],
+                         [item['label'] for item in languages['removable']])
+        self.assertEqual(u'Tool Service',
+                         languages['addable'][1]['label'])
+        # an addable value adds itself to all selected facets
+        target = languages['addable'][2]['target_query']
+        self.assertEqual(len(selected) + 1, target.count('&selected_facets='))
+        self.assertTrue(target.endswith(
+            u'&selected_facets=languageNameFilter_exact%3Aa%26b'))
+        # a removable value removes itself from the selected facets
+        target = languages['removable'][0]['target_query']
+        self.assertEqual(len(selected) - 1, target.count('&selected_facets='))
+        self.assertNotIn(u'languageNameFilter_exact%3Atext&', target + '&')
+
+
 class SearchTest(test_utils.IndexAwareTestCase):
     """
     Test the search functionality
@@ -2,13 +2,16 @@ import shutil
 import logging
 from datetime import datetime
 
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Permission, User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.humanize.templatetags import humanize
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.template.defaultfilters import urlizetrunc
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.utils.encoding import smart_str
 from django.utils.formats import date_format
 
@@ -22,6 +25,7 @@ from metashare.repository.models import resourceInfoType_model
 from metashare.repository.supermodel import OBJECT_XML_CACHE
 from metashare.settings import DJANGO_BASE, ROOT_PATH, LOG_HANDLER, \
     TEST_MODE_NAME
+from metashare.storage.models import PUBLISHED
 from metashare.repository.templatetags import mimetype_label
 from metashare.test_utils import create_user
 from metashare.utils import prettify_camel_case_string
@@ -233,6 +237,47 @@ class ViewTest(TestCase):
         self.assertTemplateUsed(response, 'repository/resource_view/lr_view.html')
         self.assertNotContains(response, '</i> Edit Resource</button>')
 
+    def test_view_context_is_cached_per_revision(self):
+        """
+        Tests whether the user independent part of the single resource view
+        is cached until the revision of the resource changes
+        """
+        cache.clear()
+        self.resource.storage_object.publication_status = PUBLISHED
+        self.resource.storage_object.save()
+        self.resource.storage_object.update_storage()
+        User.objects.create_superuser('superuser', 'super@example.com',
+                                      'secret')
+        client = Client()
+        client.login(username='superuser', password='secret')
+        response = client.get(self.resource.get_absolute_url(), follow = True)
+        self.assertContains(response, reverse(
+            'admin:repository_resourceinfotype_model_change',
+            args=(self.resource.id,)))
+        # the cached context must not contain any user specific parts
+        with CaptureQueriesContext(connection) as queries:
+            context = views._get_resource_view_context(self.resource)
+        self.assertEqual(0, len(queries.captured_queries))
+        self.assertNotIn('LR_EDIT', context)
+        self.assertEqual('Italian TTS Speech Corpus (Appen)',
+                         context['resourceName'])
+        self.assertIs(self.resource, context['resource'])
+        # a new revision of the resource must not use the cached context
+        self.resource.storage_object.revision += 1
+        with CaptureQueriesContext(connection) as queries:
+            views._get_resource_view_context(self.resource)
+        self.assertNotEqual(0, len(queries.captured_queries))
+        # neither must a resource which has been edited since the last
+        # storage update
+        self.resource.storage_object.revision -= 1
+        _name = self.resource.identificationInfo.resourceName
+        _name['en'] = u'Changed resource name'
+        self.resource.identificationInfo.save()
+        self.resource = resourceInfoType_model.objects.get(
+            pk=self.resource.pk)
+        self.assertEqual(u'Changed resource name',
+            views._get_resource_view_context(self.resource)['resourceName'])
+
     def testPageTitle(self):
         """
         Tests whether the title inside the header of the web page 
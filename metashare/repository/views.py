@@ -5,15 +5,16 @@ import os
 import shutil
 import uuid
 import zipfile
-import re
 import pdb
-from unidecode import unidecode
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from haystack.query import SearchQuerySet
 from metashare.report_utils.report_utils import _is_processed, _is_not_processed_or_related, _get_country, \
     _get_resource_mimetypes, _get_resource_linguality, _get_resource_lang_info, _get_resource_sizes, \
     _get_resource_lang_sizes, _get_preferred_size, _get_resource_domain_info
 from metashare.repository.export_utils import xml_to_json
+from metashare.repository.metadata_access import get_metadata_elementtree, \
+    is_metadata_dirty
 from metashare.repository.templatetags.is_member import is_member
 from django.http import JsonResponse
 from collections import OrderedDict
@@ -52,9 +53,10 @@ from haystack.views import FacetedSearchView
 
 from metashare.accounts.models import UserProfile, Organization, OrganizationManagers
 from metashare.local_settings import CONTRIBUTIONS_ALERT_EMAILS, TMP, SUPPORTED_LANGUAGES, EMAIL_ADDRESSES, COUNTRY, STATIC_ROOT, MAXIMUM_UPLOAD_SIZE_CONTRIBUTE
+from metashare.recommendations.models import ResourceRelationKey
 from metashare.recommendations.recommendations import SessionResourcesTracker, \
     get_download_recommendations, get_view_recommendations, \
-    get_more_from_same_creators_qs, get_more_from_same_projects_qs
+    get_resource_relation_kinds
 from metashare.repository import model_utils
 from metashare.repository.editor.resource_editor import has_edit_permission, _get_licences, _get_user_membership, MEMBER_TYPES, LICENCEINFOTYPE_URLS_LICENCE_CHOICES
 from metashare.repository.forms import LicenseSelectionForm, \
@@ -67,10 +69,12 @@ from metashare.repository.models import resourceInfoType_model, identificationIn
     languageDescriptionInfoType_model, lexicalConceptualResourceTextInfoType_model, \
     lexicalConceptualResourceMediaTypeType_model, lexicalConceptualResourceInfoType_model, distributionInfoType_model, \
     licenceInfoType_model, resourceCreationInfoType_model, projectInfoType_model
-from metashare.repository.search_indexes import resourceInfoType_modelIndex, \
-    update_lr_index_entry
+from metashare.repository.search_facets import get_facet_registry, \
+    get_facet_value_label, SelectedFacets
+from metashare.repository.search_indexes import update_lr_index_entry, \
+    get_group_filter_query
 from metashare.settings import LOG_HANDLER, STATIC_URL, DJANGO_URL, MAXIMUM_UPLOAD_SIZE, CONTRIBUTION_FORM_DATA, \
-    ROOT_PATH, LANGUAGE_CODE
+    ROOT_PATH, LANGUAGE_CODE, RESOURCE_VIEW_CACHE_TIMEOUT
 from metashare.stats.model_utils import getLRStats, saveLRStats, \
     saveQueryStats, VIEW_STAT, DOWNLOAD_STAT
 from metashare.storage.models import PUBLISHED, INGESTED
@@ -432,9 +436,81 @@ def view(request, resource_name=None, object_id=None):
     if request.path_info != resource.get_absolute_url():
         return redirect(resource.get_absolute_url())
 
+    context = _get_resource_view_context(resource)
+    template = 'repository/resource_view/lr_view.html'
+
+    # For users who have edit permission for this resource, we have to add
+    # LR_EDIT which contains the URL of the Django admin backend page
+    # for this resource.
+    if has_edit_permission(request, resource):
+        context['LR_EDIT'] = reverse(
+            'admin:repository_resourceinfotype_model_change', \
+            args=(resource.id,))
+        if ((request.user.is_staff or request.user.is_superuser or
+             request.user.groups.filter(name="globaleditors").exists()) and
+            resource.storage_object.publication_status == INGESTED):
+            # only staff can validate INGESTED resources only
+            context['LR_VALIDATE'] = context['LR_EDIT']
+    if has_view_permission(request, resource):
+        context['LR_DOWNLOAD'] = reverse(
+            'editor:repository_resourceinfotype_model_change',
+            args=(resource.id,)) + 'datadl/'
+    # Update statistics:
+    if saveLRStats(resource, VIEW_STAT, request):
+        # update view count in the search index, too
+        update_lr_index_entry(resource)
+    # update view tracker
+    tracker = SessionResourcesTracker.getTracker(request)
+    tracker.add_view(resource, datetime.datetime.now())
+    request.session['tracker'] = tracker
+
+    # Add download/view/last updated statistics to the template context.
+    context['LR_STATS'] = getLRStats(resource.storage_object.identifier)
+
+    # Render and return template with the defined context.
+    ctx = RequestContext(request)
+    # context['processing_info'] = json.loads(json.dumps(dict_xml).replace("@", "").replace("#", ""))
+    return render_to_response(template,
+                              context, context_instance=ctx)
+
+
+def _get_resource_view_context(resource):
+    """
+    Returns the template context of the single resource view for the given
+    resource without any user or request specific parts.
+
+    Creating this context is expensive, so it is cached for the current
+    revision and digest of the resource and for the current language. As the
+    context also contains recommendations and 'more from same' links which
+    may change without a new revision, the cache entries expire after
+    RESOURCE_VIEW_CACHE_TIMEOUT seconds.  The context of a resource whose
+    metadata has been changed since its last storage update, which creates
+    the next revision, is not cached at all.
+    """
+    storage_object = resource.storage_object
+    if is_metadata_dirty(storage_object):
+        context = _create_resource_view_context(resource)
+        context['resource'] = resource
+        return context
+    cache_key = u'resource-view-{0}-{1}-{2}-{3}'.format(
+        storage_object.identifier, storage_object.revision,
+        storage_object.digest_checksum, translation.get_language())
+    context = cache.get(cache_key)
+    if context is None:
+        context = _create_resource_view_context(resource)
+        cache.set(cache_key, context, RESOURCE_VIEW_CACHE_TIMEOUT)
+    context['resource'] = resource
+    return context
+
+
+def _create_resource_view_context(resource):
+    """
+    Creates the template context of the single resource view for the given
+    resource without any user or request specific parts.
+    """
     # Convert resource to ElementTree and then to template tuples.
     lr_content = _convert_to_template_tuples(
-        resource.export_to_elementtree(pretty=True))
+        get_metadata_elementtree(resource, pretty=True))
 
     # get the 'best' language version of a "DictField" and all other versions
     resource_name = resource.identificationInfo.get_default_resourceName()
@@ -616,7 +692,6 @@ def view(request, resource_name=None, object_id=None):
         'other_descriptions': other_descriptions,
         'relation_dicts': relation_dicts,
         'res_short_names': res_short_names,
-        'resource': resource,
         'resource_component_dicts': resource_component_dicts,
         'resource_component_dict': resource_component_dict,
         'resourceName': resource_name,
@@ -630,57 +705,24 @@ def view(request, resource_name=None, object_id=None):
         'text_counts': text_counts,
         'video_counts': video_counts,
     }
-    template = 'repository/resource_view/lr_view.html'
-
-    # For users who have edit permission for this resource, we have to add
-    # LR_EDIT which contains the URL of the Django admin backend page
-    # for this resource.
-    if has_edit_permission(request, resource):
-        context['LR_EDIT'] = reverse(
-            'admin:repository_resourceinfotype_model_change', \
-            args=(resource.id,))
-        if ((request.user.is_staff or request.user.is_superuser or
-             request.user.groups.filter(name="globaleditors").exists()) and
-            resource.storage_object.publication_status == INGESTED):
-            # only staff can validate INGESTED resources only
-            context['LR_VALIDATE'] = context['LR_EDIT']
-    if has_view_permission(request, resource):
-        context['LR_DOWNLOAD'] = reverse(
-            'editor:repository_resourceinfotype_model_change',
-            args=(resource.id,)) + 'datadl/'
-    # Update statistics:
-    if saveLRStats(resource, VIEW_STAT, request):
-        # update view count in the search index, too
-        update_lr_index_entry(resource)
-    # update view tracker
-    tracker = SessionResourcesTracker.getTracker(request)
-    tracker.add_view(resource, datetime.datetime.now())
-    request.session['tracker'] = tracker
-
-    # Add download/view/last updated statistics to the template context.
-    context['LR_STATS'] = getLRStats(resource.storage_object.identifier)
 
     # Add recommendations for 'also viewed' resources
     context['also_viewed'] = \
-        _format_recommendations(get_view_recommendations(resource))
+        _format_recommendations(get_view_recommendations(resource, 4))
     # Add recommendations for 'also downloaded' resources
     context['also_downloaded'] = \
-        _format_recommendations(get_download_recommendations(resource))
+        _format_recommendations(get_download_recommendations(resource, 4))
     # Add 'more from same' links
-    if get_more_from_same_projects_qs(resource).count():
+    relation_kinds = get_resource_relation_kinds(resource)
+    if ResourceRelationKey.SAME_PROJECTS in relation_kinds:
         context['search_rel_projects'] = '{}/repository/search?q={}:{}'.format(
             DJANGO_URL, MORE_FROM_SAME_PROJECTS,
             resource.storage_object.identifier)
-    if get_more_from_same_creators_qs(resource).count():
+    if ResourceRelationKey.SAME_CREATORS in relation_kinds:
         context['search_rel_creators'] = '{}/repository/search?q={}:{}'.format(
             DJANGO_URL, MORE_FROM_SAME_CREATORS,
             resource.storage_object.identifier)
-
-    # Render and return template with the defined context.
-    ctx = RequestContext(request)
-    # context['processing_info'] = json.loads(json.dumps(dict_xml).replace("@", "").replace("#", ""))
-    return render_to_response(template,
-                              context, context_instance=ctx)
+    return context
 
 
 def tuple2dict(_tuple):
@@ -765,28 +807,11 @@ class MetashareFacetedSearchView(FacetedSearchView):
         sqs = super(MetashareFacetedSearchView, self).get_results()
         if not is_member(self.request.user, 'reviewers') \
                 and not self.request.user.is_superuser:
-            resource_names = []
-            for res in resourceInfoType_model.objects.all():
-                #get resource id
-                id_res = res.storage_object.id
-                res_groups=res.groups.values_list("name", flat=True)
-
-                if self.request.user.groups.filter(
-                    name__in=res.groups.values_list("name", flat=True)).exists():
-                    resname=res.identificationInfo.get_default_resourceName()
-                    ##get resource Name
-                    resourceName=unidecode(resname)
-                    ##keep alphanumeric characters only
-                    resourceName=re.sub('[\W_]', '', resourceName)
-                    ##lowercase
-                    resourceName=resourceName.lower()
-                    ##append resource name to the list,
-                    #concatenate it to its id to resolve the conflicts that
-                    #  can arise from resources sharing the same name but with different group sharing policy
-                    resource_names.append(resourceName+str(id_res))
-            if resource_names:
-                sqs = sqs.filter(publicationStatusFilter__exact='published',
-                                 resourceNameSort__in=resource_names)
+            # only show the published resources which are shared with one of
+            # the groups of the user
+            group_filter_query = get_group_filter_query(self.request.user)
+            if group_filter_query:
+                sqs = sqs.narrow(group_filter_query)
             else:
                 sqs = sqs.none()
 
@@ -854,98 +879,71 @@ class MetashareFacetedSearchView(FacetedSearchView):
         Takes the raw facet 'fields' dictionary which is (indirectly) returned
         by the `facet_counts()` method of a `SearchQuerySet`.
         """
-        import re
-
         result = []
-        # pylint: disable-msg=E1101
-        filter_labels = [(name, field.label, field.facet_id, field.parent_id)
-                         for name, field
-                         in resourceInfoType_modelIndex.fields.iteritems()
-                         if name.endswith("Filter")]
-        filter_labels.sort(key=lambda f: f[2])
-        sel_facets = self._get_selected_facets()
+        top_level_facets = get_facet_registry().top_level_facets
+        sel_facets = SelectedFacets(self._get_selected_facets())
         # Step (1): if there are any selected facets, then add these first:
         if sel_facets:
             # add all top level facets (sorted by their facet IDs):
-            for name, label, facet_id, _dummy in \
-                    [f for f in filter_labels if f[3] == 0]:
-                name_exact = '{0}_exact'.format(name)
+            for facet in top_level_facets:
                 # only add selected facets in step (1)
-                if name_exact in sel_facets:
-                    items = facet_fields.get(name)
+                if facet.name_exact in sel_facets:
+                    items = facet_fields.get(facet.name)
                     if items:
                         removable = []
                         addable = []
                         # only items with a count > 0 are shown
                         for item in [i for i in items if i[1] > 0]:
-                            subfacets = [f for f in filter_labels if (f[3] == \
-                                                                      facet_id and item[0] in f[0])]
-                            subfacets_exactname_list = []
-                            subfacets_exactname_list.extend( \
-                                [u'{0}_exact'.format(subfacet[0]) \
-                                 for subfacet in subfacets])
+                            subfacets = facet.get_value_subfacets(item[0])
                             subresults = []
-                            for facet in subfacets:
-                                subresults = self.show_subfilter( \
-                                    facet, sel_facets, facet_fields, subresults)
-                            if item[0] in sel_facets[name_exact]:
-                                if item[0] != "":
-                                    lab_item = " ".join(re.findall( \
-                                        '[A-Z\_]*[^A-Z]*', \
-                                        item[0][0].capitalize() + item[0][1:]))[:-1]
-                                    removable.append({'label': lab_item,
-                                                      'count': item[1], 'targets':
-                                                          [u'{0}:{1}'.format(name, value)
-                                                           for name, values in
-                                                           sel_facets.iteritems() for value in
-                                                           values if (name != name_exact
-                                                                      or value != item[0]) and name \
-                                                           not in subfacets_exactname_list], \
-                                                      'subresults': subresults})
+                            for subfacet in subfacets:
+                                subresults = self.show_subfilter(
+                                    subfacet, sel_facets, facet_fields,
+                                    subresults)
+                            if item[0] == "":
+                                continue
+                            if sel_facets.is_selected(facet.name_exact,
+                                                      item[0]):
+                                removable.append({
+                                    'label': get_facet_value_label(item[0]),
+                                    'count': item[1],
+                                    'target_query': sel_facets \
+                                        .get_removing_target(facet.name_exact,
+                                            item[0], [subfacet.name_exact
+                                                      for subfacet in subfacets]),
+                                    'subresults': subresults})
                             else:
-                                targets = [u'{0}:{1}'.format(name, value)
-                                           for name, values in
-                                           sel_facets.iteritems()
-                                           for value in values]
-                                targets.append(u'{0}:{1}'.format(name_exact,
-                                                                 item[0]))
-                                if item[0] != "":
-                                    lab_item = " ".join(re.findall( \
-                                        '[A-Z\_]*[^A-Z]*', \
-                                        item[0][0].capitalize() + item[0][1:]))[:-1]
-                                    addable.append({'label': lab_item,
-                                                    'count': item[1],
-                                                    'targets': targets,
-                                                    'subresults': subresults})
-
-                        result.append({'label': label, 'removable': removable,
+                                addable.append({
+                                    'label': get_facet_value_label(item[0]),
+                                    'count': item[1],
+                                    'target_query': sel_facets \
+                                        .get_adding_target(facet.name_exact,
+                                                           item[0]),
+                                    'subresults': subresults})
+
+                        result.append({'label': facet.label,
+                                       'removable': removable,
                                        'addable': addable})
 
-                        # Step (2): add all top level facets without selected facet items at the
+        # Step (2): add all top level facets without selected facet items at the
         # end (sorted by their facet IDs):
-        for name, label, facet_id, _dummy in \
-                [f for f in filter_labels if f[3] == 0]:
-            name_exact = '{0}_exact'.format(name)
+        for facet in top_level_facets:
             # only add facets without selected items in step (2)
-            if not name_exact in sel_facets:
-                items = facet_fields.get(name)
+            if not facet.name_exact in sel_facets:
+                items = facet_fields.get(facet.name)
                 if items:
                     addable = []
                     # only items with a count > 0 are shown
                     for item in [i for i in items if i[1] > 0]:
-                        targets = [u'{0}:{1}'.format(name, value)
-                                   for name, values in sel_facets.iteritems()
-                                   for value in values]
-                        targets.append(u'{0}:{1}'.format(name_exact, item[0]))
-
                         if item[0] != "":
-                            lab_item = " ".join(re.findall('[A-Z\_]*[^A-Z]*',
-                                                           item[0][0].capitalize() + item[0][1:]))[:-1]
-                            addable.append({'label': lab_item, 'count': item[1],
-                                            'targets': targets})
-                    subresults = [f for f in filter_labels if f[3] == facet_id]
-                    result.append({'label': label, 'removable': [],
-                                   'addable': addable, 'subresults': subresults})
+                            addable.append({
+                                'label': get_facet_value_label(item[0]),
+                                'count': item[1],
+                                'target_query': sel_facets.get_adding_target(
+                                    facet.name_exact, item[0])})
+                    result.append({'label': facet.label, 'removable': [],
+                                   'addable': addable,
+                                   'subresults': facet.subfacets})
 
         return result
 
@@ -967,65 +965,33 @@ class MetashareFacetedSearchView(FacetedSearchView):
         """
         Creates a second level for faceting.
         Sub filters are included after the parent filters.
-        """
-        name = facet[0]
-        label = facet[1]
-
-        name_exact = '{0}_exact'.format(name)
-
-        if name_exact in sel_facets:
-            items = facet_fields.get(name)
-            if items:
-                removable = []
-                addable = []
-                # only items with a count > 0 are shown
-                for item in [i for i in items if i[1] > 0]:
-                    if item[0] in sel_facets[name_exact]:
-                        if item[0] != "":
-                            lab_item = " ".join(re.findall('[A-Z\_]*[^A-Z]*',
-                                                           item[0][0].capitalize() + item[0][1:]))[:-1]
-                            removable.append({'label': lab_item,
-                                              'count': item[1], 'targets':
-                                                  [u'{0}:{1}'.format(name, value)
-                                                   for name, values in
-                                                   sel_facets.iteritems() for value in
-                                                   values if name != name_exact
-                                                   or value != item[0]]})
-                    else:
-                        targets = [u'{0}:{1}'.format(name, value)
-                                   for name, values in
-                                   sel_facets.iteritems()
-                                   for value in values]
-                        targets.append(u'{0}:{1}'.format(name_exact,
-                                                         item[0]))
-                        if item[0] != "":
-                            lab_item = " ".join(re.findall('[A-Z\_]*[^A-Z]*',
-                                                           item[0][0].capitalize() + item[0][1:]))[:-1]
-                            addable.append({'label': lab_item,
-                                            'count': item[1],
-                                            'targets': targets})
-                if (addable + removable):
-                    results.append({'label': label, 'removable': removable,
-                                    'addable': addable})
-        else:
-            items = facet_fields.get(name)
-            if items:
-                addable = []
-                # only items with a count > 0 are shown
-                for item in [i for i in items if i[1] > 0]:
-                    targets = [u'{0}:{1}'.format(name, value)
-                               for name, values in sel_facets.iteritems()
-                               for value in values]
-                    targets.append(u'{0}:{1}'.format(name_exact, item[0]))
-                    if item[0] != "":
-                        lab_item = " ".join(re.findall('[A-Z\_]*[^A-Z]*',
-                                                       item[0][0].capitalize() + item[0][1:]))[:-1]
-                        addable.append({'label': lab_item, 'count': item[1],
-                                        'targets': targets})
-                if addable:
-                    results.append({'label': label, 'removable': [],
-                                    'addable': addable})
 
+        `facet` is the sub facet and `sel_facets` are the `SelectedFacets` of
+        the current request.
+        """
+        items = facet_fields.get(facet.name)
+        if not items:
+            return results
+        removable = []
+        addable = []
+        # only items with a count > 0 are shown
+        for item in [i for i in items if i[1] > 0]:
+            if item[0] == "":
+                continue
+            if sel_facets.is_selected(facet.name_exact, item[0]):
+                removable.append({'label': get_facet_value_label(item[0]),
+                                  'count': item[1],
+                                  'target_query': sel_facets \
+                                      .get_removing_target(facet.name_exact,
+                                                           item[0])})
+            else:
+                addable.append({'label': get_facet_value_label(item[0]),
+                                'count': item[1],
+                                'target_query': sel_facets.get_adding_target(
+                                    facet.name_exact, item[0])})
+        if addable or removable:
+            results.append({'label': facet.label, 'removable': removable,
+                            'addable': addable})
         return results
 
 
@@ -82,6 +82,17 @@ STATS_SERVER_URL = "http://metastats.fbk.eu/"
 # The URL for GeoIP database.
 GEOIP_DATA_URL = "http://geolite.maxmind.com/download/geoip/database/GeoLiteCountry/GeoIP.dat.gz"
 
+# The GeoIP database file; a MaxMind DB file (*.mmdb) requires the `maxminddb`
+# package.
+GEOIP_DATA_FILE = os.path.join(ROOT_PATH, 'stats', 'resources', 'GeoIP.dat')
+
+# The number of IP addresses whose countries are cached.
+GEOIP_CACHE_SIZE = 10000
+
+# The number of seconds after which a process checks whether the GeoIP
+# database file has been replaced and has to be loaded again.
+GEOIP_RELOAD_CHECK_INTERVAL = 60
+
 
 # If STORAGE_PATH does not exist, try to create it and halt if not
 # possible.
@@ -93,6 +104,22 @@ try:
 except:
     raise OSError, "STORAGE_PATH must exist and be writable!"
 
+# number of digest zip-archives which are kept in the storage folder of a
+# resource; older archives are removed when a new one is written, keeping the
+# previous ones around for readers which have just looked them up
+DIGEST_ARCHIVE_RETENTION = 2
+
+# number of metadata XML revisions which are kept in the storage folder of a
+# resource; None keeps all revisions
+METADATA_REVISION_RETENTION = 10
+
+# number of worker processes used by the storage maintenance commands
+# (update_digests, repair_storage_folder, repair_storage_objects)
+MAINTENANCE_WORKERS = 4
+
+# number of storage objects handed to a maintenance worker process at once
+MAINTENANCE_CHUNK_SIZE = 100
+
 # If XDIFF_LOCATION was not set in local_settings, set a default here:
 try:
     _ = XDIFF_LOCATION
@@ -227,6 +254,73 @@ HAYSTACK_CONNECTIONS = {
 # Django's signals and keep the search index up-to-date.
 HAYSTACK_SIGNAL_PROCESSOR = 'metashare.repository.signals.PatchedSignalProcessor'
 
+# if True, search index updates of view and download counts are scheduled in
+# a queue and sent to the search backend in batches by a background thread, so
+# that requests never wait for the search backend
+SEARCH_INDEX_QUEUE_ENABLED = True
+
+# maximum number of seconds for which search index updates are queued
+SEARCH_INDEX_QUEUE_FLUSH_INTERVAL = 5
+
+# number of resources whose search index entries are updated at once
+SEARCH_INDEX_QUEUE_BATCH_SIZE = 100
+
+# number of seconds for which the search filter query of the groups of a user
+# is cached; the cached query is discarded as soon as the group membership of
+# the user changes
+SEARCH_GROUP_FILTER_CACHE_TIMEOUT = 60 * 60
+
+# number of seconds for which the user independent part of the single
+# resource view is cached for a revision of a resource; this also limits how
+# long the recommendations on the page may be outdated
+RESOURCE_VIEW_CACHE_TIMEOUT = 10 * 60
+
+# maximum number of canonical XML serializations of metadata objects which are
+# cached by each process for finding duplicates on import
+OBJECT_XML_CACHE_SIZE = 5000
+
+# number of seconds after which a cached serialization of a metadata object is
+# discarded; serializations are discarded as soon as their object is changed,
+# but not when only one of its related objects is changed
+OBJECT_XML_CACHE_TIMEOUT = 60 * 60
+
+# the name of a cache in CACHES which keeps the serializations of metadata
+# objects for all processes instead of each process keeping its own ones; None
+# for caching in each process
+OBJECT_XML_CACHE_BACKEND = None
+
+# maximum number of parsed metadata XML documents of resources which are
+# cached by each process for the single resource view, the statistics and the
+# editor
+METADATA_TREE_CACHE_SIZE = 500
+
+# if True, statistics events (views, downloads, queries, ...) are buffered and
+# written to the statistics tables in batches by a background thread, so that
+# requests never wait for statistics writes
+STATS_BUFFER_ENABLED = True
+
+# maximum number of seconds for which statistics events are buffered
+STATS_BUFFER_FLUSH_INTERVAL = 10
+
+# number of statistics events which are written to the database at once
+STATS_BUFFER_BATCH_SIZE = 200
+
+# if True, buffered statistics events are also appended to a spool file, so
+# that they are not lost if a process crashes before they have been written
+# to the database; the events of crashed processes are written by the next
+# flush of any other process
+STATS_BUFFER_LOSSLESS = False
+
+# folder in which the statistics spool files are kept in lossless mode
+STATS_BUFFER_SPOOL_DIR = os.path.join(LOCK_DIR, 'stats-spool')
+
+# number of statistics events after which the spool file is flushed in
+# lossless mode; with the default of 1, each event is handed to the operating
+# system right away, so no event is lost if a process crashes; larger values
+# save writes, but the events which have not been flushed yet are lost if the
+# process crashes
+STATS_BUFFER_SPOOL_FLUSH_SIZE = 1
+
 # we use a custom Haystack search backend router so that we can dynamically
 # switch between the main/default search backend and the one for testing
 HAYSTACK_ROUTERS = [ 'metashare.haystack_routers.MetashareRouter' ]
@@ -257,11 +351,43 @@ MAX_VIEW_INTERVAL = 60 * 5
 # used in recommendations
 MAX_DOWNLOAD_INTERVAL = 60 * 10
 
-# list of synchronization protocols supported by this node
+# number of seconds for which the ranked recommendations of a resource are
+# cached; the cached recommendations are discarded as soon as they change
+RECOMMENDATIONS_CACHE_TIMEOUT = 60 * 60
+
+# list of synchronization protocols supported by this node, in order of
+# preference; protocol 2.0 adds delta inventories based on the inventory
+# change log and the bulk transfer of metadata records
 SYNC_PROTOCOLS = (
+    '2.0',
     '1.0',
 )
 
+# maximum number of concurrent connections used for fetching resources from a
+# remote node during synchronization
+SYNC_WORKERS = 4
+
+# folder in which the per-node synchronization checkpoints are stored so that
+# an interrupted synchronization run can be resumed with `--resume`
+SYNC_CHECKPOINT_DIR = os.path.join(LOCK_DIR, 'sync-checkpoints')
+
+# number of metadata records which are requested at once from a remote node
+# that supports bulk transfers during synchronization
+SYNC_BATCH_SIZE = 50
+
+# maximum number of metadata records which other nodes may request at once
+# from this node
+SYNC_MAX_BATCH_SIZE = 500
+
+# name of the response header with which sending digest zip archives to
+# other nodes is delegated to the web server, e.g., 'X-LIGHTTPD-send-file' for
+# lighttpd with "allow-x-send-file" enabled or 'X-Sendfile' for Apache with
+# mod_xsendfile; if None, the archives are streamed by Django
+SYNC_SENDFILE_HEADER = None
+
+# folder in which the precomputed synchronization inventory snapshots are kept
+SYNC_INVENTORY_CACHE_DIR = os.path.join(LOCK_DIR, 'sync-inventory')
+
 # Full import path of a serializer class to use for serializing session data
 SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
 
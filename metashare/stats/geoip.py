@@ -4,8 +4,23 @@ from os.path import abspath, dirname, join
 parentdir = dirname(dirname(dirname(abspath(__file__))))
 sys.path.insert(0, join(parentdir, 'lib', 'python2.7', 'site-packages'))
 import pygeoip
-import re
-from metashare.settings import ROOT_PATH
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from metashare import settings
+from metashare.settings import LOG_HANDLER
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(LOG_HANDLER)
 
 
 # Info about of the known countries
@@ -260,20 +275,189 @@ country_info = {"AD": ["Andorra", "42.5075314,1.5218156"],
 "ZM": ["Zambia", "-15.0,30.0"],
 "ZW": ["Zimbabwe", "-19.0,29.0"]}
         
-geoip = pygeoip.GeoIP('{0}/stats/resources/GeoIP.dat'.format(ROOT_PATH))
+# the networks of private, loopback, link-local and otherwise non-routable
+# addresses which cannot be located
+PRIVATE_NETWORKS = (
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8',
+    '169.254.0.0/16', '172.16.0.0/12', '192.168.0.0/16',
+    '::/128', '::1/128', 'fc00::/7', 'fe80::/10',
+)
 
-def is_privateIP(ipaddress):
-    if ipaddress.startswith('192.168.') or \
-        ipaddress.startswith('10.') or \
-        ipaddress.startswith('127.'):
-        return True
-    if ipaddress.startswith('172.'): # skip from 172.16.0.0 - 172.31.255.255
-        match2num = re.search( r'\d+\.(\d+)\..*', ipaddress, re.M|re.I)
-        if int(match2num.group(1)) >= 16 or \
-            int(match2num.group(1)) <= 31:
+
+def _parse_address(ipaddress):
+    """
+    Parses the given IPv4 or IPv6 address.
+
+    Returns a tuple of the IP version, the address as an integer and the
+    normalized address string, or `None` if the address is not valid. IPv4
+    addresses which are mapped to IPv6 are returned as IPv4 addresses.
+    """
+    ipaddress = ipaddress.strip()
+    try:
+        if ':' in ipaddress:
+            high, low = struct.unpack('!QQ',
+                socket.inet_pton(socket.AF_INET6, ipaddress))
+            number = (high << 64) | low
+            if number >> 32 != 0xffff:
+                return 6, number, ipaddress
+            number &= 0xffffffff
+        else:
+            number = struct.unpack('!I',
+                socket.inet_pton(socket.AF_INET, ipaddress))[0]
+    except (socket.error, ValueError):
+        return None
+    return 4, number, socket.inet_ntoa(struct.pack('!I', number))
+
+
+def _parse_network(network):
+    """
+    Parses the given network in CIDR notation.
+
+    Returns a tuple of the IP version, the prefix length and the network
+    prefix as an integer.
+    """
+    address, prefix_length = network.split('/')
+    version, number, _address = _parse_address(address)
+    prefix_length = int(prefix_length)
+    return version, prefix_length, \
+        number >> ((32 if version == 4 else 128) - prefix_length)
+
+
+_PRIVATE_NETWORKS = [_parse_network(network) for network in PRIVATE_NETWORKS]
+
+
+def _is_private_address(address):
+    """
+    Returns whether the given parsed address is in one of the private
+    networks.
+    """
+    version, number, _address = address
+    _bits = 32 if version == 4 else 128
+    for _version, prefix_length, prefix in _PRIVATE_NETWORKS:
+        if _version == version \
+                and number >> (_bits - prefix_length) == prefix:
             return True
     return False
 
+
+class GeoIPService(object):
+    """
+    Looks up the countries of IP addresses.
+
+    The GeoIP database is loaded completely into memory on first use and it
+    is loaded again as soon as the database file has been replaced, e.g., by
+    the `update_geoip_db` command, so that long running processes pick up new
+    databases without a restart. The countries of the most recently looked up
+    addresses are cached.
+
+    Databases in the MaxMind DB format (*.mmdb) are supported if the
+    `maxminddb` package is installed; otherwise a legacy GeoIP database is
+    expected.
+    """
+    def __init__(self, path, cache_size, reload_check_interval):
+        self.path = path
+        self.cache_size = cache_size
+        self.reload_check_interval = reload_check_interval
+        self._lock = threading.Lock()
+        self._reader = None
+        # the inode, modification time and size of the loaded database file
+        self._file_version = None
+        self._next_reload_check = 0
+        self._cache = OrderedDict()
+
+    def get_country_code(self, ipaddress):
+        """
+        Returns the country code of the given IP address or the empty string
+        if the address is private, invalid or unknown.
+        """
+        address = _parse_address(ipaddress) if ipaddress else None
+        if address is None or _is_private_address(address):
+            return ""
+        _address = address[2]
+        with self._lock:
+            self._check_reload()
+            try:
+                result = self._cache.pop(_address)
+            except KeyError:
+                result = self._lookup(_address)
+                if len(self._cache) >= self.cache_size:
+                    # evict the least recently used address
+                    self._cache.popitem(last=False)
+            self._cache[_address] = result
+        return result
+
+    def reload(self):
+        """
+        Loads the GeoIP database again at the next lookup.
+        """
+        with self._lock:
+            self._file_version = None
+            self._next_reload_check = 0
+
+    def _check_reload(self):
+        """
+        Loads the GeoIP database if it has not been loaded, yet, or if the
+        database file has changed since it has been loaded; must be called
+        while holding the lock.
+        """
+        _now = time.time()
+        if _now < self._next_reload_check:
+            return
+        self._next_reload_check = _now + self.reload_check_interval
+        try:
+            _stat = os.stat(self.path)
+        except OSError:
+            LOGGER.error('The GeoIP database {0} is missing.'.format(self.path))
+            return
+        _file_version = (_stat.st_ino, _stat.st_mtime, _stat.st_size)
+        if _file_version == self._file_version:
+            return
+        try:
+            if self.path.endswith('.mmdb') and maxminddb is not None:
+                _reader = maxminddb.open_database(self.path,
+                                                  maxminddb.MODE_MEMORY)
+            else:
+                # pygeoip would return a cached instance for the same path
+                _reader = pygeoip.GeoIP(self.path, pygeoip.MEMORY_CACHE,
+                                        cache=False)
+        except Exception:
+            LOGGER.error('Could not load the GeoIP database {0}.'
+                         .format(self.path), exc_info=True)
+            return
+        self._reader = _reader
+        self._file_version = _file_version
+        self._cache.clear()
+
+    def _lookup(self, ipaddress):
+        """
+        Looks up the country code of the given (valid, public) IP address in
+        the GeoIP database.
+        """
+        if self._reader is None:
+            return ""
+        try:
+            if isinstance(self._reader, pygeoip.GeoIP):
+                return self._reader.country_code_by_addr(ipaddress) or ""
+            record = self._reader.get(ipaddress) or {}
+            return (record.get('country') or {}).get('iso_code') or ""
+        except (pygeoip.GeoIPError, socket.error, ValueError):
+            # e.g., an IPv6 address and a database of IPv4 addresses only
+            return ""
+
+
+# the GeoIP service of this process
+GEOIP_SERVICE = GeoIPService(settings.GEOIP_DATA_FILE,
+    settings.GEOIP_CACHE_SIZE, settings.GEOIP_RELOAD_CHECK_INTERVAL)
+
+
+def is_privateIP(ipaddress):
+    """
+    Returns whether the given IP address is a private, loopback or link-local
+    address; invalid addresses are not private.
+    """
+    address = _parse_address(ipaddress)
+    return address is not None and _is_private_address(address)
+
 def getcountry_name(countrycode):
     if countrycode in country_info:
         return country_info[countrycode][0]
@@ -285,10 +469,4 @@ def getcountry_coords(countrycode):
     return ""
         
 def getcountry_code(ipaddress):
-    if (ipaddress != "" and not is_privateIP(ipaddress)):
-        try:
-            return geoip.country_code_by_addr(ipaddress)
-        except pygeoip.GeoIPError:
-            return ""
-    return ""
-    
+    return GEOIP_SERVICE.get_country_code(ipaddress)
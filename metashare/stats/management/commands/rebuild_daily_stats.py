@@ -0,0 +1,23 @@
+"""
+Rebuilds the daily statistics rollups from the raw statistics records.
+"""
+import logging
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from metashare import settings
+from metashare.stats.model_utils import rebuild_daily_stats
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the daily statistics rollups from the raw statistics ' \
+        'records; required once after upgrading and after importing raw ' \
+        'statistics records'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rebuild_daily_stats()
+        LOGGER.info("Rebuilt the daily statistics rollups.")
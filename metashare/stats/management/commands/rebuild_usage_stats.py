@@ -0,0 +1,116 @@
+"""
+Management utility to rebuild the usage statistics of all published language
+resources in parallel.
+"""
+import logging
+from optparse import make_option
+
+from django import db
+from django.core.management.base import BaseCommand, CommandError
+
+from metashare import settings
+from metashare.repository.metadata_access import get_metadata_elementtree
+from metashare.repository.models import resourceInfoType_model
+from metashare.stats.model_utils import count_usage_stats, \
+    replace_usage_stats, delete_usage_stats, USAGE_STATS_RESOURCE_BATCH_SIZE
+from metashare.stats.models import UsageStats
+from metashare.storage.models import PUBLISHED
+from metashare.utils import WorkerPool
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(settings.LOG_HANDLER)
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', action='store', dest='workers',
+                    type='int', default=settings.MAINTENANCE_WORKERS,
+                    help='number of worker processes; defaults to '
+                    'MAINTENANCE_WORKERS'),
+        make_option('-b', '--batch-size', action='store', dest='batch_size',
+                    type='int', default=USAGE_STATS_RESOURCE_BATCH_SIZE,
+                    help='number of resources whose usage statistics are '
+                    'replaced at once; defaults to {0}'
+                    .format(USAGE_STATS_RESOURCE_BATCH_SIZE)),
+    )
+
+    help = 'Rebuilds the usage statistics of all published language ' \
+        'resources in parallel'
+
+    def handle(self, *args, **options):
+        """
+        Rebuilds the usage statistics.
+        """
+        workers = options['workers']
+        batch_size = options['batch_size']
+        if workers < 1 or batch_size < 1:
+            raise CommandError('The number of workers and the batch size must '
+                               'be positive.')
+        resource_ids = list(resourceInfoType_model.objects.filter(
+                storage_object__publication_status=PUBLISHED,
+                storage_object__deleted=False) \
+            .order_by('pk').values_list('pk', flat=True))
+        total = len(resource_ids)
+        chunks = [resource_ids[i:i + batch_size]
+                  for i in range(0, total, batch_size)]
+
+        pool = None
+        if workers > 1 and len(chunks) > 1:
+            # the worker processes must not share the database connections of
+            # this process
+            for _conn in db.connections.all():
+                _conn.close()
+            pool = WorkerPool(processes=workers)
+            results = pool.imap_unordered(_count_chunk, chunks)
+        else:
+            results = (_count_chunk(chunk) for chunk in chunks)
+        # the worker processes only export and count, this process writes all
+        # usage statistics so that the workers do not compete for the database
+        done = 0
+        kept_lrids = set()
+        try:
+            for _usage, _failed in results:
+                replace_usage_stats(_usage)
+                kept_lrids.update(_usage)
+                # keep the previous usage statistics of failed resources
+                kept_lrids.update(_failed)
+                done += len(_usage) + len(_failed)
+                if int(options['verbosity']) >= 1:
+                    self.stdout.write('{0} of {1} resources processed'
+                                      .format(done, total))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        # remove the usage statistics of resources which are not published
+        # (anymore)
+        delete_usage_stats(set(UsageStats.objects.values_list('lrid', flat=True)
+                               .distinct()) - kept_lrids)
+
+
+def _count_chunk(resource_ids):
+    """
+    Counts the usage of the metadata elements of the resources with the given
+    ids.
+
+    Returns a dictionary which maps the storage object identifiers of the
+    resources to their usage counters and the storage object identifiers of
+    the resources which could not be counted.
+    """
+    usage = {}
+    failed = []
+    for resource in resourceInfoType_model.objects \
+            .filter(pk__in=resource_ids).select_related('storage_object'):
+        try:
+            usage[resource.storage_object.identifier] = count_usage_stats(
+                get_metadata_elementtree(resource))
+        # pylint: disable-msg=W0703
+        except Exception:
+            LOGGER.error('Usage statistics updating failed on resource {0}.'
+                         .format(resource.id), exc_info=True)
+            failed.append(resource.storage_object.identifier)
+    db.reset_queries()
+    return usage, failed
@@ -7,7 +7,8 @@ import gzip
 import os
 from django.core.management.base import BaseCommand
 from metashare import settings
-from metashare.settings import ROOT_PATH, GEOIP_DATA_URL
+from metashare.settings import GEOIP_DATA_FILE, GEOIP_DATA_URL
+from metashare.stats.geoip import GEOIP_SERVICE
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -18,8 +19,11 @@ class Command(BaseCommand):
     help = 'Downloading GeoIP data'
 
     def handle(self, *args, **options):
-        geogzfile = ROOT_PATH+'/stats/resources/GeoIP.dat.gz'
-        geodatfile = ROOT_PATH+'/stats/resources/GeoIP.dat'
+        geogzfile = GEOIP_DATA_FILE + '.gz'
+        # the new database is written to a temporary file first and then
+        # renamed, so that running processes which reload the database (see
+        # `GeoIPService`) never see a partially written file
+        geotmpfile = GEOIP_DATA_FILE + '.tmp'
         try:
             urldoc = urllib2.urlopen(GEOIP_DATA_URL)
             with open(geogzfile, 'wb') as out_file_handle:
@@ -28,10 +32,12 @@ class Command(BaseCommand):
             if os.path.exists(geogzfile) and os.path.getsize(geogzfile) > 0:
                 try:
                     with gzip.open(geogzfile, 'rb') as db_file_handle, \
-                            open(geodatfile, 'wb') as datfile:
+                            open(geotmpfile, 'wb') as datfile:
                         datfile.write(db_file_handle.read())
+                    os.rename(geotmpfile, GEOIP_DATA_FILE)
+                    GEOIP_SERVICE.reload()
                     LOGGER.info("Updated the GeoIP database file at: %s",
-                        geodatfile)
+                        GEOIP_DATA_FILE)
                 except:
                     LOGGER.fatal("Gzip decompression failure on %s.", geogzfile,
                         exc_info=True)
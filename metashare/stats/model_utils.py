@@ -1,15 +1,21 @@
 import logging
 import json
-import itertools 
 import threading
 import re
-from django.db.models import Count, Sum
+from collections import OrderedDict
+from datetime import datetime
+from django.db import transaction
+from django.db.models import Count, Sum, Max, F
 from django.contrib.auth.models import User
 from math import trunc
-from metashare.stats.models import LRStats, QueryStats, UsageStats
+from metashare.stats.models import LRStats, QueryStats, UsageStats, \
+    LRStatsDaily, QueryStatsDaily
 from metashare.stats.geoip import getcountry_code, getcountry_name
+from metashare.repository.metadata_access import get_metadata_elementtree
 from metashare.storage.models import PUBLISHED
+from metashare import settings
 from metashare.settings import LOG_HANDLER
+from metashare.stats.stats_buffer import STATS_BUFFER, LR_EVENT, QUERY_EVENT
 
 USAGETHREADNAME = "usagethread"
 BOT_AGENT_RE = re.compile(r".*(bot|spider|spyder|crawler|archiver|seek|\
@@ -29,6 +35,16 @@ DELETE_STAT = "e"
 STAT_LABELS = {UPDATE_STAT: "update", VIEW_STAT: "view", RETRIEVE_STAT: "retrieve", \
     DOWNLOAD_STAT: "download", PUBLISH_STAT: "publish", INGEST_STAT: "ingest", DELETE_STAT: "delete"}
 VISIBLE_STATS = [UPDATE_STAT, VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT]
+
+# number of usage statistics records (or resource ids) which are inserted (or
+# deleted) with a single query
+USAGE_STATS_BATCH_SIZE = 500
+
+# number of resources whose usage statistics are rebuilt in one transaction
+USAGE_STATS_RESOURCE_BATCH_SIZE = 50
+
+# the format of the times of buffered statistics events
+STATS_EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
     
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -41,23 +57,43 @@ def saveLRStats(resource, action, request=None):
     
     Takes into account the session to avoid to increment more than one time the
     stats counter. Returns whether the stats counter was incremented or not.
+
+    If the STATS_BUFFER_ENABLED setting is True, all actions but ingestions and
+    deletions are only buffered and saved later on by a background thread; in
+    this case, False is returned and the search index entry of the resource is
+    updated when the stats counter is actually incremented.
     """
     result = False
     LOGGER.debug("saveLRStats action=%s lrid=%s", action,
                  resource.storage_object.identifier)
     if not hasattr(resource, 'storage_object') or resource.storage_object is None:
         return result
-        
+
+    if settings.STATS_BUFFER_ENABLED:
+        if action in (INGEST_STAT, DELETE_STAT):
+            # the buffered actions of this process must not outlive the
+            # statistics which are reset below
+            STATS_BUFFER.flush()
+        else:
+            if resource.storage_object.publication_status == PUBLISHED:
+                STATS_BUFFER.add((LR_EVENT, resource.storage_object.identifier,
+                    action, _get_userid(request), _get_sessionid(request),
+                    _get_ipaddress(request),
+                    datetime.now().strftime(STATS_EVENT_TIME_FORMAT)))
+            return result
+
     # Manage statistics according with the resource status
     lrid = resource.storage_object.identifier
     ignored = False
     if action == INGEST_STAT:
         ignored = True
         LRStats.objects.filter(lrid=lrid).update(ignored=ignored)
+        LRStatsDaily.objects.filter(lrid=lrid).update(count=0)
         UsageStats.objects.filter(lrid=lrid).delete()
     if action == DELETE_STAT:
         UsageStats.objects.filter(lrid=lrid).delete()
         LRStats.objects.filter(lrid=lrid).delete()
+        LRStatsDaily.objects.filter(lrid=lrid).delete()
         return result
     if (resource.storage_object.publication_status != PUBLISHED):
         return result
@@ -67,6 +103,9 @@ def saveLRStats(resource, action, request=None):
     lrset = LRStats.objects.filter(userid=userid, lrid=lrid, sessid=sessid, action=action)
     if (lrset.count() > 0):
         record = lrset[0]
+        if record.ignored != ignored:
+            _update_lr_daily_stats({_get_lr_daily_key(record):
+                [0, -record.count if ignored else record.count]})
         record.ignored = ignored
         record.save(force_update=True)
         #LOGGER.debug('UPDATESTATS: Saved LR {0}, {1} action={2} ({3}).'.format(lrid, sessid, action, record.lasttime))
@@ -79,16 +118,22 @@ def saveLRStats(resource, action, request=None):
         record.geoinfo = getcountry_code(_get_ipaddress(request))
         record.ignored = ignored
         record.save(force_insert=True)
+        _update_lr_daily_stats({_get_lr_daily_key(record):
+            [1, 0 if ignored else record.count]})
         #LOGGER.debug('SAVESTATS: Saved LR {0}, {1} action={2}.'.format(lrid, sessid, action))
         result = True
     if action == UPDATE_STAT:
         if (resource.storage_object.published):
-            UsageStats.objects.filter(lrid=lrid).delete()
-            update_usage_stats(lrid, resource.export_to_elementtree())
+            update_usage_stats(lrid, get_metadata_elementtree(resource))
             #LOGGER.debug('STATS: Updating usage statistics: resource {0} updated'.format(lrid))
     return result
 
 def saveQueryStats(query, facets, found, exectime=0, request=None): 
+    if settings.STATS_BUFFER_ENABLED:
+        STATS_BUFFER.add((QUERY_EVENT, _get_userid(request),
+            _get_ipaddress(request), query, facets, found, exectime,
+            datetime.now().strftime(STATS_EVENT_TIME_FORMAT)))
+        return
     stat = QueryStats()
     stat.userid = _get_userid(request)
     stat.geoinfo = getcountry_code(_get_ipaddress(request))    
@@ -97,22 +142,235 @@ def saveQueryStats(query, facets, found, exectime=0, request=None):
     stat.found = found
     stat.exectime = exectime    
     stat.save()
+    _update_query_daily_stats([stat])
     LOGGER.debug(u'saveQueryStats q={0}.'.format(query))
 
+def save_stats_events(events):
+    """
+    Saves the given buffered statistics events with a few bulk queries.
+
+    The resource actions of the same user and session are aggregated into a
+    single `LRStats` record just like in `saveLRStats()`, and actions on
+    resources which are not published (anymore) are dropped. The usage
+    statistics of an updated resource are rebuilt only once per call and the
+    search index entries of the resources with new views or downloads are
+    updated.
+    """
+    from metashare.repository.models import resourceInfoType_model
+    from metashare.repository.search_indexes import update_lr_index_entry
+    _queries = []
+    _actions = OrderedDict()
+    for event in events:
+        if event[0] == QUERY_EVENT:
+            userid, ip_address, query, facets, found, exectime, _time = \
+                event[1:]
+            _queries.append(QueryStats(userid=userid,
+                geoinfo=getcountry_code(ip_address), query=query,
+                facets=facets, found=found, exectime=exectime,
+                lasttime=datetime.strptime(_time, STATS_EVENT_TIME_FORMAT)))
+        elif event[0] == LR_EVENT:
+            lrid, action, userid, sessid, ip_address, _time = event[1:]
+            # the first action of a user in a session determines the record
+            _actions.setdefault((userid, lrid, sessid, action),
+                                (ip_address, _time))
+    if _queries:
+        QueryStats.objects.bulk_create(_queries)
+        _update_query_daily_stats(_queries)
+    if not _actions:
+        return
+
+    _lrids = set(key[1] for key in _actions)
+    _resources = dict((res.storage_object.identifier, res) for res in
+        resourceInfoType_model.objects.filter(
+            storage_object__identifier__in=_lrids,
+            storage_object__publication_status=PUBLISHED,
+            storage_object__deleted=False).select_related('storage_object'))
+    _existing = {}
+    for record in LRStats.objects.filter(lrid__in=_resources.keys(),
+            sessid__in=set(key[2] for key in _actions)) \
+            .only('id', 'userid', 'lrid', 'sessid', 'action'):
+        _existing.setdefault(
+            (record.userid, record.lrid, record.sessid, record.action),
+            record.id)
+
+    _new_records = []
+    _touched_ids = []
+    _updated_lrids = set()
+    _counted_lrids = set()
+    for key, (ip_address, _time) in _actions.iteritems():
+        userid, lrid, sessid, action = key
+        if lrid not in _resources:
+            continue
+        if action == UPDATE_STAT:
+            _updated_lrids.add(lrid)
+        if key in _existing:
+            _touched_ids.append(_existing[key])
+            continue
+        _new_records.append(LRStats(userid=userid, lrid=lrid, sessid=sessid,
+            action=action, geoinfo=getcountry_code(ip_address), ignored=False,
+            lasttime=datetime.strptime(_time, STATS_EVENT_TIME_FORMAT)))
+        if action in (VIEW_STAT, DOWNLOAD_STAT):
+            _counted_lrids.add(lrid)
+    _daily = {}
+    for record in _new_records:
+        _daily.setdefault(_get_lr_daily_key(record), [0, 0])
+        _daily[_get_lr_daily_key(record)][0] += 1
+        _daily[_get_lr_daily_key(record)][1] += record.count
+    if _new_records:
+        LRStats.objects.bulk_create(_new_records)
+    if _touched_ids:
+        # ignored records which are touched again are counted again
+        _ignored = list(LRStats.objects.filter(id__in=_touched_ids,
+                ignored=True).only('lrid', 'action', 'geoinfo', 'lasttime',
+                                   'count'))
+        for record in _ignored:
+            _daily.setdefault(_get_lr_daily_key(record), [0, 0])
+            _daily[_get_lr_daily_key(record)][1] += record.count
+        if _ignored:
+            LRStats.objects.filter(id__in=[record.id for record in _ignored]) \
+                .update(ignored=False)
+    _update_lr_daily_stats(_daily)
+
+    if _updated_lrids:
+        replace_usage_stats(dict((lrid, count_usage_stats(
+                get_metadata_elementtree(_resources[lrid])))
+            for lrid in _updated_lrids))
+    for lrid in _counted_lrids:
+        update_lr_index_entry(_resources[lrid])
+    LOGGER.debug(u'Saved {0} statistics events.'.format(len(events)))
+
+def _get_lr_daily_key(record):
+    """
+    Returns the key of the `LRStatsDaily` rollup row of the given `LRStats`
+    record.
+    """
+    return (record.lrid, record.action, record.geoinfo, record.lasttime.date())
+
+
+def _update_lr_daily_stats(deltas):
+    """
+    Adds the given deltas to the daily `LRStats` rollup.
+
+    `deltas` maps `LRStatsDaily` keys (see `_get_lr_daily_key()`) to pairs of
+    the number of added `LRStats` records and the added (not ignored) count.
+    """
+    if not deltas:
+        return
+    _existing = {}
+    for row in LRStatsDaily.objects.filter(
+            lrid__in=set(key[0] for key in deltas),
+            day__in=set(key[3] for key in deltas)) \
+            .only('id', 'lrid', 'action', 'geoinfo', 'day'):
+        _existing.setdefault((row.lrid, row.action, row.geoinfo, row.day),
+                             row.id)
+    _new_rows = []
+    for key, (records, count) in deltas.iteritems():
+        if key in _existing:
+            LRStatsDaily.objects.filter(id=_existing[key]).update(
+                records=F('records') + records, count=F('count') + count)
+        else:
+            _new_rows.append(LRStatsDaily(lrid=key[0], action=key[1],
+                geoinfo=key[2], day=key[3], records=records, count=count))
+    if _new_rows:
+        LRStatsDaily.objects.bulk_create(_new_rows)
+
+
+def _get_query_daily_deltas(stats):
+    """
+    Returns the deltas of the daily `QueryStats` rollup for the given new
+    `QueryStats` records.
+
+    The result maps the `QueryStatsDaily` keys to lists of the number of
+    records and the sum of their execution times.
+    """
+    _deltas = OrderedDict()
+    for stat in stats:
+        key = (stat.query, stat.facets, stat.geoinfo, stat.lasttime.date())
+        delta = _deltas.setdefault(key, [0, 0])
+        delta[0] += 1
+        delta[1] += stat.exectime
+    return _deltas
+
+
+def _update_query_daily_stats(stats):
+    """
+    Adds the given new `QueryStats` records to the daily `QueryStats` rollup.
+    """
+    _deltas = _get_query_daily_deltas(stats)
+    _existing = {}
+    for row in QueryStatsDaily.objects.filter(
+            day__in=set(key[3] for key in _deltas),
+            query__in=set(key[0] for key in _deltas)) \
+            .only('id', 'query', 'facets', 'geoinfo', 'day'):
+        _existing.setdefault((row.query, row.facets, row.geoinfo, row.day),
+                             row.id)
+    _new_rows = []
+    for key, (count, total) in _deltas.iteritems():
+        if key in _existing:
+            QueryStatsDaily.objects.filter(id=_existing[key]).update(
+                count=F('count') + count,
+                exectime_total=F('exectime_total') + total)
+        else:
+            _new_rows.append(QueryStatsDaily(query=key[0], facets=key[1],
+                geoinfo=key[2], day=key[3], count=count, exectime_total=total))
+    if _new_rows:
+        QueryStatsDaily.objects.bulk_create(_new_rows)
+
+
+def rebuild_daily_stats():
+    """
+    Rebuilds the daily rollups of the `LRStats` and `QueryStats` records from
+    scratch, e.g., after statistics have been imported into the raw tables.
+    """
+    LRStatsDaily.objects.all().delete()
+    _daily = {}
+    for record in LRStats.objects.only('lrid', 'action', 'geoinfo', 'lasttime',
+                                       'count', 'ignored').iterator():
+        delta = _daily.setdefault(_get_lr_daily_key(record), [0, 0])
+        delta[0] += 1
+        if not record.ignored:
+            delta[1] += record.count
+    LRStatsDaily.objects.bulk_create(
+        [LRStatsDaily(lrid=key[0], action=key[1], geoinfo=key[2], day=key[3],
+                      records=records, count=count)
+         for key, (records, count) in _daily.iteritems()], batch_size=500)
+    QueryStatsDaily.objects.all().delete()
+    QueryStatsDaily.objects.bulk_create(
+        [QueryStatsDaily(query=key[0], facets=key[1], geoinfo=key[2],
+                         day=key[3], count=count, exectime_total=total)
+         for key, (count, total)
+         in _get_query_daily_deltas(QueryStats.objects.only('query', 'facets',
+            'geoinfo', 'lasttime', 'exectime').iterator()).iteritems()],
+        batch_size=500)
+
+
 def getLRStats(lrid):
-    data = ""
-    action_list = LRStats.objects.values('lrid', 'action').filter(lrid=lrid, ignored=False).annotate(Count('action'), Sum('count')).order_by('-action')
-    if (action_list.count() > 0):
-        for key in action_list:
-            sets = LRStats.objects.values('lasttime').filter(lrid=lrid, action=str(key['action'])).order_by('-lasttime')[:1]
-            for key2 in sets:
-                if str(key['action']) in VISIBLE_STATS:
-                    if (len(data) > 0):
-                        data += ", "
-                    data += "{\"action\":\""+ STAT_LABELS[str(key['action'])] +"\",\"count\":\""+ \
-                        str(key['count__sum']) +"\",\"last\":\""+str(key2['lasttime'])[:10]+"\"}"
-                    break    
-    return json.loads("["+data+"]")
+    """
+    Returns the counters and the days of the last actions of the visible
+    actions on the resource with the given storage object identifier.
+    """
+    return getAllLRStats(lrid).get(lrid, [])
+
+
+def getAllLRStats(lrid=None):
+    """
+    Returns a dictionary which maps the storage object identifiers of the
+    resources to their action counters as returned by `getLRStats()`; if an
+    identifier is given, only the counters of this resource are returned.
+    """
+    action_list = LRStatsDaily.objects.filter(action__in=VISIBLE_STATS)
+    if lrid is not None:
+        action_list = action_list.filter(lrid=lrid)
+    action_list = action_list.values('lrid', 'action') \
+        .annotate(count_sum=Sum('count'), last=Max('day')) \
+        .filter(count_sum__gt=0).order_by('lrid', '-action')
+    result = {}
+    for item in action_list:
+        result.setdefault(item['lrid'], []).append(
+            {"action": STAT_LABELS[str(item['action'])],
+             "count": str(item['count_sum']),
+             "last": str(item['last'])[:10]})
+    return result
 
     
 def getUserCount(lrid, user = None):
@@ -155,24 +413,14 @@ def getUserStats(lrid):
 def getLRTop(action, limit, geoinfo=None, since=None, offset=0):
     action_list = []
     if (action and not action == ""):
+        action_list = LRStatsDaily.objects.filter(action=action)
         if (geoinfo != None and geoinfo != ''):
-            if (since):
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action, geoinfo=geoinfo, lasttime__gte=since) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
-            else:
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action, geoinfo=geoinfo) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
-        else:
-            if (since):
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action, lasttime__gte=since) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
-            else:
-                action_list = LRStats.objects.values('lrid') \
-                    .filter(ignored=False, action=action) \
-                    .annotate(sum_count=Sum('count')).order_by('-sum_count')[offset:offset+limit]
+            action_list = action_list.filter(geoinfo=geoinfo)
+        if (since):
+            action_list = action_list.filter(day__gte=since)
+        action_list = action_list.values('lrid') \
+            .annotate(sum_count=Sum('count')).filter(sum_count__gt=0) \
+            .order_by('-sum_count')[offset:offset+limit]
     return action_list
 
 def getLRLast(action, limit, geoinfo=None, offset=0):
@@ -193,36 +441,14 @@ def getLRLast(action, limit, geoinfo=None, offset=0):
     return action_list
 
 def getTopQueries(limit, geoinfo=None, since=None, offset=0):
+    topqueries = QueryStatsDaily.objects.exclude(query__startswith="mfs")
     if (geoinfo != None and geoinfo != ''):
-        if (since):
-            topqueries = QueryStats.objects.values('query', 'facets') \
-                .exclude(query__startswith="mfs") \
-                .filter(lasttime__gte=since, geoinfo=geoinfo) \
-                .annotate(query_count=Count('query'),
-                          facets_count=Count('facets')) \
-                .order_by('-query_count','-facets_count')[offset:offset+limit]
-        else:
-            topqueries = QueryStats.objects.values('query', 'facets') \
-                .exclude(query__startswith="mfs") \
-                .filter(geoinfo=geoinfo) \
-                .annotate(query_count=Count('query'), 
-                    facets_count=Count('facets')) \
-                .order_by('-query_count','-facets_count')[offset:offset+limit] 
-    else:
-        if (since):
-            topqueries = QueryStats.objects.values('query', 'facets') \
-                .exclude(query__startswith="mfs") \
-                .filter(lasttime__gte=since) \
-                .annotate(query_count=Count('query'), 
-                    facets_count=Count('facets')) \
-                .order_by('-query_count','-facets_count')[offset:offset+limit]
-        else:
-            topqueries = QueryStats.objects.values('query', 'facets') \
-                .exclude(query__startswith="mfs") \
-                .annotate(query_count=Count('query'), 
-                    facets_count=Count('facets')) \
-                .order_by('-query_count','-facets_count')[offset:offset+limit]
-    return topqueries
+        topqueries = topqueries.filter(geoinfo=geoinfo)
+    if (since):
+        topqueries = topqueries.filter(day__gte=since)
+    return topqueries.values('query', 'facets') \
+        .annotate(query_count=Sum('count')) \
+        .order_by('-query_count')[offset:offset+limit]
     
 def getLastQuery(limit, geoinfo=None, offset=0):
     if (geoinfo != None and geoinfo != ''):
@@ -238,20 +464,22 @@ def getLastQuery(limit, geoinfo=None, offset=0):
     return lastquery
 
 def statByDate(date):
-    return LRStats.objects.values("action").filter(lasttime__year=date[0:4], lasttime__month=date[4:6], \
-        lasttime__day=date[6:8]).annotate(Count('action'))
+    return LRStatsDaily.objects.values("action").filter(day=date[0:4] + "-" \
+        + date[4:6] + "-" + date[6:8]).annotate(action__count=Sum('records'))
     
 def statDays():
-    days = itertools.chain(LRStats.objects.dates('lasttime', 'day'), QueryStats.objects.dates('lasttime', 'day'))
-    return reduce(lambda x, y: x if y in x else x + [y], days, [])
+    return sorted(set(LRStatsDaily.objects.values_list('day', flat=True)
+                      .distinct())
+                  | set(QueryStatsDaily.objects.values_list('day', flat=True)
+                        .distinct()))
 
 def getCountryActions(action):
     result = []
     sets = None
     if (action != None):
-        sets = LRStats.objects.values('geoinfo').exclude(geoinfo=u'').filter(action=action).annotate(Count('action')).order_by('-action__count')
+        sets = LRStatsDaily.objects.values('geoinfo').exclude(geoinfo=u'').filter(action=action).annotate(action__count=Sum('records')).order_by('-action__count')
     else:
-        sets = LRStats.objects.values('geoinfo').annotate(Count('action')).order_by('-action__count')
+        sets = LRStatsDaily.objects.values('geoinfo').annotate(action__count=Sum('records')).order_by('-action__count')
     
     for key in sets:
         result.append([key['geoinfo'], key['action__count'], getcountry_name(key['geoinfo'])])
@@ -260,7 +488,7 @@ def getCountryActions(action):
         
 def getCountryQueries():
     result = []
-    sets = QueryStats.objects.values('geoinfo').exclude(geoinfo=u'').annotate(Count('geoinfo')).order_by('-geoinfo__count')
+    sets = QueryStatsDaily.objects.values('geoinfo').exclude(geoinfo=u'').annotate(geoinfo__count=Sum('count')).order_by('-geoinfo__count')
     for key in sets:
         result.append([key['geoinfo'], key['geoinfo__count'], getcountry_name(key['geoinfo'])])
     return result
@@ -305,49 +533,84 @@ def _get_ipaddress(request):
     return ''
 
 
-def update_usage_stats(lrid, element_tree):
-    element_children = list(element_tree)
-    if len(element_children):
-        for child in element_children:
-            item = update_usage_stats(lrid, child)
-            if (item == None or item[0] == None):
-                lrset = UsageStats.objects.filter(lrid=lrid, elparent=element_tree.tag, elname=child.tag)
-                if (lrset.count() > 1):
-                    LOGGER.debug('ERROR! Saving usage stats in {}, {}'.format(element_tree.tag, child.tag))
-                    continue
-                if (lrset.count() > 0):
-                    record = lrset[0]
-                    record.count = record.count+1
-                    record.save(force_update=True)
-                else:
-                    record = UsageStats()
-                    record.lrid = lrid
-                    record.elname = child.tag
-                    record.elparent = element_tree.tag
-                    record.save(force_insert=True)
-                continue
-            if not isinstance(item[0], basestring):
-                elname = item[0][0].encode("utf-8") if item[0][0] != None else ""
-                text = item[0][1].encode("utf-8") if item[0][1] != None else ""
-                lrset = UsageStats.objects.filter(lrid=lrid, elparent=element_tree.tag, elname=elname, text=text)
-                if (lrset.count() > 1):
-                    LOGGER.debug('ERROR! Saving usage stats in {}, {}'.format(element_tree.tag, elname))
+def count_usage_stats(element_tree):
+    """
+    Returns the usage counters of the metadata elements of the given exported
+    resource.
+
+    The result maps (parent tag, tag, text) keys to counters. A leaf element
+    is counted with its text; an element with children is counted with an
+    empty text, unless its parent/tag combination has already been counted
+    exactly once with some text in which case that counter is increased, and
+    it is not counted at all if the combination has been counted with several
+    texts.
+    """
+    counts = OrderedDict()
+    # the keys of the counters by parent tag and tag
+    _keys = {}
+    def _count(element):
+        for child in element:
+            if len(child):
+                _count(child)
+                _named = _keys.setdefault((element.tag, child.tag), [])
+                if len(_named) > 1:
+                    LOGGER.debug('ERROR! Saving usage stats in {}, {}'
+                                 .format(element.tag, child.tag))
                     continue
-                if (lrset.count() > 0):
-                    record = lrset[0]
-                    record.count = record.count+1
-                    record.save(force_update=True)
-                else:
-                    record = UsageStats()
-                    record.lrid = lrid
-                    record.elname = elname
-                    record.elparent = element_tree.tag
-                    record.text = text
-                    record.save(force_insert=True)
-        return None
-    # Otherwise, we return a tuple containg (key, value), i.e., (tag, text).
-    else:
-        return ((element_tree.tag, element_tree.text),)
+                if not _named:
+                    _named.append((element.tag, child.tag, u''))
+                key = _named[0]
+            else:
+                key = (element.tag, child.tag, child.text or u'')
+                if key not in counts:
+                    _keys.setdefault((element.tag, child.tag), []).append(key)
+            counts[key] = counts.get(key, 0) + 1
+    _count(element_tree)
+    return counts
+
+
+def replace_usage_stats(usage):
+    """
+    Replaces the usage statistics of the resources with the given storage
+    object identifiers with the given usage counters.
+
+    `usage` maps storage object identifiers to usage counters as returned by
+    `count_usage_stats()`; all new `UsageStats` records are inserted at once.
+    """
+    _lrids = list(usage)
+    with transaction.atomic():
+        for i in range(0, len(_lrids), USAGE_STATS_BATCH_SIZE):
+            UsageStats.objects.filter(
+                lrid__in=_lrids[i:i + USAGE_STATS_BATCH_SIZE]).delete()
+        UsageStats.objects.bulk_create(
+            [UsageStats(lrid=lrid, elparent=elparent, elname=elname,
+                        text=text, count=count)
+             for lrid, counts in usage.iteritems()
+             for (elparent, elname, text), count in counts.iteritems()],
+            batch_size=USAGE_STATS_BATCH_SIZE)
+
+
+def delete_usage_stats(lrids, with_lr_stats=False):
+    """
+    Deletes the usage statistics of the resources with the given storage
+    object identifiers and, optionally, their action statistics.
+    """
+    _lrids = list(lrids)
+    _models = [UsageStats]
+    if with_lr_stats:
+        _models.extend((LRStats, LRStatsDaily))
+    for i in range(0, len(_lrids), USAGE_STATS_BATCH_SIZE):
+        for _model in _models:
+            _model.objects.filter(
+                lrid__in=_lrids[i:i + USAGE_STATS_BATCH_SIZE]).delete()
+
+
+def update_usage_stats(lrid, element_tree):
+    """
+    Rebuilds the usage statistics of the resource with the given storage
+    object identifier from the given exported resource.
+    """
+    replace_usage_stats({lrid: count_usage_stats(element_tree)})
     
 
 def updateUsageStats(resources):   
@@ -386,24 +649,30 @@ class UsageThread(threading.Thread):
         
     def run(self):       
         self.done = 0
-        usagelrids = UsageStats.objects.values_list('lrid', flat=True).distinct()
-        available_lrids = []
+        usagelrids = set(UsageStats.objects.values_list('lrid', flat=True)
+                         .distinct())
+        available_lrids = set()
+        usage = {}
         for resource in self.resources:
+            lrid = resource.storage_object.identifier
             try:
                 # add statistics for new resources
-                if not resource.storage_object.identifier in usagelrids:
-                    update_usage_stats(resource.storage_object.identifier, resource.export_to_elementtree())
+                if not lrid in usagelrids:
+                    usage[lrid] = count_usage_stats(
+                        get_metadata_elementtree(resource))
+                    if len(usage) >= USAGE_STATS_RESOURCE_BATCH_SIZE:
+                        replace_usage_stats(usage)
+                        usage = {}
                 else: 
-                    available_lrids.append(resource.storage_object.identifier)
+                    available_lrids.add(lrid)
             # pylint: disable-msg=W0703
             except Exception, e:
                 LOGGER.debug('ERROR! Usage statistics updating failed on resource {}: {}'.format(resource.id, e))
             self.done += 1
+        if usage:
+            replace_usage_stats(usage)
         #remove statistics for no longer available resources
         if (len(usagelrids) != len(available_lrids)):
             self.done = self.done - 1
-            for lrid in usagelrids:
-                if not lrid in available_lrids:
-                    UsageStats.objects.filter(lrid=str(lrid)).delete()
-                    LRStats.objects.filter(lrid=str(lrid)).delete()
-            
+            delete_usage_stats(usagelrids - available_lrids,
+                               with_lr_stats=True)
@@ -61,3 +61,43 @@ class UsageStats(models.Model):
     
     #def __unicode__(self):
     #    return "U>> " +str(self.lrid) + "," + str(self.elname) + "," + str(self.elparent) + "," +str(self.text)+ "," + str(self.count)
+
+
+class LRStatsDaily(models.Model):
+    """
+    The daily rollup of the `LRStats` records of a language resource, action
+    and country.
+
+    The rollup is maintained incrementally whenever `LRStats` records are
+    saved (see `metashare.stats.model_utils`), so that the statistics pages do
+    not need to aggregate the raw records. All statistics are sums or maxima
+    over the rollup rows, so an occasional second row for the same day (e.g.,
+    created concurrently by two processes) does not distort them.
+    """
+    # the storage object identifier of the language resource,
+    # NOT the pk of the resource!
+    lrid = models.CharField(blank=False, max_length=64, db_index=True)
+
+    action = models.CharField(blank=False, max_length=1)
+    geoinfo = models.CharField(blank=True, max_length=2)
+    day = models.DateField(blank=False, db_index=True)
+    # the number of `LRStats` records of the day
+    records = models.IntegerField(blank=False, default=0)
+    # the sum of the counts of the `LRStats` records of the day which are not
+    # ignored
+    count = models.IntegerField(blank=False, default=0)
+
+
+class QueryStatsDaily(models.Model):
+    """
+    The daily rollup of the `QueryStats` records of a query, the selected
+    facets and country; see `LRStatsDaily`.
+    """
+    query = models.TextField(blank=False)
+    facets = models.TextField(blank=False)
+    geoinfo = models.CharField(blank=True, max_length=2)
+    day = models.DateField(blank=False, db_index=True)
+    # the number of `QueryStats` records of the day
+    count = models.IntegerField(blank=False, default=0)
+    # the sum of the execution times of the queries
+    exectime_total = models.IntegerField(blank=False, default=0)
@@ -0,0 +1,279 @@
+"""
+A buffer for statistics events.
+
+Statistics events are collected in memory and a background thread writes
+them to the statistics tables in batches, so that requests never have to wait
+for statistics writes.
+
+In lossless mode, each event is also appended to a spool file of the current
+process before it is buffered; the spool file is flushed after a number of
+events. The spool files are only removed after their events have been written
+to the database, and spool files which have been left behind by a crashed
+process are picked up by the next flush of any process.
+"""
+import atexit
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+
+from django import db
+
+from metashare import settings
+from metashare.settings import LOG_HANDLER
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(LOG_HANDLER)
+
+# the kinds of statistics events
+LR_EVENT = 'lr'
+QUERY_EVENT = 'query'
+
+# the suffixes of the spool files which are written to and of the spool files
+# which are currently flushed
+SPOOL_SUFFIX = '.spool'
+FLUSHING_SUFFIX = '.flushing'
+
+
+class StatsBuffer(object):
+    """
+    A process-wide buffer of statistics events.
+
+    The events are tuples of JSON serializable values starting with the kind
+    of the event; see `metashare.stats.model_utils.save_stats_events()`.
+    """
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        # serializes the flushes of this process
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._pending_count = 0
+        self._spool = None
+        # the number of events which have been written to the spool file
+        # since it has been flushed
+        self._spool_unflushed = 0
+        self._flush_count = 0
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._stopped = False
+
+    def add(self, event):
+        """
+        Adds the given statistics event to this buffer.
+        """
+        with self._lock:
+            self._ensure_worker()
+            if settings.STATS_BUFFER_LOSSLESS:
+                if self._spool is None:
+                    if not os.path.isdir(settings.STATS_BUFFER_SPOOL_DIR):
+                        os.makedirs(settings.STATS_BUFFER_SPOOL_DIR)
+                    self._spool = open(_get_spool_path(os.getpid()), 'a')
+                self._spool.write(json.dumps(event) + '\n')
+                self._spool_unflushed += 1
+                if self._spool_unflushed \
+                        >= settings.STATS_BUFFER_SPOOL_FLUSH_SIZE:
+                    self._spool.flush()
+                    self._spool_unflushed = 0
+            else:
+                self._pending.append(event)
+            self._pending_count += 1
+            if self._pending_count >= settings.STATS_BUFFER_BATCH_SIZE:
+                self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes all buffered statistics events to the database.
+        """
+        from metashare.stats.model_utils import save_stats_events
+        with self._flush_lock:
+            with self._lock:
+                _events = self._pending
+                self._pending = []
+                self._pending_count = 0
+                _claimed = self._claim_spool_files()
+            # in lossless mode, the spool files contain the buffered events of
+            # this process as well as the ones of crashed processes
+            for _path in _claimed:
+                self._flush_spool_file(_path, save_stats_events)
+            _batch_size = settings.STATS_BUFFER_BATCH_SIZE
+            for i in range(0, len(_events), _batch_size):
+                try:
+                    save_stats_events(_events[i:i + _batch_size])
+                except:
+                    LOGGER.error('Could not save {0} statistics events.'
+                                 .format(len(_events[i:i + _batch_size])),
+                                 exc_info=True)
+
+    def stop(self):
+        """
+        Stops the background worker thread of this process after a final
+        flush of all buffered statistics events.
+        """
+        if self._pid != os.getpid():
+            return
+        self._stopped = True
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join()
+        self.flush()
+
+    def _claim_spool_files(self):
+        """
+        Claims the spool files which are to be flushed by this process, i.e.,
+        the spool file of this process, the spool files of processes which do
+        not exist anymore and the spool files whose flush has failed before;
+        must be called while holding the lock.
+
+        Returns the paths of the claimed spool files.
+        """
+        if not os.path.isdir(settings.STATS_BUFFER_SPOOL_DIR):
+            return []
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            self._spool_unflushed = 0
+        _pid = os.getpid()
+        result = []
+        for _path in sorted(glob.glob(os.path.join(
+                settings.STATS_BUFFER_SPOOL_DIR, 'stats-*'))):
+            _owner = _get_spool_owner(_path)
+            if _owner is None:
+                continue
+            if _owner == _pid:
+                if _path.endswith(FLUSHING_SUFFIX):
+                    # a previous flush of this process has failed
+                    result.append(_path)
+                    continue
+            elif _is_process_alive(_owner):
+                continue
+            self._flush_count += 1
+            _claimed = os.path.join(settings.STATS_BUFFER_SPOOL_DIR,
+                'stats-{0}-{1}{2}'.format(_pid, self._flush_count,
+                                          FLUSHING_SUFFIX))
+            try:
+                # renaming is atomic, so only one process can claim a file
+                os.rename(_path, _claimed)
+            except OSError:
+                continue
+            result.append(_claimed)
+        return result
+
+    def _flush_spool_file(self, path, save_stats_events):
+        """
+        Writes the statistics events of the given spool file to the database
+        and removes the spool file afterwards. If the events cannot be saved,
+        the spool file is kept and retried with the next flush.
+        """
+        _events = []
+        with open(path) as _file:
+            for _number, _line in enumerate(_file, 1):
+                if not _line.strip():
+                    continue
+                try:
+                    _events.append(json.loads(_line))
+                except ValueError:
+                    # a crashed process may have written its last event only
+                    # partially
+                    LOGGER.error('Skipping the corrupt line {0} of the '
+                                 'statistics spool file {1}.'
+                                 .format(_number, path))
+        _batch_size = settings.STATS_BUFFER_BATCH_SIZE
+        try:
+            with db.transaction.atomic():
+                for i in range(0, len(_events), _batch_size):
+                    save_stats_events(_events[i:i + _batch_size])
+        except:
+            LOGGER.error('Could not save the statistics events of {0}.'
+                         .format(path), exc_info=True)
+            return
+        os.remove(path)
+
+    def _ensure_worker(self):
+        """
+        Starts the background worker thread if it is not running in this
+        process, yet; must be called while holding the lock.
+        """
+        if self._pid != os.getpid():
+            # a forked process does not inherit the worker thread, nor should
+            # it flush the events buffered by its parent
+            self._pid = os.getpid()
+            self._pending = []
+            self._pending_count = 0
+            self._spool = None
+            self._spool_unflushed = 0
+            self._worker = None
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run,
+                                            name='stats-buffer')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        """
+        The main loop of the background worker thread.
+        """
+        while not self._stopped:
+            self._wakeup.wait(settings.STATS_BUFFER_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except:
+                LOGGER.error('Could not save the statistics.', exc_info=True)
+            finally:
+                # the worker must not keep a database connection open between
+                # two flushes
+                db.connection.close()
+
+
+def _get_spool_path(pid):
+    """
+    Returns the path of the spool file of the process with the given id.
+    """
+    return os.path.join(settings.STATS_BUFFER_SPOOL_DIR,
+                        'stats-{0}{1}'.format(pid, SPOOL_SUFFIX))
+
+
+def _get_spool_owner(path):
+    """
+    Returns the id of the process which owns the given spool file or `None` if
+    the file is no spool file.
+    """
+    _name = os.path.basename(path)
+    if not _name.endswith(SPOOL_SUFFIX) and not _name.endswith(FLUSHING_SUFFIX):
+        return None
+    try:
+        return int(_name[len('stats-'):].split('.')[0].split('-')[0])
+    except ValueError:
+        return None
+
+
+def _is_process_alive(pid):
+    """
+    Returns whether a process with the given id exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as problem:
+        # the process may exist, but belong to another user
+        return problem.errno != errno.ESRCH
+    return True
+
+
+# the statistics buffer of this process
+STATS_BUFFER = StatsBuffer()
+
+
+@atexit.register
+def _flush_on_exit():
+    """
+    Writes the statistics events which are still buffered to the database
+    when the process exits.
+    """
+    try:
+        STATS_BUFFER.stop()
+    except:
+        LOGGER.error('Could not save the statistics.', exc_info=True)
@@ -1,19 +1,31 @@
+import errno
+import json
 import logging
+import os
+import shutil
+import tempfile
 import urllib2
 from urllib import urlencode
 import uuid
 from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
-from django.contrib.auth.models import Group, User
-from django.test.client import Client
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.core.management import call_command
+from django.test.client import Client, RequestFactory
 from django.test.testcases import TestCase
 from metashare import test_utils
 from metashare.accounts.models import EditorGroup, EditorGroupManagers
 from metashare.repository.models import resourceInfoType_model
+from metashare import settings
 from metashare.settings import ROOT_PATH, STORAGE_PATH, LOG_HANDLER, DJANGO_BASE, STATS_SERVER_URL, DJANGO_URL
-from metashare.storage.models import INGESTED
+from metashare.storage.models import INGESTED, PUBLISHED
 from metashare.stats.model_utils import update_usage_stats, UsageStats, saveLRStats, getLRLast, getLastQuery, \
-    UPDATE_STAT, VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT
+    saveQueryStats, getLRStats, getLRTop, getTopQueries, rebuild_daily_stats, \
+    UPDATE_STAT, VIEW_STAT, RETRIEVE_STAT, DOWNLOAD_STAT, INGEST_STAT
+from metashare.stats.models import LRStats, QueryStats, LRStatsDaily, QueryStatsDaily
+from metashare.stats import stats_buffer
+from metashare.stats.stats_buffer import STATS_BUFFER, StatsBuffer
 from metashare.stats.views import callServerStats
+from metashare.stats.geoip import GeoIPService, is_privateIP
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -93,6 +105,154 @@ class StatsTest(TestCase):
                 saveLRStats(resource, action)
                 self.assertEqual(len(getLRLast(action, 10)), i+1)
  
+    def test_buffered_stats_actions(self):
+        """
+        Tests that buffered statistics events are aggregated and saved when
+        the statistics buffer is flushed.
+        """
+        _settings = (settings.STATS_BUFFER_ENABLED,
+            settings.STATS_BUFFER_FLUSH_INTERVAL, settings.STATS_BUFFER_LOSSLESS,
+            settings.STATS_BUFFER_SPOOL_DIR,
+            settings.STATS_BUFFER_SPOOL_FLUSH_SIZE)
+        settings.STATS_BUFFER_ENABLED = True
+        settings.STATS_BUFFER_FLUSH_INTERVAL = 3600
+        settings.STATS_BUFFER_SPOOL_DIR = tempfile.mkdtemp()
+        try:
+            resource = resourceInfoType_model.objects.all()[0]
+            resource.storage_object.publication_status = PUBLISHED
+            resource.storage_object.save()
+            for _ in range(3):
+                self.assertFalse(saveLRStats(resource, VIEW_STAT))
+                saveQueryStats('italian', '', 1)
+            self.assertEqual(LRStats.objects.count(), 0)
+            self.assertEqual(QueryStats.objects.count(), 0)
+            STATS_BUFFER.flush()
+            # repeated actions of the same session are only counted once
+            self.assertEqual(len(getLRLast(VIEW_STAT, 10)), 1)
+            self.assertEqual(QueryStats.objects.filter(query='italian')
+                             .count(), 3)
+
+            # in lossless mode, buffered events survive the loss of the buffer
+            # once the spool file has been flushed
+            settings.STATS_BUFFER_LOSSLESS = True
+            settings.STATS_BUFFER_SPOOL_FLUSH_SIZE = 2
+            self.assertFalse(saveLRStats(resource, DOWNLOAD_STAT))
+            saveQueryStats('spooled', '', 1)
+            self.assertEqual(len(getLRLast(DOWNLOAD_STAT, 10)), 0)
+            StatsBuffer().flush()
+            self.assertEqual(len(getLRLast(DOWNLOAD_STAT, 10)), 1)
+            STATS_BUFFER.flush()
+            self.assertEqual(len(getLRLast(DOWNLOAD_STAT, 10)), 1)
+            self.assertEqual(QueryStats.objects.filter(query='spooled')
+                             .count(), 1)
+
+            # a partially written last event of a crashed process is skipped
+            saveQueryStats('crashed', '', 1)
+            saveQueryStats('crashed', '', 1)
+            _spool_files = os.listdir(settings.STATS_BUFFER_SPOOL_DIR)
+            self.assertEqual(1, len(_spool_files))
+            with open(os.path.join(settings.STATS_BUFFER_SPOOL_DIR,
+                                   _spool_files[0]), 'a') as _spool:
+                _spool.write('["query", "cras')
+            StatsBuffer().flush()
+            STATS_BUFFER.flush()
+            self.assertEqual(QueryStats.objects.filter(query='crashed')
+                             .count(), 2)
+            self.assertEqual([], os.listdir(settings.STATS_BUFFER_SPOOL_DIR))
+        finally:
+            shutil.rmtree(settings.STATS_BUFFER_SPOOL_DIR)
+            settings.STATS_BUFFER_ENABLED, \
+                settings.STATS_BUFFER_FLUSH_INTERVAL, \
+                settings.STATS_BUFFER_LOSSLESS, \
+                settings.STATS_BUFFER_SPOOL_DIR, \
+                settings.STATS_BUFFER_SPOOL_FLUSH_SIZE = _settings
+
+    def test_spool_owner_liveness(self):
+        """
+        Tests that the spool file of a process is only taken over if the
+        process does not exist anymore, even if it belongs to another user.
+        """
+        self.assertTrue(stats_buffer._is_process_alive(os.getpid()))
+        _kill = stats_buffer.os.kill
+        for _errno, _alive in ((errno.EPERM, True), (errno.ESRCH, False)):
+            def _failing_kill(pid, sig):
+                raise OSError(_errno, os.strerror(_errno))
+            stats_buffer.os.kill = _failing_kill
+            try:
+                self.assertEqual(_alive, stats_buffer._is_process_alive(1))
+            finally:
+                stats_buffer.os.kill = _kill
+
+    def test_daily_stats_rollup(self):
+        """
+        Tests that the daily statistics rollups are maintained along with the
+        raw statistics records.
+        """
+        resource = resourceInfoType_model.objects.all()[0]
+        lrid = resource.storage_object.identifier
+        resource.storage_object.publication_status = PUBLISHED
+        resource.storage_object.save()
+        LRStats.objects.all().delete()
+        LRStatsDaily.objects.all().delete()
+        for sessid in ('s1', 's2', 's2'):
+            request = RequestFactory().get('/')
+            request.COOKIES['sessionid'] = sessid
+            request.user = AnonymousUser()
+            saveLRStats(resource, VIEW_STAT, request)
+            saveQueryStats('italian', '', 1, 5, request)
+        self.assertEqual(LRStats.objects.filter(action=VIEW_STAT).count(), 2)
+        self.assertEqual([item['count'] for item in getLRStats(lrid)
+                          if item['action'] == 'view'], ['2'])
+        self.assertEqual(list(getLRTop(VIEW_STAT, 10)),
+                         [{'lrid': lrid, 'sum_count': 2}])
+        self.assertEqual([(item['query'], item['query_count'])
+                          for item in getTopQueries(10)], [('italian', 3)])
+
+        # the rollups can be rebuilt from the raw records
+        _rows = sorted(LRStatsDaily.objects.values_list('lrid', 'action',
+            'geoinfo', 'day', 'records', 'count'))
+        _query_rows = list(QueryStatsDaily.objects.values_list('query',
+            'day', 'count', 'exectime_total'))
+        rebuild_daily_stats()
+        self.assertEqual(sorted(LRStatsDaily.objects.values_list('lrid',
+            'action', 'geoinfo', 'day', 'records', 'count')), _rows)
+        self.assertEqual(list(QueryStatsDaily.objects.values_list('query',
+            'day', 'count', 'exectime_total')), _query_rows)
+
+        # the node statistics of a day are also available for a month
+        client = Client()
+        client.login(username='su', password='supwd')
+        for _date in (_query_rows[0][1].isoformat(),
+                      _query_rows[0][1].strftime('%Y-%m')):
+            response = client.get('/{0}stats/get/?date={1}'.format(
+                DJANGO_BASE, _date))
+            self.assertEquals(200, response.status_code)
+            self.assertEqual(3, json.loads(response.content)[0]['queries'])
+
+        # the actions before an ingestion are ignored
+        saveLRStats(resource, INGEST_STAT)
+        self.assertEqual(getLRStats(lrid), [])
+        self.assertEqual(len(getLRTop(VIEW_STAT, 10)), 0)
+
+    def test_rebuild_usage_stats(self):
+        """
+        Tests that the usage statistics rebuild command replaces the usage
+        statistics of the published resources and removes all others.
+        """
+        resource = resourceInfoType_model.objects.all()[0]
+        lrid = resource.storage_object.identifier
+        resource.storage_object.publication_status = PUBLISHED
+        resource.storage_object.save()
+        update_usage_stats(lrid, resource.export_to_elementtree())
+        _expected = sorted(UsageStats.objects.filter(lrid=lrid)
+            .values_list('elparent', 'elname', 'text', 'count'))
+        self.assertTrue(_expected)
+        UsageStats.objects.create(lrid=lrid, elname='stale')
+        UsageStats.objects.create(lrid='unpublished', elname='stale')
+        call_command('rebuild_usage_stats', workers=1, verbosity=0)
+        self.assertEqual(sorted(UsageStats.objects
+            .values_list('elparent', 'elname', 'text', 'count')), _expected)
+
     def test_visiting_stats(self):
         """
         Tries to load the visiting stats page of the ELRI website.
@@ -288,3 +448,47 @@ class StatsTest(TestCase):
         response = client.get('/{0}stats/usage/'.format(DJANGO_BASE))
         self.assertContains(response, "Metadata usage in 2 resources")
 
+
+class GeoIPTest(TestCase):
+    """
+    Tests the GeoIP service.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'GeoIP.dat')
+        shutil.copy(settings.GEOIP_DATA_FILE, self.db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_private_addresses(self):
+        for ipaddress in ('10.1.2.3', '127.0.0.1', '172.16.0.1',
+                          '172.31.255.255', '192.168.1.1', '169.254.0.1',
+                          '::1', 'fe80::1', 'fd00::1', '::ffff:10.0.0.1'):
+            self.assertTrue(is_privateIP(ipaddress), ipaddress)
+        for ipaddress in ('193.254.26.9', '172.15.0.1', '172.32.0.1',
+                          '2001:4860:4860::8888', '::ffff:193.254.26.9',
+                          'no address', ''):
+            self.assertFalse(is_privateIP(ipaddress), ipaddress)
+
+    def test_lookup(self):
+        service = GeoIPService(self.db_file, 2, 0)
+        self.assertEqual(service.get_country_code('193.254.26.9'), 'IT')
+        self.assertEqual(service.get_country_code('::ffff:193.254.26.9'), 'IT')
+        self.assertEqual(service.get_country_code('192.168.1.1'), '')
+        self.assertEqual(service.get_country_code('no address'), '')
+        # the least recently used address is evicted from the cache
+        service.get_country_code('8.8.8.8')
+        service.get_country_code('193.254.26.9')
+        service.get_country_code('80.1.1.1')
+        self.assertEqual(list(service._cache), ['193.254.26.9', '80.1.1.1'])
+
+    def test_reload(self):
+        service = GeoIPService(self.db_file, 10, 0)
+        self.assertEqual(service.get_country_code('193.254.26.9'), 'IT')
+        # a replaced database file is loaded again
+        shutil.copy(settings.GEOIP_DATA_FILE, self.db_file + '.tmp')
+        os.rename(self.db_file + '.tmp', self.db_file)
+        _reader = service._reader
+        self.assertEqual(service.get_country_code('193.254.26.9'), 'IT')
+        self.assertIsNot(service._reader, _reader)
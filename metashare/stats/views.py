@@ -4,7 +4,8 @@ import uuid
 from metashare.settings import DJANGO_URL, STATS_SERVER_URL, METASHARE_VERSION, STORAGE_PATH
 from metashare.repository.models import resourceInfoType_model
 from metashare.storage.models import PUBLISHED
-from metashare.stats.models import LRStats, QueryStats, UsageStats
+from metashare.stats.models import LRStats, QueryStats, UsageStats, \
+    LRStatsDaily, QueryStatsDaily
 from django.contrib.auth.decorators import user_passes_test
 # pylint: disable-msg=W0611, W0401
 from metashare.stats.model_utils import *
@@ -15,7 +16,7 @@ from metashare.repository.models import *
 from django.utils.importlib import import_module
 import django.utils.encoding
 from django.shortcuts import render_to_response
-from django.db.models import Count, Max, Min, Avg
+from django.db.models import Count, Sum
 from django.http import HttpResponse
 from django.template import RequestContext
 from django.core.paginator import Paginator
@@ -399,12 +400,15 @@ def getstats(request):
         storage_object__deleted=False).count()
     data['lrmastercount'] = StorageObject.objects.filter(copy_status=MASTER, publication_status=PUBLISHED,
                                                          deleted=False).count()
-    data['lrupdate'] = LRStats.objects.filter(lasttime__startswith=currdate, action=UPDATE_STAT).count()
-    data['lrview'] = LRStats.objects.filter(lasttime__startswith=currdate, action=VIEW_STAT).count()
-    data['lrdown'] = LRStats.objects.filter(lasttime__startswith=currdate, action=DOWNLOAD_STAT).count()
-    data['queries'] = QueryStats.objects.filter(lasttime__startswith=currdate).count()
-    extimes = QueryStats.objects.filter(lasttime__startswith=currdate).aggregate(Avg('exectime'), Max('exectime'),
-                                                                                 Min('exectime'))
+    actions = dict(LRStatsDaily.objects.filter(day__startswith=currdate).values_list('action').annotate(Sum('records')))
+    data['lrupdate'] = actions.get(UPDATE_STAT, 0)
+    data['lrview'] = actions.get(VIEW_STAT, 0)
+    data['lrdown'] = actions.get(DOWNLOAD_STAT, 0)
+    extimes = QueryStatsDaily.objects.filter(day__startswith=currdate).aggregate(Sum('count'), Sum('exectime_total'))
+    data['queries'] = extimes["count__sum"] or 0
+    extimes["exectime__avg"] = None
+    if data['queries']:
+        extimes["exectime__avg"] = float(extimes["exectime_total__sum"]) / data['queries']
 
     qltavg = 0
     if (extimes["exectime__avg"]):
@@ -454,8 +458,9 @@ def getstats(request):
         lrstats = {}
         resources = resourceInfoType_model.objects \
             .filter(storage_object__publication_status=PUBLISHED, storage_object__deleted=False)
-        for resource in resources:
-            lrstats[resource.storage_object.identifier] = getLRStats(resource.storage_object.identifier)
+        all_lrstats = getAllLRStats()
+        for lrid in resources.values_list('storage_object__identifier', flat=True):
+            lrstats[lrid] = all_lrstats.get(lrid, [])
         data["lrstats"] = lrstats
 
     return HttpResponse("[" + json.dumps(data) + "]", content_type="application/json")
@@ -0,0 +1,159 @@
+"""
+A runner for maintenance tasks on many storage objects.
+
+The storage objects are processed in chunks which are distributed to a pool
+of worker processes. The storage is only locked while a single storage object
+is processed so that the maintenance can run alongside the normal operation of
+the node.
+"""
+import logging
+from datetime import datetime
+from optparse import make_option
+
+from django import db
+from django.core.management.base import CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+
+from metashare import settings
+from metashare.settings import LOG_HANDLER
+from metashare.storage.models import StorageObject
+from metashare.utils import Lock, WorkerPool
+
+# Setup logging support.
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(LOG_HANDLER)
+
+# command line options shared by the storage maintenance commands
+MAINTENANCE_OPTIONS = (
+    make_option('-s', '--since', action='store', dest='since', default=None,
+                help='only process storage objects whose digest was last '
+                'checked at or after this date (YYYY-MM-DD[ HH:MM[:SS]])'),
+    make_option('-n', '--dry-run', action='store_true', dest='dry_run',
+                default=False, help='only report what would be done'),
+    make_option('-w', '--workers', action='store', dest='workers',
+                type='int', default=None, help='number of worker processes; '
+                'defaults to MAINTENANCE_WORKERS'),
+)
+
+
+def get_maintenance_arguments(command, options):
+    """
+    Returns the keyword arguments for a maintenance function from the given
+    options of the given management command.
+
+    Raises CommandError if the options are invalid.
+    """
+    since = options.get('since')
+    if since:
+        try:
+            _since = parse_datetime(since)
+            if _since is None:
+                _date = parse_date(since)
+                if _date is not None:
+                    _since = datetime.combine(_date, datetime.min.time())
+        except ValueError:
+            _since = None
+        if _since is None:
+            raise CommandError('Invalid date for --since: {0}'.format(since))
+        since = _since
+    workers = options.get('workers')
+    if workers is not None and workers < 1:
+        raise CommandError('The number of workers must be positive.')
+
+    def _progress(processed, total):
+        if int(options.get('verbosity', 1)) >= 1:
+            command.stdout.write('{0} of {1} storage objects processed'
+                                 .format(processed, total))
+
+    return {'since': since, 'dry_run': options.get('dry_run', False),
+            'workers': workers, 'progress': _progress}
+
+
+def run_maintenance(task, object_ids, workers=None, chunk_size=None,
+                    dry_run=False, progress=None, failures=None):
+    """
+    Runs the given task for the storage objects with the given ids.
+
+    `task` is a module level function which is called with a storage object
+    and the dry run flag and which returns whether it changed (or, in a dry
+    run, would have changed) anything. Any exception of the task is logged and
+    the storage object is counted as failed.
+
+    `workers` is the number of worker processes and `chunk_size` the number of
+    storage objects which are handed to a worker at once; they default to the
+    MAINTENANCE_WORKERS and MAINTENANCE_CHUNK_SIZE settings. With a single
+    worker, the storage objects are processed in the current process.
+
+    `progress` is an optional callable which is called after each chunk with
+    the number of processed storage objects and the total number.
+
+    `failures` is an optional list to which the ids of the failed storage
+    objects are appended.
+
+    Returns a triple of the number of processed, changed and failed storage
+    objects.
+    """
+    if workers is None:
+        workers = settings.MAINTENANCE_WORKERS
+    if chunk_size is None:
+        chunk_size = settings.MAINTENANCE_CHUNK_SIZE
+    object_ids = list(object_ids)
+    total = len(object_ids)
+    chunks = [(task, object_ids[i:i + chunk_size], dry_run)
+              for i in range(0, total, chunk_size)]
+
+    processed = changed = failed = 0
+    pool = None
+    if workers > 1 and len(chunks) > 1:
+        # the worker processes must not share the database connections of
+        # this process, so close them before forking; each worker will open
+        # its own connection
+        for _conn in db.connections.all():
+            _conn.close()
+        pool = WorkerPool(processes=workers)
+        results = pool.imap_unordered(_process_chunk, chunks)
+    else:
+        results = (_process_chunk(chunk) for chunk in chunks)
+    try:
+        for _processed, _changed, _failed in results:
+            processed += _processed
+            changed += _changed
+            failed += len(_failed)
+            if failures is not None:
+                failures.extend(_failed)
+            LOGGER.info('{0}: processed {1} of {2} storage objects'.format(
+              task.__name__, processed, total))
+            if progress:
+                progress(processed, total)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return processed, changed, failed
+
+
+def _process_chunk(args):
+    """
+    Runs a maintenance task for a chunk of storage object ids.
+
+    Returns a triple of the number of processed and changed storage objects
+    and the list of the ids of the failed storage objects.
+    """
+    task, object_ids, dry_run = args
+    changed = 0
+    failed = []
+    lock = Lock('storage')
+    for _so in StorageObject.objects.filter(pk__in=object_ids):
+        if not dry_run:
+            lock.acquire()
+        try:
+            if task(_so, dry_run):
+                changed += 1
+        except:
+            LOGGER.error('{0} failed for storage object {1}'.format(
+              task.__name__, _so.identifier), exc_info=True)
+            failed.append(_so.pk)
+        finally:
+            if not dry_run:
+                lock.release()
+    return len(object_ids), changed, failed
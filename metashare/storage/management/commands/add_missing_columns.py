@@ -0,0 +1,40 @@
+"""
+Management utility to add the columns of model fields which are missing in
+the existing database tables, e.g., after an upgrade which added fields to
+models whose tables have been created before.
+"""
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+class Command(BaseCommand):
+
+    help = 'Adds the columns of model fields which are missing in the ' \
+        'existing database tables'
+
+    def handle(self, *args, **options):
+        """
+        Adds the missing columns.
+        """
+        _tables = set(connection.introspection.table_names())
+        _added = 0
+        with connection.schema_editor() as editor:
+            for model in apps.get_models():
+                _meta = model._meta
+                # tables which do not exist at all are created by migrate
+                if not _meta.managed or _meta.proxy or _meta.swapped \
+                        or not _meta.db_table in _tables:
+                    continue
+                with connection.cursor() as cursor:
+                    _columns = set(_column[0] for _column in connection
+                        .introspection.get_table_description(cursor,
+                                                             _meta.db_table))
+                for _field in _meta.local_fields:
+                    if _field.column and not _field.column in _columns:
+                        if int(options['verbosity']) >= 1:
+                            self.stdout.write('Adding column {0}.{1}'.format(
+                              _meta.db_table, _field.column))
+                        editor.add_field(model, _field)
+                        _added += 1
+        self.stdout.write('{0} columns added'.format(_added))
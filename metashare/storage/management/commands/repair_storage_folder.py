@@ -4,22 +4,24 @@ of all files. Superfluous files are deleted."
 """
 from django.core.management.base import BaseCommand
 
+from metashare.storage.maintenance import MAINTENANCE_OPTIONS, \
+    get_maintenance_arguments
 from metashare.storage.models import repair_storage_folder
-from metashare.utils import Lock
 
 
 class Command(BaseCommand):
     
+    option_list = BaseCommand.option_list + MAINTENANCE_OPTIONS
+
     help = 'Repair content of storage folder by forcing the recreation of all ' + \
       'files. Superfluous files are deleted.'
     
     def handle(self, *args, **options):
-        try:
-            # before starting to repair the storage folder, make sure to lock
-            # the storage so that any other processes with heavy/frequent
-            # operations on the storage don't get in our way
-            lock = Lock('storage')
-            lock.acquire()
-            repair_storage_folder()
-        finally:
-            lock.release()
+        # the storage is locked by the maintenance workers for each single
+        # storage object so that any other processes with heavy/frequent
+        # operations on the storage are not blocked for the whole run
+        _count = repair_storage_folder(**get_maintenance_arguments(self, options))
+        if options['dry_run']:
+            self.stdout.write('{0} storage objects would be repaired'.format(_count))
+        else:
+            self.stdout.write('{0} storage objects repaired'.format(_count))
@@ -4,21 +4,23 @@ is set.
 """
 from django.core.management.base import BaseCommand
 
+from metashare.storage.maintenance import MAINTENANCE_OPTIONS, \
+    get_maintenance_arguments
 from metashare.storage.models import repair_storage_objects
-from metashare.utils import Lock
 
 
 class Command(BaseCommand):
     
+    option_list = BaseCommand.option_list + MAINTENANCE_OPTIONS
+
     help = 'Remove storage objects for which no resource is set.'
     
     def handle(self, *args, **options):
-        try:
-            # before starting to remove the storage objects, make sure to lock
-            # the storage so that any other processes with heavy/frequent
-            # operations on the storage don't get in our way
-            lock = Lock('storage')
-            lock.acquire()
-            repair_storage_objects()
-        finally:
-            lock.release()
+        # the storage is locked by the maintenance workers for each single
+        # storage object so that any other processes with heavy/frequent
+        # operations on the storage are not blocked for the whole run
+        _count = repair_storage_objects(**get_maintenance_arguments(self, options))
+        if options['dry_run']:
+            self.stdout.write('{0} storage objects would be removed'.format(_count))
+        else:
+            self.stdout.write('{0} storage objects removed'.format(_count))
@@ -2,23 +2,25 @@
 Management utility to trigger digest updating.
 """
 from django.core.management.base import BaseCommand
+from metashare.storage.maintenance import MAINTENANCE_OPTIONS, \
+    get_maintenance_arguments
 from metashare.storage.models import update_digests
-from metashare.utils import Lock
 
 class Command(BaseCommand):
     
+    option_list = BaseCommand.option_list + MAINTENANCE_OPTIONS
+
     help = 'Updates the resource digests if they are older than MAX_DIGEST_AGE / 2 seconds'
     
     def handle(self, *args, **options):
         """
         Update digests.
         """
-        try:
-            # before starting the digest updating, make sure to lock the storage
-            # so that any other processes with heavy/frequent operations on the
-            # storage don't get in our way
-            lock = Lock('storage')
-            lock.acquire()
-            update_digests()
-        finally:
-            lock.release()
\ No newline at end of file
+        # the storage is locked by the maintenance workers for each single
+        # storage object so that any other processes with heavy/frequent
+        # operations on the storage are not blocked for the whole run
+        _count = update_digests(**get_maintenance_arguments(self, options))
+        if options['dry_run']:
+            self.stdout.write('{0} digests would be updated'.format(_count))
+        else:
+            self.stdout.write('{0} digests updated'.format(_count))
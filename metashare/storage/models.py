@@ -9,18 +9,24 @@ from hashlib import md5
 from json import dumps, loads
 from os import mkdir
 from os.path import exists
+from StringIO import StringIO
+from tempfile import mkstemp
 from uuid import uuid1, uuid4
 from xml.etree import ElementTree as etree
 from zipfile import ZIP_DEFLATED
 
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Max, Min
 from django.db.models.query_utils import Q
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
 from metashare.settings import LOG_HANDLER
 from metashare import settings
+from metashare.utils import Lock
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -32,6 +38,11 @@ ALLOWED_LEGAL_DOCUMENTATION_EXTENSIONS = ('zip',)
 MAXIMUM_MD5_BLOCK_SIZE = 1024
 XML_DECL = re.compile(r'\s*<\?xml version=".+" encoding=".+"\?>\s*\n?',
                       re.I | re.S | re.U)
+# file names of the digest zip-archives and of the metadata XML revisions in
+# a storage folder
+DIGEST_ARCHIVE_NAME = 'digest-{0}.zip'
+METADATA_REVISION_NAME = 'metadata-{0:04d}.xml'
+METADATA_REVISION_REGEXP = re.compile(r'^metadata-(\d+)\.xml$')
 
 # Publication status constants and choice:
 INTERNAL = 'i'
@@ -65,6 +76,14 @@ GLOBAL_STORAGE_ATTS = ['source_url', 'identifier', 'created', 'modified',
 LOCAL_STORAGE_ATTS = ['digest_checksum', 'digest_modified',
                       'digest_last_checked', 'copy_status', 'source_node']
 
+# the fields on which the synchronization inventory state of a storage object
+# depends, see StorageObject.get_inventory_state()
+INVENTORY_STATE_FIELDS = ('copy_status', 'publication_status',
+                          'digest_checksum')
+
+# marks a synchronization inventory state which has not been looked up yet
+_UNKNOWN_INVENTORY_STATE = object()
+
 
 def _validate_valid_xml(value):
     """
@@ -87,6 +106,17 @@ def _validate_valid_xml(value):
         raise ValidationError(error)
 
 
+def _get_inventory_state(copy_status, publication_status, digest_checksum):
+    """
+    Returns the digest checksum under which a storage object with the given
+    field values is listed in the synchronization inventory or None if it is
+    not listed at all.
+    """
+    if copy_status in (MASTER, PROXY) and publication_status != INTERNAL:
+        return digest_checksum
+    return None
+
+
 def _create_uuid():
     """
     Creates a unique id from a UUID-1 and a UUID-4, checks for collisions.
@@ -211,17 +241,64 @@ class StorageObject(models.Model):
                                      help_text=_("text containing the JSON serialization of local attributes " \
                                                "for this storage object instance."))
 
+    metadata_dirty = models.BooleanField(default=True, editable=False,
+      help_text=_("(Read-only) whether the metadata of the resource may have " \
+                  "been changed since the metadata XML was last checked."))
+
+    def __init__(self, *args, **kwargs):
+        super(StorageObject, self).__init__(*args, **kwargs)
+        # remember the state in which this instance was last seen by the sync
+        # inventory so that changes to it can be recorded in the change log;
+        # if any of the fields it depends on has been deferred, it is only
+        # looked up when it is needed, see _get_saved_inventory_state()
+        if not self.pk:
+            self._inventory_state = None
+        elif all(_field in self.__dict__ for _field in INVENTORY_STATE_FIELDS):
+            self._inventory_state = self.get_inventory_state()
+        else:
+            self._inventory_state = _UNKNOWN_INVENTORY_STATE
+
+    def get_inventory_state(self):
+        """
+        Returns the digest checksum under which this storage object is listed
+        in the synchronization inventory or None if it is not listed at all.
+        """
+        return _get_inventory_state(self.copy_status, self.publication_status,
+                                    self.digest_checksum)
+
+    def _get_saved_inventory_state(self):
+        """
+        Returns the inventory state of this storage object as it was when it
+        was loaded or last saved.
+        """
+        if self._inventory_state is _UNKNOWN_INVENTORY_STATE:
+            _saved = StorageObject.objects.filter(pk=self.pk) \
+                .values_list(*INVENTORY_STATE_FIELDS)[:1]
+            self._inventory_state = _get_inventory_state(*_saved[0]) \
+                if _saved else None
+        return self._inventory_state
+
     def get_digest_checksum(self):
         """
         Checks if the current digest is till up-to-date, recreates it if
         required, and return the up-to-date digest checksum.
         """
-        _expiration_date = _get_expiration_date()
-        if _expiration_date > self.digest_modified \
-                and _expiration_date > self.digest_last_checked:
+        if self.is_digest_expired():
             self.update_storage()
         return self.digest_checksum
 
+    def is_digest_expired(self):
+        """
+        Returns True if the digest is older than MAX_DIGEST_AGE / 2 and has to
+        be checked again, see get_expired_digest_query(); this is always the
+        case if it has never been created or checked.
+        """
+        _expiration_date = _get_expiration_date()
+        return (self.digest_modified is None
+                or self.digest_modified < _expiration_date) \
+            and (self.digest_last_checked is None
+                 or self.digest_last_checked < _expiration_date)
+
     def __unicode__(self):
         """
         Returns the Unicode representation for this storage object instance.
@@ -234,6 +311,29 @@ class StorageObject(models.Model):
         """
         return '{0}/{1}'.format(settings.STORAGE_PATH, self.identifier)
 
+    def _digest_archive_path(self):
+        """
+        Returns the path to the digest zip-archive with the current digest
+        checksum of this storage object instance.
+        """
+        return os.path.join(self._storage_folder(),
+                            DIGEST_ARCHIVE_NAME.format(self.digest_checksum))
+
+    def get_digest_archive(self):
+        """
+        Returns the path to the current digest zip-archive of this storage
+        object instance, recreating the archive if it is missing.
+        """
+        _path = self._digest_archive_path()
+        if not os.path.isfile(_path):
+            if self.digest_checksum and self.digest_checksum == \
+                    compute_digest_checksum(self.metadata, self.global_storage):
+                self._write_digest_archive()
+            else:
+                self.update_storage(force_digest=True)
+                _path = self._digest_archive_path()
+        return _path
+
     def compute_checksum(self):
         """
         Computes the MD5 hash checksum for the binary archive which may be
@@ -308,8 +408,24 @@ class StorageObject(models.Model):
         self.full_clean()
         if not self.identifier:
             self.identifier = _create_uuid()
+        if not self._state.adding and not args \
+                and kwargs.get('update_fields') is None \
+                and not kwargs.get('force_insert'):
+            # the metadata dirty flag is only changed by mark_metadata_dirty()
+            # and update_storage() so that concurrent changes of the metadata
+            # are never lost
+            kwargs['update_fields'] = [_field.name
+              for _field in self._meta.local_fields
+              if not _field.primary_key and _field.name != 'metadata_dirty'
+                and _field.attname in self.__dict__]
         # Call save() method from super class with all arguments.
         super(StorageObject, self).save(*args, **kwargs)
+        # record any change that is visible in the synchronization inventory
+        _state = self.get_inventory_state()
+        if _state != self._get_saved_inventory_state():
+            InventoryChange.objects.create(identifier=self.identifier,
+                digest_checksum=_state, deleted=_state is None)
+            self._inventory_state = _state
 
     def update_storage(self, force_digest=False):
         """
@@ -339,8 +455,20 @@ class StorageObject(models.Model):
 
         self.digest_last_checked = datetime.now()
 
-        # check metadata serialization
-        metadata_updated = self.check_metadata()
+        # check metadata serialization; this is only required if any metadata
+        # of the resource has been changed since the last check; the dirty
+        # flag is cleared before the check so that concurrent changes set it
+        # again
+        if StorageObject.objects.filter(pk=self.pk, metadata_dirty=True) \
+                .update(metadata_dirty=False) or not self.metadata:
+            try:
+                metadata_updated = self.check_metadata()
+            except:
+                mark_metadata_dirty(StorageObject.objects.filter(pk=self.pk))
+                raise
+        else:
+            metadata_updated = False
+        self.metadata_dirty = False
 
         # check global storage object serialization
         global_updated = self.check_global_storage_object()
@@ -355,8 +483,7 @@ class StorageObject(models.Model):
         # save storage object if required; this should always happen since
         # at least self.digest_last_checked in the local storage object 
         # has changed
-        if source_url_updated or metadata_updated \
-                or local_updated:
+        if source_url_updated or metadata_updated or local_updated:
             self.save()
 
     def check_metadata(self):
@@ -401,15 +528,16 @@ class StorageObject(models.Model):
         # the publication status just changed from internal to ingested
         # or if the resource was received when syncing
         if self.publication_status in (INGESTED, PUBLISHED) \
-                and not os.path.isfile(
-                    '{0}/metadata-{1:04d}.xml'.format(self._storage_folder(), self.revision)):
+                and not os.path.isfile(os.path.join(self._storage_folder(),
+                    METADATA_REVISION_NAME.format(self.revision))):
             update_xml = True
 
         if update_xml:
             # serialize metadata
-            with open('{0}/metadata-{1:04d}.xml'.format(
-                    self._storage_folder(), self.revision), 'wb') as _out:
-                _out.write(unicode(self.metadata).encode('ASCII'))
+            _write_atomically(os.path.join(self._storage_folder(),
+                                           METADATA_REVISION_NAME.format(self.revision)),
+                              unicode(self.metadata).encode('ASCII'))
+            _remove_old_metadata_revisions(self._storage_folder())
 
         return update_xml
 
@@ -429,9 +557,9 @@ class StorageObject(models.Model):
         if self.global_storage != _global_storage:
             self.global_storage = _global_storage
             if self.publication_status in (INGESTED, PUBLISHED, PROCESSING, ERROR):
-                with open('{0}/storage-global.json'.format(
-                        self._storage_folder()), 'wb') as _out:
-                    _out.write(unicode(self.global_storage).encode('utf-8'))
+                _write_atomically('{0}/storage-global.json'.format(
+                        self._storage_folder()),
+                    unicode(self.global_storage).encode('utf-8'))
                 return True
 
         return False
@@ -439,26 +567,35 @@ class StorageObject(models.Model):
     def create_digest(self):
         """
         Creates a new digest zip-archive for master and proxy copies.
+
+        The digest zip-archives are named after their digest checksum, so an
+        archive is only written if there is none for the current content yet.
+        Readers of an older archive are not affected by writing a new one.
         """
 
         if self.copy_status in (MASTER, PROXY):
-            _zf_name = '{0}/resource.zip'.format(self._storage_folder())
-            _zf = zipfile.ZipFile(_zf_name, mode='w', compression=ZIP_DEFLATED)
-            try:
-                _zf.write(
-                    '{0}/metadata-{1:04d}.xml'.format(self._storage_folder(), self.revision),
-                    arcname='metadata.xml')
-                _zf.write(
-                    '{0}/storage-global.json'.format(self._storage_folder()),
-                    arcname='storage-global.json')
-            finally:
-                _zf.close()
             # update zip digest checksum
             self.digest_checksum = \
                 compute_digest_checksum(self.metadata, self.global_storage)
+            if not os.path.isfile(self._digest_archive_path()):
+                self._write_digest_archive()
             # update last modified timestamp
             self.digest_modified = datetime.now()
 
+    def _write_digest_archive(self):
+        """
+        Atomically writes the digest zip-archive for the current metadata and
+        global storage object serialization and removes old archives.
+        """
+        _buffer = StringIO()
+        with zipfile.ZipFile(_buffer, mode='w', compression=ZIP_DEFLATED) as _zf:
+            _zf.writestr('metadata.xml', unicode(self.metadata).encode('ASCII'))
+            _zf.writestr('storage-global.json',
+                         unicode(self.global_storage).encode('utf-8'))
+        _write_atomically(self._digest_archive_path(), _buffer.getvalue())
+        _remove_old_digest_archives(self._storage_folder(),
+                                    self._digest_archive_path())
+
     def check_local_storage_object(self):
         """
         Checks if the local storage object serialization has changed. If yes,
@@ -475,14 +612,127 @@ class StorageObject(models.Model):
         if self.local_storage != _local_storage:
             self.local_storage = _local_storage
             if self.publication_status in (INGESTED, PUBLISHED):
-                with open('{0}/storage-local.json'.format(
-                        self._storage_folder()), 'wb') as _out:
-                    _out.write(unicode(self.local_storage).encode('utf-8'))
+                _write_atomically('{0}/storage-local.json'.format(
+                        self._storage_folder()),
+                    unicode(self.local_storage).encode('utf-8'))
                 return True
 
         return False
 
 
+class InventoryChange(models.Model):
+    """
+    Models an entry in the change log of the synchronization inventory.
+
+    Each change of the inventory state of a storage object (a new digest,
+    becoming (un)available for synchronization, or a deletion) is recorded
+    with an increasing sequence number so that other nodes can ask for all
+    changes since a sequence number they have already seen.
+
+    The sequence number is not assigned when a change is recorded but when it
+    is first seen committed by get_inventory_sequence(); unlike the primary
+    key, it hence never falls below the sequence number of a change which
+    has been committed earlier.
+    """
+    identifier = models.CharField(max_length=64, db_index=True, editable=False)
+
+    sequence = models.PositiveIntegerField(null=True, blank=True,
+                                           db_index=True, editable=False)
+
+    digest_checksum = models.CharField(blank=True, null=True, max_length=32,
+                                       editable=False)
+
+    deleted = models.BooleanField(default=False, editable=False)
+
+    class Meta:
+        ordering = ('sequence', 'id')
+
+
+@receiver(pre_delete)
+def _record_inventory_deletion(sender, instance, **kwargs):
+    """
+    Records a tombstone in the inventory change log for deleted storage
+    objects that were part of the synchronization inventory.
+
+    The tombstone is written before the storage object is deleted, in the same
+    transaction, as its saved inventory state may still have to be read.  The
+    receiver is not restricted to the StorageObject sender as the signals of
+    instances with deferred fields are sent by a generated subclass.
+    """
+    if isinstance(instance, StorageObject) \
+            and instance._get_saved_inventory_state() is not None:
+        InventoryChange.objects.create(identifier=instance.identifier,
+                                       deleted=True)
+
+
+def get_inventory_sequence():
+    """
+    Assigns sequence numbers to all committed inventory changes which do not
+    have one yet and returns the sequence number of the latest inventory
+    change or 0 if no change has been recorded yet.
+
+    The new sequence numbers are all greater than the ones assigned before,
+    so a change which is committed after a later recorded one has been
+    handed out is never missed by asking for the changes since a sequence
+    number.
+    """
+    lock = Lock('inventory-sequence')
+    lock.acquire()
+    try:
+        with transaction.atomic():
+            _latest = InventoryChange.objects.aggregate(
+                Max('sequence'))['sequence__max'] or 0
+            _first = InventoryChange.objects.filter(sequence__isnull=True) \
+                .aggregate(Min('id'))['id__min']
+            if _first is not None:
+                # keeps the order of the primary keys; changes which are
+                # committed meanwhile with a lower primary key are left for
+                # the next call
+                InventoryChange.objects \
+                    .filter(sequence__isnull=True, id__gte=_first) \
+                    .update(sequence=F('id') + (_latest - _first + 1))
+                _latest = InventoryChange.objects.aggregate(
+                    Max('sequence'))['sequence__max']
+    finally:
+        lock.release()
+    return _latest
+
+
+def mark_metadata_dirty(storage_objects):
+    """
+    Marks the metadata XML of the storage objects in the given queryset as
+    possibly outdated, so that it is not used in place of an export and is
+    checked again by the next update_storage() call.
+    """
+    storage_objects.update(metadata_dirty=True)
+
+
+def get_inventory_changes(since, until):
+    """
+    Returns the changes of the synchronization inventory after sequence number
+    `since` up to and including sequence number `until`.
+
+    The result is a pair of a dictionary of identifiers and digest checksums
+    of added or updated storage objects and a list of identifiers of storage
+    objects which have been deleted or are no longer available for
+    synchronization.
+    """
+    _changed = {}
+    _deleted = set()
+    # later changes of the same storage object overwrite earlier ones
+    for _id, _digest, _del in InventoryChange.objects \
+            .filter(sequence__gt=since, sequence__lte=until) \
+            .order_by('sequence') \
+            .values_list('identifier', 'digest_checksum', 'deleted'):
+        if _del:
+            _changed.pop(_id, None)
+            _deleted.add(_id)
+        else:
+            _deleted.discard(_id)
+            _changed[_id] = _digest
+    return _changed, list(_deleted)
+
+
 def restore_from_folder(storage_id, copy_status=MASTER, \
                         storage_digest=None, source_node=None, force_digest=False):
     """
@@ -670,60 +920,204 @@ def _fill_storage_object(storage_obj, json_file_name):
         return json_string
 
 
-def update_digests():
+def update_digests(since=None, dry_run=False, workers=None, progress=None):
     """
     Re-creates a digest if it is older than MAX_DIGEST_AGE / 2.
     This assumes that this method is called in MAX_DIGEST_AGE / 2 intervals to
     guarantee a maximum digest age of MAX_DIGEST_AGE.
+
+    since (optional): only consider storage objects last checked at or after
+        this date
+    dry_run (optional): if True, only report the storage objects to update
+    workers (optional): the number of worker processes to use
+    progress (optional): a callable which is called with the number of
+        processed storage objects and the total number
+
+    Returns the number of updated storage objects.
     """
+    from metashare.storage.maintenance import run_maintenance
     LOGGER.info('Starting to update digests.')
-    _expiration_date = _get_expiration_date()
-
     # get all master copy storage object of ingested and published resources
-    for _so in StorageObject.objects.filter(
+    # with an expired digest
+    _query = StorageObject.objects.filter(
             Q(copy_status=MASTER),
-                    Q(publication_status=INGESTED) | Q(publication_status=PUBLISHED)):
-        if _expiration_date > _so.digest_modified \
-                and _expiration_date > _so.digest_last_checked:
-            LOGGER.info('updating {}'.format(_so.identifier))
-            _so.update_storage()
-        else:
-            LOGGER.info('{} is up to date'.format(_so.identifier))
-
+                    Q(publication_status=INGESTED) | Q(publication_status=PUBLISHED)) \
+        .filter(get_expired_digest_query())
+    if since:
+        _query = _query.filter(digest_last_checked__gte=since)
+    _updated = run_maintenance(_update_digest, _query.values_list('pk', flat=True),
+      workers=workers, dry_run=dry_run, progress=progress)[1]
     LOGGER.info('Finished updating digests.')
+    return _updated
+
+
+def _update_digest(storage_object, dry_run):
+    """
+    Re-creates the digest of the given storage object if it has expired.
+    """
+    # the digest may have been updated in the meantime by another process
+    if not storage_object.is_digest_expired():
+        LOGGER.info('{} is up to date'.format(storage_object.identifier))
+        return False
+    LOGGER.info('updating {}'.format(storage_object.identifier))
+    if not dry_run:
+        storage_object.update_storage()
+    return True
 
 
-def repair_storage_folder():
+def repair_storage_folder(since=None, dry_run=False, workers=None,
+                          progress=None):
     """
     Repairs the storage folder by forcing the recreation of all files.
     Superfluous files are deleted."
+
+    See update_digests() for the optional arguments.
+
+    Returns the number of repaired storage objects.
     """
-    for _so in StorageObject.objects.all():
-        if _so.publication_status == INTERNAL:
-            # if storage folder is found, delete all files except a possible
-            # binary
-            folder = os.path.join(settings.STORAGE_PATH, _so.identifier)
-            for _file in ('storage-local.json', 'storage-global.json',
-                          'resource.zip', 'metadata.xml', 'metadata-*.xml'):
-                path = os.path.join(folder, _file)
-                for _path in glob.glob(path):
-                    if os.path.exists(_path):
-                        os.remove(_path)
-        else:
-            _so.metadata = None
-            _so.global_storage = None
-            _so.local_storage = None
-            _so.update_storage()
+    from metashare.storage.maintenance import run_maintenance
+    _query = StorageObject.objects.all()
+    if since:
+        _query = _query.filter(digest_last_checked__gte=since)
+    return run_maintenance(_repair_storage_folder,
+      _query.values_list('pk', flat=True), workers=workers, dry_run=dry_run,
+      progress=progress)[1]
 
 
-def repair_storage_objects():
+def _repair_storage_folder(storage_object, dry_run):
+    """
+    Recreates all files of the given storage object in the storage folder.
+    """
+    LOGGER.info('repairing {}'.format(storage_object.identifier))
+    if dry_run:
+        return True
+    if storage_object.publication_status == INTERNAL:
+        # if storage folder is found, delete all files except a possible
+        # binary
+        folder = os.path.join(settings.STORAGE_PATH, storage_object.identifier)
+        for _file in ('storage-local.json', 'storage-global.json',
+                      'resource.zip', DIGEST_ARCHIVE_NAME.format('*'),
+                      'metadata.xml', 'metadata-*.xml'):
+            path = os.path.join(folder, _file)
+            for _path in glob.glob(path):
+                if os.path.exists(_path):
+                    os.remove(_path)
+    else:
+        storage_object.metadata = None
+        storage_object.global_storage = None
+        storage_object.local_storage = None
+        storage_object.update_storage()
+    return True
+
+
+def repair_storage_objects(since=None, dry_run=False, workers=None,
+                           progress=None):
     """
     Removes storage objects for which no resourceinfotype_model is set.
+
+    See update_digests() for the optional arguments.
+
+    Returns the number of removed storage objects.
     """
-    for _so in StorageObject.objects.all():
-        if _so.resourceinfotype_model_set.count() == 0:
-            LOGGER.info('remove storage object {}'.format(_so.identifier))
-            _so.delete()
+    from metashare.storage.maintenance import run_maintenance
+    # find all orphaned storage objects with a single query
+    _query = StorageObject.objects.filter(resourceinfotype_model__isnull=True)
+    if since:
+        _query = _query.filter(digest_last_checked__gte=since)
+    return run_maintenance(_remove_storage_object,
+      _query.values_list('pk', flat=True), workers=workers, dry_run=dry_run,
+      progress=progress)[1]
+
+
+def _remove_storage_object(storage_object, dry_run):
+    """
+    Removes the given storage object unless a resource has been set for it in
+    the meantime.
+    """
+    # pylint: disable-msg=E1101
+    if storage_object.resourceinfotype_model_set.exists():
+        return False
+    LOGGER.info('remove storage object {}'.format(storage_object.identifier))
+    if not dry_run:
+        storage_object.delete()
+    return True
+
+
+def _write_atomically(path, data):
+    """
+    Writes the given data to the file with the given path via a temporary file
+    in the same folder which is then renamed, so that readers of the file
+    never see a partially written file.
+    """
+    _fd, _tmp_path = mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(_fd, 'wb') as _out:
+            _out.write(data)
+        # mkstemp() creates files which are only readable by the owner
+        os.chmod(_tmp_path, 0644)
+        os.rename(_tmp_path, path)
+    except:
+        if os.path.exists(_tmp_path):
+            os.remove(_tmp_path)
+        raise
+
+
+def _remove_old_digest_archives(folder, current_path):
+    """
+    Removes all but the DIGEST_ARCHIVE_RETENTION most recent digest
+    zip-archives from the given storage folder; the current archive is always
+    kept. A legacy `resource.zip` archive is removed as well.
+    """
+    _legacy_path = os.path.join(folder, 'resource.zip')
+    if os.path.isfile(_legacy_path):
+        os.remove(_legacy_path)
+    _archives = sorted(glob.glob(os.path.join(folder, DIGEST_ARCHIVE_NAME.format('*'))),
+                       key=_get_mtime, reverse=True)
+    _keep = max(settings.DIGEST_ARCHIVE_RETENTION, 1)
+    for _path in [_path for _path in _archives if _path != current_path][_keep - 1:]:
+        _remove_silently(_path)
+
+
+def _remove_old_metadata_revisions(folder):
+    """
+    Removes all but the METADATA_REVISION_RETENTION most recent metadata XML
+    revisions from the given storage folder; if the setting is None, all
+    revisions are kept.
+    """
+    if settings.METADATA_REVISION_RETENTION is None:
+        return
+    # the revision numbers are only padded to four digits, so they have to
+    # be compared as numbers
+    _revisions = []
+    for _path in glob.glob(os.path.join(folder, 'metadata-*.xml')):
+        _match = METADATA_REVISION_REGEXP.match(os.path.basename(_path))
+        if _match:
+            _revisions.append((int(_match.group(1)), _path))
+    _revisions.sort(reverse=True)
+    for _, _path in _revisions[max(settings.METADATA_REVISION_RETENTION, 1):]:
+        _remove_silently(_path)
+
+
+def _get_mtime(path):
+    """
+    Returns the modification time of the file with the given path or 0 if the
+    file has been removed in the meantime.
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _remove_silently(path):
+    """
+    Removes the file with the given path, unless it has already been removed
+    by another process.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
 def compute_checksum(infile):
@@ -761,6 +1155,19 @@ class IllegalAccessException(Exception):
     pass
 
 
+def get_expired_digest_query():
+    """
+    Returns a query for all storage objects whose digest is older than
+    MAX_DIGEST_AGE / 2 and has to be checked again, i.e., the storage objects
+    for which `get_digest_checksum()` would update the storage.
+    """
+    _expiration_date = _get_expiration_date()
+    return (Q(digest_modified__isnull=True)
+            | Q(digest_modified__lt=_expiration_date)) \
+        & (Q(digest_last_checked__isnull=True)
+           | Q(digest_last_checked__lt=_expiration_date))
+
+
 def _get_expiration_date():
     """
     Returns the expiration date of a digest based on the maximum age.
@@ -1,16 +1,26 @@
+import glob
 import logging
+import os
+from StringIO import StringIO
+from zipfile import ZipFile
 from time import sleep
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
 from django.test.client import Client
 from django.utils import unittest
 from metashare.storage.models import StorageObject, _validate_valid_xml, \
-    add_or_update_resource, MASTER, REMOTE, PROXY, IllegalAccessException
+    _remove_old_metadata_revisions, \
+    add_or_update_resource, MASTER, REMOTE, PROXY, IllegalAccessException, \
+    update_digests, repair_storage_objects, PUBLISHED, \
+    compute_digest_checksum
 from metashare import settings, test_utils
 from metashare.settings import DJANGO_BASE, LOG_HANDLER
 import json
 from metashare.repository.models import resourceInfoType_model
-from datetime import date
+from datetime import date, datetime
 from metashare.test_utils import set_index_active
+from metashare.utils import WorkerPool
 
 # Setup logging support.
 LOGGER = logging.getLogger(__name__)
@@ -158,6 +168,63 @@ class StorageObjectTestCase(unittest.TestCase):
         storage_object.master_copy = True
         storage_object.save()
 
+    def test_repair_storage_objects(self):
+        """
+        Checks that storage objects without a resource are removed.
+        """
+        # a dry run does not remove anything
+        self.assertEquals(1, repair_storage_objects(dry_run=True, workers=1))
+        self.assertTrue(StorageObject.objects.filter(pk=self.object_id).exists())
+        # only storage objects checked since the given date are considered
+        self.assertEquals(0, repair_storage_objects(
+          since=datetime(2100, 1, 1), workers=1))
+        self.assertEquals(1, repair_storage_objects(workers=1))
+        self.assertFalse(StorageObject.objects.filter(pk=self.object_id).exists())
+
+    def test_remove_old_metadata_revisions(self):
+        """
+        Checks that only the most recent metadata XML revisions are kept, also
+        beyond revision 9999.
+        """
+        storage_object = StorageObject.objects.get(pk=self.object_id)
+        _folder = storage_object._storage_folder()
+        if not os.path.isdir(_folder):
+            os.mkdir(_folder)
+        for _revision in (998, 9999, 10000, 10001):
+            with open(os.path.join(_folder, 'metadata-{0:04d}.xml'
+                                   .format(_revision)), 'w') as _out:
+                _out.write('<resourceInfo/>')
+        _old_retention = settings.METADATA_REVISION_RETENTION
+        settings.METADATA_REVISION_RETENTION = 2
+        try:
+            _remove_old_metadata_revisions(_folder)
+        finally:
+            settings.METADATA_REVISION_RETENTION = _old_retention
+        self.assertEquals(['metadata-10000.xml', 'metadata-10001.xml'],
+          sorted(os.path.basename(_path) for _path in
+                 glob.glob(os.path.join(_folder, 'metadata-*.xml'))))
+
+    def test_add_missing_columns(self):
+        """
+        Checks that the columns of fields which have been added to existing
+        tables are created.
+        """
+        _table = StorageObject._meta.db_table
+        def _get_columns():
+            with connection.cursor() as cursor:
+                return [_column[0] for _column in connection.introspection
+                        .get_table_description(cursor, _table)]
+        with connection.schema_editor() as editor:
+            editor.remove_field(StorageObject,
+                                StorageObject._meta.get_field('metadata_dirty'))
+        self.assertNotIn('metadata_dirty', _get_columns())
+        _out = StringIO()
+        call_command('add_missing_columns', verbosity=0, stdout=_out)
+        self.assertIn('metadata_dirty', _get_columns())
+        self.assertEquals('1 columns added', _out.getvalue().strip())
+        self.assertTrue(StorageObject.objects.get(pk=self.object_id)
+                        .metadata_dirty)
+
 
 class UpdateTests(unittest.TestCase):
     """
@@ -279,3 +346,176 @@ class UpdateTests(unittest.TestCase):
         self.assertEquals(1, len(persons))
         contact_person = persons[0]
         self.assertEquals(MASTER, contact_person.copy_status)
+
+    def test_update_storage_skips_unchanged_metadata(self):
+        """
+        Verify that the metadata XML is only exported again after metadata
+        has been changed.
+        """
+        # setup
+        add_or_update_resource(self.storage_json, self.metadata_before, None, copy_status=MASTER)
+        storage_object = StorageObject.objects.get(identifier=self.storage_id)
+        storage_object.update_storage()
+        self.assertFalse(self._is_metadata_dirty(storage_object))
+        # exercise: nothing has changed, so the stale XML is not detected
+        _stale = u'<?xml version="1.0"?>\n<stale/>'
+        storage_object.metadata = _stale
+        storage_object.update_storage()
+        self.assertEquals(_stale, storage_object.metadata)
+        # exercise: changes of other resources do not matter
+        other = test_utils.import_xml('{0}/repository/fixtures/testfixture.xml'
+                                      .format(settings.ROOT_PATH))
+        other.storage_object.publication_status = PUBLISHED
+        other.storage_object.save()
+        other.storage_object.update_storage()
+        other.metadataInfo.save()
+        self.assertTrue(self._is_metadata_dirty(other.storage_object))
+        self.assertFalse(self._is_metadata_dirty(storage_object))
+        # exercise: any change of the metadata leads to a new export
+        resource = resourceInfoType_model.objects.get(storage_object__identifier=self.storage_id)
+        resource.metadataInfo.save()
+        self.assertTrue(self._is_metadata_dirty(storage_object))
+        storage_object.update_storage()
+        self.assertNotEquals(_stale, storage_object.metadata)
+        self.assertFalse(self._is_metadata_dirty(storage_object))
+
+    def test_shared_metadata_changes(self):
+        """
+        Verify that changes of metadata objects which are shared by several
+        resources mark the metadata XML of all of them as outdated.
+        """
+        # setup
+        add_or_update_resource(self.storage_json, self.metadata_before, None, copy_status=MASTER)
+        resource = resourceInfoType_model.objects.get(storage_object__identifier=self.storage_id)
+        other = test_utils.import_xml('{0}/repository/fixtures/testfixture.xml'
+                                      .format(settings.ROOT_PATH))
+        other.storage_object.publication_status = PUBLISHED
+        other.storage_object.save()
+        person = resource.contactPerson.all()[0]
+        other.contactPerson.add(person)
+        self.assertTrue(self._is_metadata_dirty(other.storage_object))
+        for _storage_object in (resource.storage_object, other.storage_object):
+            _storage_object.update_storage()
+            self.assertFalse(self._is_metadata_dirty(_storage_object))
+        # exercise
+        person.save()
+        # verify
+        self.assertTrue(self._is_metadata_dirty(resource.storage_object))
+        self.assertTrue(self._is_metadata_dirty(other.storage_object))
+        # exercise: a relation is removed from the other side
+        other.storage_object.update_storage()
+        person.contactPerson_resourceinfotype_model_related.remove(other)
+        self.assertTrue(self._is_metadata_dirty(other.storage_object))
+
+    @staticmethod
+    def _is_metadata_dirty(storage_object):
+        return StorageObject.objects.get(pk=storage_object.pk).metadata_dirty
+
+    def test_update_digests(self):
+        """
+        Verify that only expired digests are updated.
+        """
+        # setup
+        add_or_update_resource(self.storage_json, self.metadata_before, None, copy_status=MASTER)
+        _old = datetime(2000, 1, 1)
+        StorageObject.objects.filter(identifier=self.storage_id).update(
+          publication_status=PUBLISHED, digest_modified=_old,
+          digest_last_checked=_old)
+        # a dry run does not update anything
+        self.assertEquals(1, update_digests(dry_run=True, workers=1))
+        self.assertEquals(_old, StorageObject.objects.get(
+          identifier=self.storage_id).digest_last_checked)
+        self.assertEquals(0, update_digests(since=datetime(2001, 1, 1), workers=1))
+        # exercise
+        self.assertEquals(1, update_digests(workers=1))
+        self.assertNotEquals(_old, StorageObject.objects.get(
+          identifier=self.storage_id).digest_last_checked)
+        self.assertEquals(0, update_digests(workers=1))
+
+    def test_update_missing_digests(self):
+        """
+        Verify that digests which have never been created or checked are
+        updated.
+        """
+        # setup
+        add_or_update_resource(self.storage_json, self.metadata_before, None, copy_status=MASTER)
+        StorageObject.objects.filter(identifier=self.storage_id).update(
+          publication_status=PUBLISHED, digest_modified=None,
+          digest_last_checked=None)
+        storage_object = StorageObject.objects.get(identifier=self.storage_id)
+        self.assertTrue(storage_object.is_digest_expired())
+        # exercise
+        self.assertEquals(1, update_digests(workers=1))
+        # verify
+        storage_object = StorageObject.objects.get(identifier=self.storage_id)
+        self.assertIsNotNone(storage_object.digest_last_checked)
+        self.assertFalse(storage_object.is_digest_expired())
+        self.assertEquals(0, update_digests(workers=1))
+
+    def test_digest_archive(self):
+        """
+        Verify that digest archives are named after their checksum, are only
+        written once and that old archives are removed.
+        """
+        # setup
+        add_or_update_resource(self.storage_json, self.metadata_before, None, copy_status=MASTER)
+        storage_object = StorageObject.objects.get(identifier=self.storage_id)
+        _path = storage_object.get_digest_archive()
+        self.assertEquals('digest-{0}.zip'.format(storage_object.digest_checksum),
+                          os.path.basename(_path))
+        with ZipFile(_path, 'r') as inzip:
+            self.assertEquals(storage_object.digest_checksum,
+              compute_digest_checksum(inzip.read('metadata.xml'),
+                                      inzip.read('storage-global.json')))
+        # an archive with unchanged content is not written again
+        _inode = os.stat(_path).st_ino
+        storage_object.create_digest()
+        self.assertEquals(_path, storage_object.get_digest_archive())
+        self.assertEquals(_inode, os.stat(_path).st_ino)
+        # a missing archive is recreated
+        os.remove(_path)
+        self.assertEquals(_path, storage_object.get_digest_archive())
+        self.assertTrue(os.path.isfile(_path))
+        # only the most recent archives are kept
+        _old_retention = settings.DIGEST_ARCHIVE_RETENTION
+        settings.DIGEST_ARCHIVE_RETENTION = 1
+        try:
+            storage_object.global_storage = storage_object.global_storage + ' '
+            storage_object.create_digest()
+        finally:
+            settings.DIGEST_ARCHIVE_RETENTION = _old_retention
+        self.assertEquals([storage_object.get_digest_archive()],
+          glob.glob(os.path.join(storage_object._storage_folder(), 'digest-*.zip')))
+
+
+def _log_in_worker(message):
+    LOGGER.info(message)
+    return os.getpid()
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """
+    Test case that checks the logging of the maintenance worker processes.
+    """
+    def test_worker_logging(self):
+        """
+        Verify that the log records of the worker processes are written by
+        the process which has created them.
+        """
+        _messages = ['message {0}'.format(i) for i in range(4)]
+        # logging is disabled while testing
+        _disabled = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        pool = WorkerPool(processes=2)
+        _records = []
+        LOG_HANDLER.handle = _records.append
+        try:
+            _pids = pool.map(_log_in_worker, _messages)
+            pool.close()
+            pool.join()
+        finally:
+            del LOG_HANDLER.handle
+            logging.disable(_disabled)
+        self.assertNotIn(os.getpid(), _pids)
+        self.assertEquals(_messages,
+                          sorted(_record.getMessage() for _record in _records))
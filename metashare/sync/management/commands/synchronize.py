@@ -2,17 +2,21 @@
 Management utility to trigger synchronization.
 """
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from optparse import make_option
 import socket
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand
+from django.utils.http import quote_etag
 
 from metashare import settings
 from metashare.storage.models import StorageObject, PROXY, REMOTE, \
     add_or_update_resource
 from metashare.storage.utils import remove_resource
-from metashare.sync.sync_utils import login, get_inventory, get_full_metadata
+from metashare.sync.sync_utils import login, get_inventory, \
+    get_full_metadata, get_bulk_metadata, SyncCheckpoint, \
+    NotModifiedException, DELTA_SYNC_PROTOCOL
 from metashare.utils import Lock
 
 
@@ -28,6 +32,13 @@ class Command(BaseCommand):
                     default=None, help='file for IDs of new/modified resource'),
         make_option('-n', '--node', action='store', dest='node',
                     default=None, help='sync only with specified node'),
+        make_option('-w', '--workers', action='store', dest='workers',
+                    type='int', default=None, help='number of concurrent '
+                    'connections used for fetching resources from a node; '
+                    'defaults to SYNC_WORKERS'),
+        make_option('-r', '--resume', action='store_true', dest='resume',
+                    default=False, help='resume an interrupted synchronization '
+                    'from the last checkpoint of each node'),
     )
 
     help = 'Synchronizes with a predefined list of META-SHARE nodes'
@@ -52,22 +63,29 @@ class Command(BaseCommand):
         # our connections blocks forever
         socket.setdefaulttimeout(30.0)
 
+        workers = options.get('workers', None) or settings.SYNC_WORKERS
+        resume = options.get('resume', False)
+
         node_name = options.get('node', None)
         if node_name is None:
-            Command.sync_with_nodes(getattr(settings, 'CORE_NODES', {}), False, id_file)
-            Command.sync_with_nodes(getattr(settings, 'PROXIED_NODES', {}), True, id_file)
+            Command.sync_with_nodes(getattr(settings, 'CORE_NODES', {}), False,
+                                    id_file, workers, resume)
+            Command.sync_with_nodes(getattr(settings, 'PROXIED_NODES', {}), True,
+                                    id_file, workers, resume)
         else:
             # Synchronize only with the given node
             core_nodes = getattr(settings, 'CORE_NODES', {})
             for key, value in core_nodes.items():
                 if value['NAME'] == node_name:
-                    Command.sync_with_nodes({key: value}, False, id_file)
+                    Command.sync_with_nodes({key: value}, False, id_file,
+                                            workers, resume)
                     break
 
             proxied_nodes = getattr(settings, 'PROXIED_NODES', {})
             for key, value in proxied_nodes.items():
                 if value['NAME'] == node_name:
-                    Command.sync_with_nodes({key: value}, True, id_file)
+                    Command.sync_with_nodes({key: value}, True, id_file,
+                                            workers, resume)
                     break
 
         # Close id file if used
@@ -75,7 +93,8 @@ class Command(BaseCommand):
             id_file.close()
 
     @staticmethod
-    def sync_with_nodes(nodes, is_proxy, id_file=None):
+    def sync_with_nodes(nodes, is_proxy, id_file=None, workers=None,
+                        resume=False):
         """
         Synchronizes this META-SHARE node with the given other META-SHARE nodes.
         
@@ -83,26 +102,24 @@ class Command(BaseCommand):
             to synchronize with
         `is_proxy` must be True if this node is a proxy for the given nodes;
             it must be False if the given nodes are not proxied by this node
+        `workers` is the number of concurrent connections used for fetching
+            resources from a node; defaults to SYNC_WORKERS
+        `resume` must be True if an interrupted synchronization should be
+            continued from the last checkpoint of each node
         """
         for node_id, node in nodes.items():
             LOGGER.info("syncing with node {} at {} ...".format(
               node_id, node['URL']))
             try:
-                # before starting the actual synchronization, make sure to lock
-                # the storage so that any other processes with heavy/frequent
-                # operations on the storage don't get in our way
-                lock = Lock('storage')
-                lock.acquire()
-                Command.sync_with_single_node(
-                  node_id, node, is_proxy, id_file=id_file)
+                Command.sync_with_single_node(node_id, node, is_proxy,
+                  id_file=id_file, workers=workers, resume=resume)
             except:
                 LOGGER.error('There was an error while trying to sync with '
                     'node "%s":', node_id, exc_info=True)
-            finally:
-                lock.release()
 
     @staticmethod
-    def sync_with_single_node(node_id, node, is_proxy, id_file=None):
+    def sync_with_single_node(node_id, node, is_proxy, id_file=None,
+                              workers=None, resume=False):
         """
         Synchronizes this META-SHARE node with another META-SHARE node using
         the given node description.
@@ -113,7 +130,13 @@ class Command(BaseCommand):
             synchronize with
         `is_proxy` must be True if this node is a proxy for the given nodes;
             it must be False if the given nodes are not proxied by this node
+        `workers` is the number of concurrent connections used for fetching
+            resources from the node; defaults to SYNC_WORKERS
+        `resume` must be True if an interrupted synchronization with the node
+            should be continued from its last checkpoint
         """
+        if not workers:
+            workers = settings.SYNC_WORKERS
 
         # login
         url = node['URL']
@@ -129,11 +152,41 @@ class Command(BaseCommand):
             if (index < len(settings.SYNC_PROTOCOLS) - 1):
                 inv_url = inv_url + "&"
         
-        # get the inventory list 
-        remote_inventory = get_inventory(opener, inv_url)
-        remote_inventory_count = len(remote_inventory)
-        LOGGER.info("Remote node {} contains {} resources".format(
-          node_id, remote_inventory_count))
+        # get the inventory list; when resuming, the inventory of the
+        # interrupted run is reused so that its plan can be completed
+        checkpoint = SyncCheckpoint(node_id)
+        if resume and checkpoint.load():
+            sync_protocol, remote_inventory = checkpoint.inventory
+            LOGGER.info("Resuming sync with node {} from checkpoint; {} "
+              "resources were already processed".format(
+              node_id, len(checkpoint.done)))
+        else:
+            # ask for a delta inventory if we know where the last run stopped
+            since = checkpoint.load_sequence()
+            if since:
+                inv_url = inv_url + "&since={}".format(since)
+            sync_protocol, remote_inventory = get_inventory(opener, inv_url)
+            checkpoint.start([sync_protocol, remote_inventory])
+
+        # a delta inventory only lists the resources which have changed or have
+        # been deleted since the last run
+        remote_sequence = None
+        remote_deleted = None
+        if sync_protocol == DELTA_SYNC_PROTOCOL:
+            remote_sequence = remote_inventory['sequence']
+            if remote_inventory['full']:
+                remote_inventory = remote_inventory['inventory']
+            else:
+                remote_deleted = remote_inventory['deleted']
+                remote_inventory = remote_inventory['changed']
+        if remote_deleted is None:
+            remote_inventory_count = len(remote_inventory)
+            LOGGER.info("Remote node {} contains {} resources".format(
+              node_id, remote_inventory_count))
+        else:
+            LOGGER.info("Remote node {} reports {} changed and {} deleted "
+              "resources".format(node_id, len(remote_inventory),
+              len(remote_deleted)))
         
         # create a dictionary of uuid's and digests of resource from the local 
         # inventory that stem from the remote node
@@ -142,6 +195,9 @@ class Command(BaseCommand):
         for item in remote_storage_objects:
             local_inventory[item.identifier] = item.digest_checksum
         local_inventory_count = len(local_inventory)
+        # the ETags of the records received from the node before, for
+        # conditional requests of updated resources
+        validators = checkpoint.load_validators()
         LOGGER.info("Local node contains {} resources stemming from remote node {}".format(
           local_inventory_count, node_id))
         
@@ -181,8 +237,23 @@ class Command(BaseCommand):
                       node_id, remote_res_id, source_node))
                 except ObjectDoesNotExist:
                     resources_to_add.append(remote_res_id)
-        # remaining local inventory resources are to delete
-        resources_to_delete = local_inventory.keys()
+        # remaining local inventory resources are to delete; for a delta
+        # inventory, these are only the ones reported as deleted
+        if remote_deleted is None:
+            resources_to_delete = local_inventory.keys()
+        else:
+            resources_to_delete = [res_id for res_id in remote_deleted
+                                   if res_id in local_inventory]
+
+        # skip all resources that have already been processed before an
+        # interruption
+        if checkpoint.done:
+            resources_to_add = [res_id for res_id in resources_to_add
+                                if res_id not in checkpoint.done]
+            resources_to_update = [res_id for res_id in resources_to_update
+                                   if res_id not in checkpoint.done]
+            resources_to_delete = [res_id for res_id in resources_to_delete
+                                   if res_id not in checkpoint.done]
 
         # print informative messages to the user
         resources_to_add_count = len(resources_to_add)
@@ -197,45 +268,47 @@ class Command(BaseCommand):
         else:
             _copy_status = REMOTE
 
+        # nodes which support the bulk transfer send several metadata records
+        # per request
+        if sync_protocol == DELTA_SYNC_PROTOCOL:
+            batch_size = settings.SYNC_BATCH_SIZE
+        else:
+            batch_size = 1
+
         # add resources from remote inventory
-        num_added = 0
-        for res_id in resources_to_add:
-            try:
-                LOGGER.info("adding resource {0} from node {1}".format(res_id, node_id))
-                res_obj = Command._get_remote_resource(
-                  res_id, remote_inventory[res_id], node_id, node, opener, _copy_status)
-                if not id_file is None:
-                    id_file.write("--->RESOURCE_ID:{0};STORAGE_IDENTIFIER:{1}\n"\
-                        .format(res_obj.id, res_obj.storage_object.identifier))
-                num_added += 1
-            except:
-                LOGGER.error("Error while adding resource {}".format(res_id),
-                    exc_info=True)
+        num_added = Command._sync_resources(resources_to_add, 'adding',
+          remote_inventory, node_id, node, opener, _copy_status, checkpoint,
+          workers, batch_size, validators, id_file=id_file)
 
-        # update resources from remote inventory
-        num_updated = 0
-        for res_id in resources_to_update:
-            try:
-                LOGGER.info("updating resource {0} from node {1}".format(res_id, node_id))
-                res_obj = Command._get_remote_resource(
-                  res_id, remote_inventory[res_id], node_id, node, opener, _copy_status)
-                if not id_file is None:
-                    id_file.write("--->RESOURCE_ID:{0};STORAGE_IDENTIFIER:{1}\n"\
-                        .format(res_obj.id, res_obj.storage_object.identifier))
-                    if remote_inventory[res_id] != res_obj.storage_object.digest_checksum:
-                        id_file.write("Different digests!\n")
-                num_updated += 1
-            except:
-                LOGGER.error("Error while updating resource {}".format(res_id),
-                    exc_info=True)
+        # update resources from remote inventory; the resources for which the
+        # node has sent an ETag before are requested one by one with it, as
+        # their local digests may differ from the remote ones only because
+        # they have been recomputed locally
+        num_updated = Command._sync_resources(
+          [res_id for res_id in resources_to_update if res_id in validators],
+          'updating', remote_inventory, node_id, node, opener, _copy_status,
+          checkpoint, workers, 1, validators, conditional=True,
+          id_file=id_file)
+        num_updated += Command._sync_resources(
+          [res_id for res_id in resources_to_update
+           if res_id not in validators],
+          'updating', remote_inventory, node_id, node, opener, _copy_status,
+          checkpoint, workers, batch_size, validators, id_file=id_file)
 
         # delete resources from remote inventory
         num_deleted = 0
+        lock = Lock('storage')
         for res_id in resources_to_delete:
             try:
                 LOGGER.info("removing resource {0} from node {1}".format(res_id, node_id))
                 _so_to_remove = StorageObject.objects.get(identifier=res_id)
-                remove_resource(_so_to_remove)
+                lock.acquire()
+                try:
+                    remove_resource(_so_to_remove)
+                finally:
+                    lock.release()
+                checkpoint.mark_done(res_id)
+                validators.pop(res_id, None)
                 num_deleted += 1
             except:
                 LOGGER.error("Error while removing resource {}".format(res_id),
@@ -248,18 +321,131 @@ class Command(BaseCommand):
         LOGGER.info("{} of {} resources successfully removed." \
             .format(num_deleted, resources_to_delete_count))
 
+        # the run is complete; resources that failed are retried by the next
+        # run since their digests still differ
+        checkpoint.save_validators(validators)
+        checkpoint.clear()
+        # only continue with a delta inventory next time if nothing failed;
+        # otherwise the failed changes would not be reported again
+        if num_added == resources_to_add_count \
+                and num_updated == resources_to_update_count \
+                and num_deleted == resources_to_delete_count:
+            checkpoint.save_sequence(remote_sequence)
+
 
     @staticmethod
-    def _get_remote_resource(resource_id, resource_digest, node_id, node, opener, copy_status):
+    def _sync_resources(res_ids, action, remote_inventory, node_id, node,
+                        opener, copy_status, checkpoint, workers, batch_size,
+                        validators, conditional=False, id_file=None):
         """
-        Retrieves from the given node the resource for the given id and
-        adds/updates it at the current node with the given copy status using the
-        given opener 
+        Adds/updates the resources with the given ids from the given node.
+
+        The metadata records are fetched concurrently by a bounded pool of
+        `workers` threads while the calling thread is the single writer which
+        applies them to the database and the storage folder, one at a time.
+        The storage lock is only held while a single resource is written so
+        that other storage writers are not blocked for the whole run.
+
+        If `batch_size` is greater than 1, the records are fetched in batches
+        of this size with a single request per batch.
+
+        `validators` is a dict of resource ids and the ETags which the node
+        sent for the records received before; the ETags of the applied records
+        are added to it.  If `conditional` is True, single records are only
+        transferred if they have been modified since their ETags were sent.
+
+        Returns the number of successfully synchronized resources.
         """
-        # Get the json storage object and the actual metadata xml
-        storage_json, resource_xml_string = \
-          get_full_metadata(opener, "{0}/sync/{1}/metadata/" \
-                .format(node['URL'], resource_id), resource_digest)
-        res_obj = add_or_update_resource(storage_json, resource_xml_string,
-                        resource_digest, copy_status, source_node=node_id)
-        return res_obj
+        num_synced = 0
+        batches = (res_ids[i:i + batch_size]
+                   for i in range(0, len(res_ids), batch_size))
+        pending = {}
+        lock = Lock('storage')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def _submit_next():
+                for batch in batches:
+                    for res_id in batch:
+                        LOGGER.info("{0} resource {1} from node {2}".format(
+                          action, res_id, node_id))
+                    pending[executor.submit(Command._fetch_remote_resources,
+                      batch, remote_inventory, node, opener,
+                      validators if conditional else None)] = batch
+                    return
+
+            # keep a limited number of records in flight so that memory usage
+            # does not depend on the number of changed resources
+            for _ in range(workers * 2):
+                _submit_next()
+            while pending:
+                done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    _submit_next()
+                    try:
+                        records = future.result()
+                    except:
+                        LOGGER.error("Error while {0} resources {1}".format(
+                          action, ', '.join(batch)), exc_info=True)
+                        continue
+                    for res_id in batch:
+                        try:
+                            if not res_id in records:
+                                raise Exception("Resource {0} was not sent "
+                                  "by node {1}".format(res_id, node_id))
+                            record = records.pop(res_id)
+                            if record is None:
+                                # the local copy is already up-to-date
+                                LOGGER.info("Resource {0} has not been "
+                                  "modified".format(res_id))
+                                checkpoint.mark_done(res_id)
+                                num_synced += 1
+                                continue
+                            storage_json, resource_xml_string, etag = record
+                            lock.acquire()
+                            try:
+                                res_obj = add_or_update_resource(storage_json,
+                                  resource_xml_string, remote_inventory[res_id],
+                                  copy_status, source_node=node_id)
+                            finally:
+                                lock.release()
+                            checkpoint.mark_done(res_id)
+                            # the node uses the digest as ETag of a record
+                            validators[res_id] = etag \
+                              or quote_etag(remote_inventory[res_id])
+                            if not id_file is None:
+                                id_file.write("--->RESOURCE_ID:{0};STORAGE_IDENTIFIER:{1}\n"\
+                                    .format(res_obj.id, res_obj.storage_object.identifier))
+                                if remote_inventory[res_id] != res_obj.storage_object.digest_checksum:
+                                    id_file.write("Different digests!\n")
+                            num_synced += 1
+                        except:
+                            LOGGER.error("Error while {0} resource {1}".format(
+                              action, res_id), exc_info=True)
+        return num_synced
+
+    @staticmethod
+    def _fetch_remote_resources(res_ids, remote_inventory, node, opener,
+                                validators=None):
+        """
+        Retrieves from the given node the resources for the given ids using
+        the given opener; several resources are retrieved with a single bulk
+        request.
+
+        Returns a dict of resource ids and triples of the storage JSON object,
+        the metadata XML string and the ETag sent by the node (None for bulk
+        requests); the value is None for a resource which has not been
+        modified since the node sent the ETag from `validators` for it.
+        """
+        if len(res_ids) == 1:
+            res_id = res_ids[0]
+            try:
+                return {res_id: get_full_metadata(opener,
+                    "{0}/sync/{1}/metadata/".format(node['URL'], res_id),
+                    remote_inventory[res_id],
+                    validators and validators.get(res_id))}
+            except NotModifiedException:
+                return {res_id: None}
+        return dict((res_id, record + (None,)) for res_id, record
+                    in get_bulk_metadata(opener, "{0}/sync/metadata/".format(
+                        node['URL']), dict((res_id, remote_inventory[res_id])
+                                           for res_id in res_ids)).iteritems())
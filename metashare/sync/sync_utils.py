@@ -21,6 +21,10 @@ from metashare.settings import LOG_HANDLER
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(LOG_HANDLER)
 
+# the first synchronization protocol version that supports delta inventories
+# and the bulk transfer of metadata records
+DELTA_SYNC_PROTOCOL = '2.0'
+
 # Idea taken from 
 # http://stackoverflow.com/questions/5082128/how-do-i-authenticate-a-urllib2-script-in-order-to-access-https-web-services-fro
 def login(login_url, username, password):
@@ -64,7 +68,8 @@ def login(login_url, username, password):
 def get_inventory(opener, inventory_url):
     """
     Obtain the inventory from a logged-in opener and fill it into a JSON structure.
-    Returns the JSON structure.
+    Returns a pair of the sync protocol version chosen by the remote server
+    and the JSON structure.
     """
     try:
         with contextlib.closing(opener.open(inventory_url)) as response:
@@ -73,45 +78,242 @@ def get_inventory(opener, inventory_url):
                     'send any sync protocol version along with its metadata '
                     'inventory. This indicates an incompatible pre-v3.0 node.'
                     .format(inventory_url))
+            sync_protocol = response.headers['sync-protocol']
             data = response.read()
             with ZipFile(StringIO(data), 'r') as inzip:
                 json_inventory = json.load(inzip.open('inventory.json'))
                 # TODO: add error handling and verification of json structure
-                return json_inventory
+                return sync_protocol, json_inventory
     except ConnectionException:
         raise
     except:
         raise ConnectionException("Problem getting inventory from {0}: {1}".format(inventory_url, format_exc()))
 
 
-def get_full_metadata(opener, full_metadata_url, expected_digest):
+def get_full_metadata(opener, full_metadata_url, expected_digest,
+                      etag=None):
     """
     Obtain the full metadata record for one resource.
     
-    Returns a pair of storage_json_string, resource_xml_string.
+    Returns a triple of storage_json_string, resource_xml_string and the ETag
+    which the remote node sent for the record (None if it sent none).
     
+    If etag is given, i.e., the ETag of a record of the resource which has
+    been received from the remote node before, the record is only transferred
+    if it has been modified since; otherwise NotModifiedException is raised.
+
     Raises CorruptDataException if the zip data received from full_metadata_url
     does not have an md5 digest identical to expected_digest.
     """
-    with contextlib.closing(opener.open(full_metadata_url)) as response:
+    request = urllib2.Request(full_metadata_url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        response = opener.open(request)
+    except urllib2.HTTPError, err:
+        if err.code == 304:
+            raise NotModifiedException("Resource at '{0}' has not been "
+              "modified.".format(full_metadata_url))
+        raise
+    with contextlib.closing(response):
+        data = response.read()
+        return _read_full_metadata(data, expected_digest, full_metadata_url) \
+            + (response.info().getheader('ETag'),)
+
+
+def get_bulk_metadata(opener, bulk_metadata_url, expected_digests):
+    """
+    Obtain the full metadata records for several resources with a single
+    request.
+
+    `expected_digests` is a dict of the identifiers of the requested resources
+    and their expected digests.
+
+    Returns a dict of resource identifiers and pairs of storage_json,
+    resource_xml_string. Resources which were not sent by the remote node or
+    whose zip data does not have the expected md5 digest are left out.
+    """
+    post_data = urllib.urlencode(
+        [('resource', res_id) for res_id in expected_digests])
+    result = {}
+    with contextlib.closing(opener.open(bulk_metadata_url, post_data)) as response:
         data = response.read()
         with ZipFile(StringIO(data), 'r') as inzip:
-            with inzip.open('metadata.xml') as resource_xml:
-                resource_xml_string = resource_xml.read()
-            with inzip.open('storage-global.json') as storage_file:
-                # read json string
-                storage_json_string = storage_file.read() 
-                # convert to json object
-                storage_json = json.loads(storage_json_string)
-            if not expected_digest == \
-              compute_digest_checksum(resource_xml_string, storage_json_string):
-                raise CorruptDataException("Checksum error for resource '{0}'." \
-                  .format(full_metadata_url))
-            return storage_json, resource_xml_string
+            for name in inzip.namelist():
+                res_id = name[:-len('.zip')]
+                if not res_id in expected_digests:
+                    LOGGER.warn("Ignoring unexpected resource '{0}' from {1}" \
+                      .format(res_id, bulk_metadata_url))
+                    continue
+                try:
+                    result[res_id] = _read_full_metadata(inzip.read(name),
+                      expected_digests[res_id], res_id)
+                except CorruptDataException:
+                    LOGGER.error("Corrupt resource received from {0}" \
+                      .format(bulk_metadata_url), exc_info=True)
+    return result
+
+
+def _read_full_metadata(data, expected_digest, source):
+    """
+    Reads the full metadata record for one resource from the given digest zip
+    data.
+
+    Returns a pair of storage_json_string, resource_xml_string.
+
+    Raises CorruptDataException if the zip data does not have an md5 digest
+    identical to expected_digest.
+    """
+    with ZipFile(StringIO(data), 'r') as inzip:
+        with inzip.open('metadata.xml') as resource_xml:
+            resource_xml_string = resource_xml.read()
+        with inzip.open('storage-global.json') as storage_file:
+            # read json string
+            storage_json_string = storage_file.read() 
+            # convert to json object
+            storage_json = json.loads(storage_json_string)
+        if not expected_digest == \
+          compute_digest_checksum(resource_xml_string, storage_json_string):
+            raise CorruptDataException("Checksum error for resource '{0}'." \
+              .format(source))
+        return storage_json, resource_xml_string
+
+
+class SyncCheckpoint(object):
+    """
+    A persistent record of the progress of a synchronization run with a single
+    node.
+
+    The checkpoint consists of the remote inventory that the run is based on
+    and of an append-only log of the identifiers of all resources that have
+    already been processed, so that an interrupted run can later be resumed
+    where it stopped.
+    """
+    def __init__(self, node_id):
+        _base = os.path.join(settings.SYNC_CHECKPOINT_DIR,
+                             'sync-{0}'.format(node_id))
+        self.inventory_path = '{0}.inventory.json'.format(_base)
+        self.done_path = '{0}.done'.format(_base)
+        self.sequence_path = '{0}.sequence'.format(_base)
+        self.validators_path = '{0}.validators.json'.format(_base)
+        self.inventory = None
+        self.done = set()
+
+    def load(self):
+        """
+        Loads the checkpoint from disk.
+
+        Returns whether a usable checkpoint was found.
+        """
+        if not os.path.isfile(self.inventory_path):
+            return False
+        try:
+            with open(self.inventory_path, 'rb') as _in:
+                self.inventory = json.load(_in)
+            self.done = set()
+            if os.path.isfile(self.done_path):
+                with open(self.done_path, 'rb') as _in:
+                    self.done = set(line.strip() for line in _in if line.strip())
+        except:
+            LOGGER.warn('Ignoring unreadable sync checkpoint {0}'.format(
+              self.inventory_path), exc_info=True)
+            self.inventory = None
+            self.done = set()
+            return False
+        return True
+
+    def start(self, inventory):
+        """
+        Starts a new checkpoint for a run based on the given remote inventory.
+        """
+        if not os.path.isdir(settings.SYNC_CHECKPOINT_DIR):
+            os.makedirs(settings.SYNC_CHECKPOINT_DIR)
+        # write atomically so that a crash never leaves a truncated inventory
+        _tmp_path = '{0}.tmp'.format(self.inventory_path)
+        with open(_tmp_path, 'wb') as _out:
+            json.dump(inventory, _out)
+        os.rename(_tmp_path, self.inventory_path)
+        if os.path.isfile(self.done_path):
+            os.remove(self.done_path)
+        self.inventory = inventory
+        self.done = set()
+
+    def mark_done(self, res_id):
+        """
+        Records that the resource with the given id has been processed.
+        """
+        with open(self.done_path, 'ab') as _out:
+            _out.write('{0}\n'.format(res_id))
+        self.done.add(res_id)
+
+    def load_sequence(self):
+        """
+        Returns the inventory change log sequence number of the node which was
+        reached by the last completed run or None if there is none.
+        """
+        try:
+            with open(self.sequence_path, 'rb') as _in:
+                return int(_in.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def save_sequence(self, sequence):
+        """
+        Stores the inventory change log sequence number of the node which was
+        reached by a completed run; None removes any stored sequence number.
+        """
+        if sequence is None:
+            if os.path.isfile(self.sequence_path):
+                os.remove(self.sequence_path)
+            return
+        if not os.path.isdir(settings.SYNC_CHECKPOINT_DIR):
+            os.makedirs(settings.SYNC_CHECKPOINT_DIR)
+        _tmp_path = '{0}.tmp'.format(self.sequence_path)
+        with open(_tmp_path, 'wb') as _out:
+            _out.write(str(sequence))
+        os.rename(_tmp_path, self.sequence_path)
+
+    def load_validators(self):
+        """
+        Returns a dict of the identifiers of the resources which have been
+        received from the node and the ETags which the node sent for the
+        received records.
+        """
+        try:
+            with open(self.validators_path, 'rb') as _in:
+                return json.load(_in)
+        except (IOError, ValueError):
+            return {}
+
+    def save_validators(self, validators):
+        """
+        Stores the given dict of resource identifiers and ETags, see
+        load_validators().
+        """
+        if not os.path.isdir(settings.SYNC_CHECKPOINT_DIR):
+            os.makedirs(settings.SYNC_CHECKPOINT_DIR)
+        _tmp_path = '{0}.tmp'.format(self.validators_path)
+        with open(_tmp_path, 'wb') as _out:
+            json.dump(validators, _out)
+        os.rename(_tmp_path, self.validators_path)
+
+    def clear(self):
+        """
+        Removes the checkpoint after a completed run; the stored sequence
+        number and ETags are kept.
+        """
+        for _path in (self.inventory_path, self.done_path):
+            if os.path.isfile(_path):
+                os.remove(_path)
+        self.inventory = None
+        self.done = set()
+
 
-    
 class ConnectionException(Exception):
     pass
 
 class CorruptDataException(Exception):
     pass
+
+class NotModifiedException(Exception):
+    pass
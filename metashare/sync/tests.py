@@ -2,6 +2,10 @@ import datetime
 import os
 import json
 import logging
+import shutil
+import tempfile
+import threading
+import time
 
 from xml.etree.ElementTree import fromstring
 from StringIO import StringIO
@@ -15,8 +19,10 @@ from django.core.management import call_command
 from metashare import settings, test_utils
 from metashare.repository.models import resourceInfoType_model
 from metashare.storage.models import INGESTED, INTERNAL, StorageObject, \
-    PUBLISHED, compute_digest_checksum, MASTER, PROXY
+    PUBLISHED, compute_digest_checksum, MASTER, PROXY, InventoryChange
 from metashare.settings import DJANGO_BASE, LOGIN_URL, LOG_HANDLER
+from metashare.sync.management.commands import synchronize
+from metashare.sync.sync_utils import SyncCheckpoint
 from metashare.test_utils import set_index_active
 
 # Setup logging support.
@@ -32,8 +38,16 @@ class MetadataSyncTest(TestCase):
     normal_login = None
     editor_login = None
 
+    def get_content(self, response):
+        # streamed content can only be consumed once, so keep it around
+        if response.streaming:
+            if not hasattr(response, 'consumed_content'):
+                response.consumed_content = ''.join(response.streaming_content)
+            return response.consumed_content
+        return response.content
+
     def extract_inventory(self, response):
-        with ZipFile(StringIO(response.content), 'r') as inzip:
+        with ZipFile(StringIO(self.get_content(response)), 'r') as inzip:
             return json.load(inzip.open('inventory.json'))
 
     def assertIsRedirectToLogin(self, response):
@@ -53,7 +67,7 @@ class MetadataSyncTest(TestCase):
         self.assertEquals(200, response.status_code)
         self.assertEquals('application/zip', response['Content-Type'])
         self.assertEquals(settings.METASHARE_VERSION, response['Metashare-Version'])
-        with ZipFile(StringIO(response.content), 'r') as inzip:
+        with ZipFile(StringIO(self.get_content(response)), 'r') as inzip:
             json_inventory = json.load(inzip.open('inventory.json'))
         self.assertNotEquals(0, len(json_inventory))
 
@@ -61,7 +75,7 @@ class MetadataSyncTest(TestCase):
         self.assertEquals(200, response.status_code)
         self.assertEquals('application/zip', response['Content-Type'])
         self.assertEquals(settings.METASHARE_VERSION, response['Metashare-Version'])
-        with ZipFile(StringIO(response.content), 'r') as inzip:
+        with ZipFile(StringIO(self.get_content(response)), 'r') as inzip:
             with inzip.open('storage-global.json') as storage_file:
                 storage_content = storage_file.read()
                 self.assertIsNotNone(storage_content)
@@ -149,6 +163,8 @@ class MetadataSyncTest(TestCase):
         test_utils.clean_resources_db()
         test_utils.clean_storage()
         test_utils.clean_user_db()
+        # inventory change log sequence numbers are reused after each test
+        shutil.rmtree(settings.SYNC_INVENTORY_CACHE_DIR, ignore_errors=True)
     
 
     def test_unprotected_inventory(self):
@@ -255,7 +271,7 @@ class MetadataSyncTest(TestCase):
         expected_digest = resource.storage_object.digest_checksum
         response = client.get('{0}{1}/metadata/'.format(self.SYNC_BASE, resource_uuid))
         # read zip file from response
-        with ZipFile(StringIO(response.content), 'r') as inzip:
+        with ZipFile(StringIO(self.get_content(response)), 'r') as inzip:
             with inzip.open('metadata.xml') as resource_xml:
                 resource_xml_string = resource_xml.read()
             with inzip.open('storage-global.json') as storage_file:
@@ -264,6 +280,46 @@ class MetadataSyncTest(TestCase):
         self.assertEquals(expected_digest, compute_digest_checksum(
           resource_xml_string, storage_json_string))
 
+    def test_full_metadata_not_modified(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        storage_object = StorageObject.objects.filter(publication_status=PUBLISHED)[0]
+        url = '{0}{1}/metadata/'.format(self.SYNC_BASE, storage_object.identifier)
+        response = Client().get(url)
+        etag = '"{0}"'.format(storage_object.digest_checksum)
+        self.assertEquals(etag, response['ETag'])
+        self.assertEquals('bytes', response['Accept-Ranges'])
+        response = Client().get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(304, response.status_code)
+        self.assertEquals(etag, response['ETag'])
+        response = Client().get(url, HTTP_IF_NONE_MATCH='"outdated"')
+        self.assertValidFullMetadataResponse(response)
+        response = Client().get(url,
+          HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEquals(304, response.status_code)
+
+    def test_full_metadata_range(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        storage_object = StorageObject.objects.filter(publication_status=PUBLISHED)[0]
+        url = '{0}{1}/metadata/'.format(self.SYNC_BASE, storage_object.identifier)
+        content = self.get_content(Client().get(url))
+        size = len(content)
+        response = Client().get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEquals(206, response.status_code)
+        self.assertEquals('bytes 10-19/{0}'.format(size), response['Content-Range'])
+        self.assertEquals(content[10:20], self.get_content(response))
+        response = Client().get(url, HTTP_RANGE='bytes=-10')
+        self.assertEquals(206, response.status_code)
+        self.assertEquals(content[-10:], self.get_content(response))
+        response = Client().get(url, HTTP_RANGE='bytes=10-')
+        self.assertEquals(content[10:], self.get_content(response))
+        response = Client().get(url, HTTP_RANGE='bytes={0}-'.format(size))
+        self.assertEquals(416, response.status_code)
+        # an outdated partial copy gets the whole file
+        response = Client().get(url, HTTP_RANGE='bytes=10-19',
+                                HTTP_IF_RANGE='"outdated"')
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(content, self.get_content(response))
+
     def test_inventory_no_sync_protocol(self):
         settings.SYNC_NEEDS_AUTHENTICATION = False
         response = Client().get(self.INVENTORY_URL)
@@ -284,6 +340,133 @@ class MetadataSyncTest(TestCase):
         inventory = self.extract_inventory(response)
         self.assertNotEquals(0, len(inventory))
      
+    def test_delta_inventory_without_sequence_is_full(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        response = Client().get(self.INVENTORY_URL + "?sync_protocol=2.0")
+        self.assertEquals(200, response.status_code)
+        self.assertEquals("2.0", response['Sync-Protocol'])
+        inventory = self.extract_inventory(response)
+        self.assertTrue(inventory['full'])
+        self.assertEquals(2, len(inventory['inventory']))
+        self.assertTrue(inventory['sequence'] > 0)
+        # negative sequence numbers are not valid
+        inventory = self.extract_inventory(Client().get(
+          self.INVENTORY_URL + "?sync_protocol=2.0&since=-1"))
+        self.assertTrue(inventory['full'])
+        self.assertEquals(2, len(inventory['inventory']))
+
+    def test_delta_inventory(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        client = Client()
+        sequence = self.extract_inventory(client.get(
+          self.INVENTORY_URL + "?sync_protocol=2.0"))['sequence']
+        # nothing has changed since the last inventory
+        inventory = self.extract_inventory(client.get(self.INVENTORY_URL
+          + "?sync_protocol=2.0&since={}".format(sequence)))
+        self.assertFalse(inventory['full'])
+        self.assertEquals({}, inventory['changed'])
+        self.assertEquals([], inventory['deleted'])
+        # internal resources which are ingested become part of the delta
+        internal_so = StorageObject.objects.get(publication_status=INTERNAL)
+        internal_so.publication_status = INGESTED
+        internal_so.save()
+        internal_so.update_storage()
+        # deleted resources are reported as such
+        deleted_so = StorageObject.objects.filter(
+          publication_status=PUBLISHED)[0]
+        deleted_id = deleted_so.identifier
+        deleted_so.resourceinfotype_model_set.all()[0].delete_deep()
+        deleted_so.delete()
+        inventory = self.extract_inventory(client.get(self.INVENTORY_URL
+          + "?sync_protocol=2.0&since={}".format(sequence)))
+        self.assertFalse(inventory['full'])
+        self.assertTrue(inventory['sequence'] > sequence)
+        self.assertEquals({internal_so.identifier: internal_so.digest_checksum},
+                          inventory['changed'])
+        self.assertEquals([deleted_id], inventory['deleted'])
+
+    def test_delta_inventory_late_commit(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        client = Client()
+        _last_id = InventoryChange.objects.order_by('-id')[0].id
+        InventoryChange.objects.create(id=_last_id + 10,
+          identifier='a' * 64, digest_checksum='digest-a')
+        sequence = self.extract_inventory(client.get(
+          self.INVENTORY_URL + "?sync_protocol=2.0"))['sequence']
+        # a change which is committed after a change with a higher primary
+        # key has been handed out is still part of the next delta
+        InventoryChange.objects.create(id=_last_id + 5,
+          identifier='b' * 64, digest_checksum='digest-b')
+        inventory = self.extract_inventory(client.get(self.INVENTORY_URL
+          + "?sync_protocol=2.0&since={}".format(sequence)))
+        self.assertFalse(inventory['full'])
+        self.assertTrue(inventory['sequence'] > sequence)
+        self.assertEquals({'b' * 64: 'digest-b'}, inventory['changed'])
+
+    def test_deferred_inventory_state(self):
+        # the inventory state of deferred instances is only looked up when
+        # they are saved or deleted
+        with self.assertNumQueries(1):
+            self.assertEquals(3, len(StorageObject.objects.only('identifier')))
+        deleted_so = StorageObject.objects.only('identifier') \
+          .get(publication_status=PUBLISHED)
+        deleted_so.resourceinfotype_model_set.all()[0].delete_deep()
+        deleted_so.delete()
+        self.assertTrue(InventoryChange.objects.filter(
+          identifier=deleted_so.identifier, deleted=True).exists())
+
+    def test_inventory_snapshot(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        client = Client()
+        inventory = self.extract_inventory(
+          client.get(self.INVENTORY_URL + "?sync_protocol=1.0"))
+        # the snapshot is reused as long as the inventory does not change
+        self.assertEquals(inventory, self.extract_inventory(
+          client.get(self.INVENTORY_URL + "?sync_protocol=1.0")))
+        # a changed digest invalidates the snapshot
+        internal_so = StorageObject.objects.get(publication_status=INTERNAL)
+        internal_so.publication_status = INGESTED
+        internal_so.save()
+        internal_so.update_storage()
+        inventory = self.extract_inventory(
+          client.get(self.INVENTORY_URL + "?sync_protocol=1.0"))
+        self.assertEquals(3, len(inventory))
+        self.assertEquals(internal_so.digest_checksum,
+                          inventory[internal_so.identifier])
+
+    def test_bulk_metadata(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        expected_digests = dict((so.identifier, so.digest_checksum)
+          for so in StorageObject.objects.all())
+        response = Client().post('{0}metadata/'.format(self.SYNC_BASE),
+          {'resource': expected_digests.keys()})
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('application/zip', response['Content-Type'])
+        with ZipFile(StringIO(self.get_content(response)), 'r') as inzip:
+            names = inzip.namelist()
+            # internal resources are not sent
+            self.assertEquals(2, len(names))
+            for name in names:
+                res_id = name[:-len('.zip')]
+                with ZipFile(StringIO(inzip.read(name)), 'r') as reszip:
+                    self.assertEquals(expected_digests[res_id],
+                      compute_digest_checksum(reszip.read('metadata.xml'),
+                                              reszip.read('storage-global.json')))
+                self.assertNotEquals(INTERNAL, StorageObject.objects.get(
+                  identifier=res_id).publication_status)
+
+    def test_bulk_metadata_requires_post(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = False
+        response = Client().get('{0}metadata/'.format(self.SYNC_BASE))
+        self.assertEquals(405, response.status_code)
+
+    def test_anonymous_cannot_reach_bulk_metadata(self):
+        settings.SYNC_NEEDS_AUTHENTICATION = True
+        resource = resourceInfoType_model.objects.all()[0]
+        response = Client().post('{0}metadata/'.format(self.SYNC_BASE),
+          {'resource': [resource.storage_object.identifier]})
+        self.assertIsForbidden(response)
+
     def test_proxy_check(self):
         
         # define proxied nodes
@@ -339,4 +522,165 @@ class MetadataSyncTest(TestCase):
         self.assertEquals(1, StorageObject.objects.filter(copy_status=PROXY).count())
         self.assertFalse(os.path.isdir(res1_folder))
         self.assertFalse(os.path.isdir(res2_folder))
-        self.assertTrue(os.path.isdir(res3_folder))        
+        self.assertTrue(os.path.isdir(res3_folder))
+
+
+class SyncCheckpointTest(TestCase):
+    """
+    Tests the persistence of synchronization checkpoints.
+    """
+    def setUp(self):
+        self.checkpoint_dir = settings.SYNC_CHECKPOINT_DIR
+        settings.SYNC_CHECKPOINT_DIR = tempfile.mkdtemp()
+        self.checkpoint = SyncCheckpoint('test_node')
+
+    def tearDown(self):
+        shutil.rmtree(settings.SYNC_CHECKPOINT_DIR, ignore_errors=True)
+        settings.SYNC_CHECKPOINT_DIR = self.checkpoint_dir
+
+    def test_no_checkpoint(self):
+        self.assertFalse(SyncCheckpoint('test_node').load())
+
+    def test_resume_from_checkpoint(self):
+        inventory = {'a' * 64: 'digest-a', 'b' * 64: 'digest-b'}
+        self.checkpoint.start(inventory)
+        self.checkpoint.mark_done('a' * 64)
+        # simulate a new run after an interruption
+        resumed = SyncCheckpoint('test_node')
+        self.assertTrue(resumed.load())
+        self.assertEquals(inventory, resumed.inventory)
+        self.assertEquals(set(['a' * 64]), resumed.done)
+
+    def test_start_resets_progress(self):
+        self.checkpoint.start({'a' * 64: 'digest-a'})
+        self.checkpoint.mark_done('a' * 64)
+        self.checkpoint.start({'b' * 64: 'digest-b'})
+        resumed = SyncCheckpoint('test_node')
+        self.assertTrue(resumed.load())
+        self.assertEquals(set(), resumed.done)
+
+    def test_clear(self):
+        self.checkpoint.start({'a' * 64: 'digest-a'})
+        self.checkpoint.clear()
+        self.assertFalse(SyncCheckpoint('test_node').load())
+
+
+class SyncEngineTest(TestCase):
+    """
+    Tests the concurrent synchronization with a node, with the HTTP requests
+    to the node replaced by local functions.
+    """
+    NODE_ID = 'test_node'
+    NODE = {'NAME': 'Test node', 'URL': 'http://example.com/metashare',
+            'USERNAME': 'syncuser', 'PASSWORD': 'secret'}
+
+    @classmethod
+    def setUpClass(cls):
+        LOGGER.info("running '{}' tests...".format(cls.__name__))
+        set_index_active(False)
+
+    @classmethod
+    def tearDownClass(cls):
+        set_index_active(True)
+        LOGGER.info("finished '{}' tests".format(cls.__name__))
+
+    def setUp(self):
+        test_utils.setup_test_storage()
+        self.checkpoint_dir = settings.SYNC_CHECKPOINT_DIR
+        settings.SYNC_CHECKPOINT_DIR = tempfile.mkdtemp()
+        folder = '{0}/storage/test_fixtures/updatetest'.format(
+            settings.ROOT_PATH)
+        with open('{0}/storage-global.json'.format(folder), 'rb') as _in:
+            storage_json = json.load(_in)
+        with open('{0}/metadata-before.xml'.format(folder), 'rb') as _in:
+            metadata = _in.read()
+        self.records = {}
+        for _char in 'abcd':
+            _json = dict(storage_json, identifier=_char * 64)
+            self.records[_char * 64] = (_json, metadata.replace(
+                'Italian TTS Speech Corpus (Appen)',
+                'Italian TTS Speech Corpus {0}'.format(_char)))
+        self.inventory = dict((res_id, 'digest-{0}'.format(res_id[0]))
+                              for res_id in self.records)
+        self.fetched = []
+        self.conditional = {}
+        self.running = 0
+        self.max_running = 0
+        self.fetch_lock = threading.Lock()
+        # replace all HTTP requests
+        self.originals = (synchronize.login, synchronize.get_inventory,
+                          synchronize.Command._fetch_remote_resources)
+        synchronize.login = lambda *args: None
+        synchronize.get_inventory = lambda opener, url: ('1.0', self.inventory)
+        synchronize.Command._fetch_remote_resources = \
+            staticmethod(self._fetch_remote_resources)
+
+    def tearDown(self):
+        synchronize.login, synchronize.get_inventory, \
+            synchronize.Command._fetch_remote_resources = self.originals
+        shutil.rmtree(settings.SYNC_CHECKPOINT_DIR, ignore_errors=True)
+        settings.SYNC_CHECKPOINT_DIR = self.checkpoint_dir
+        test_utils.clean_resources_db()
+        test_utils.clean_storage()
+
+    def _fetch_remote_resources(self, res_ids, remote_inventory, node, opener,
+                                validators=None):
+        with self.fetch_lock:
+            self.fetched.extend(res_ids)
+            if validators:
+                # the records have not been modified on the node
+                self.conditional.update((res_id, validators[res_id])
+                                        for res_id in res_ids)
+                return dict((res_id, None) for res_id in res_ids)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        # keep the request open long enough for the other workers to start
+        time.sleep(0.2)
+        with self.fetch_lock:
+            self.running -= 1
+        return dict((res_id, self.records[res_id] + (None,))
+                    for res_id in res_ids)
+
+    def _get_synced_ids(self):
+        return set(StorageObject.objects.filter(source_node=self.NODE_ID)
+                   .values_list('identifier', flat=True))
+
+    def test_parallel_fetching(self):
+        synchronize.Command.sync_with_single_node(self.NODE_ID, self.NODE,
+                                                  False, workers=4)
+        self.assertEquals(sorted(self.records), sorted(self.fetched))
+        self.assertTrue(self.max_running > 1)
+        self.assertEquals(set(self.records), self._get_synced_ids())
+        # a completed run leaves no checkpoint
+        self.assertFalse(SyncCheckpoint(self.NODE_ID).load())
+
+    def test_conditional_update(self):
+        synchronize.Command.sync_with_single_node(self.NODE_ID, self.NODE,
+                                                  False, workers=4)
+        self.assertEquals({}, self.conditional)
+        _etags = dict((res_id, '"{0}"'.format(digest))
+                      for res_id, digest in self.inventory.items())
+        # the digests in the inventory of the node change, so the resources
+        # are requested again, but with the ETags sent by the node before
+        self.inventory = dict((res_id, '{0}-new'.format(digest))
+                              for res_id, digest in self.inventory.items())
+        self.fetched = []
+        synchronize.Command.sync_with_single_node(self.NODE_ID, self.NODE,
+                                                  False, workers=4)
+        self.assertEquals(sorted(self.records), sorted(self.fetched))
+        self.assertEquals(_etags, self.conditional)
+        self.assertEquals(set(self.records), self._get_synced_ids())
+
+    def test_resume_from_checkpoint(self):
+        # simulate a run which has been interrupted after two resources
+        checkpoint = SyncCheckpoint(self.NODE_ID)
+        checkpoint.start(['1.0', self.inventory])
+        for res_id in ('a' * 64, 'b' * 64):
+            checkpoint.mark_done(res_id)
+        # the inventory of the interrupted run is reused
+        synchronize.get_inventory = None
+        synchronize.Command.sync_with_single_node(self.NODE_ID, self.NODE,
+            False, workers=2, resume=True)
+        self.assertEquals(['c' * 64, 'd' * 64], sorted(self.fetched))
+        self.assertEquals(set(['c' * 64, 'd' * 64]), self._get_synced_ids())
+        self.assertFalse(SyncCheckpoint(self.NODE_ID).load())
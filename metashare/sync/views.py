@@ -1,12 +1,33 @@
 from StringIO import StringIO
-from django.http import HttpResponse
+import calendar
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse, HttpResponseNotAllowed, \
+    HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, \
+    quote_etag
 import json
-from zipfile import ZipFile
+import os
+import re
+from tempfile import mkstemp
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from metashare import settings
 from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from metashare.storage.models import StorageObject, MASTER, PROXY, INTERNAL, \
-    REMOTE
+    REMOTE, get_inventory_sequence, get_inventory_changes, \
+    get_expired_digest_query
+from metashare.sync.sync_utils import DELTA_SYNC_PROTOCOL
+
+# number of storage objects read from the database at once when the inventory
+# is collected
+INVENTORY_CHUNK_SIZE = 1000
+
+# size of the blocks in which partial files are sent
+FILE_BLOCK_SIZE = 64 * 1024
+
+# a Range header with a single byte range
+BYTE_RANGE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
 
 
 def inventory(request):
@@ -28,38 +49,160 @@ def inventory(request):
         # protocols
         return HttpResponse(status=501)
 
-    response = HttpResponse(status=200, content_type='application/zip')
+    # make sure that all digests are up-to-date before the inventory is
+    # collected; this may add new inventory changes
+    objects_to_sync = _get_objects_to_sync()
+    for obj in objects_to_sync.filter(get_expired_digest_query()):
+        obj.update_storage()
+    # determine the sequence number first so that changes happening while the
+    # inventory is collected are sent again with the next delta
+    sequence = get_inventory_sequence()
+
+    if sync_protocol == DELTA_SYNC_PROTOCOL:
+        try:
+            since = max(int(request.GET.get('since')), 0)
+        except (TypeError, ValueError):
+            since = 0
+    else:
+        since = None
+
+    if since:
+        # a delta inventory is usually small, so it is collected in memory
+        response = HttpResponse(status=200, content_type='application/zip')
+        response_stringio = StringIO()
+        with ZipFile(response_stringio, 'w', ZIP_DEFLATED) as outzip:
+            outzip.writestr('inventory.json',
+                            json.dumps(_get_delta_inventory(since, sequence)))
+        response.write(response_stringio.getvalue())
+    else:
+        snapshot = _open_inventory_snapshot(sync_protocol, sequence)
+        response = StreamingHttpResponse(FileWrapper(snapshot), status=200,
+                                         content_type='application/zip')
+        response['Content-Length'] = os.fstat(snapshot.fileno()).st_size
     response['Metashare-Version'] = settings.METASHARE_VERSION
     response['Content-Disposition'] = 'attachment; filename="inventory.zip"'
     response['Sync-Protocol'] = sync_protocol
+    return response
+
 
-    # collect inventory for existing resources;
-    # consists of key - value pairs of resource identifiers and digest checksums
-    json_response = {}
-    objects_to_sync = StorageObject.objects \
+def _get_objects_to_sync():
+    """
+    Returns the query set of all storage objects which are part of the
+    synchronization inventory.
+    """
+    # 'from' parameter for restricting the inventory CAN NOT be used anymore
+    # since it would break to automatic detection of deleted resources; delta
+    # inventories are based on the inventory change log instead
+    return StorageObject.objects \
         .filter(Q(copy_status=MASTER) | Q(copy_status=PROXY)) \
         .exclude(publication_status=INTERNAL)
-    # 'from' parameter for restricting the inventory CAN NOT be used anymore
-    # since it would break to automatic detection of deleted resources
-#    if 'from' in request.GET:
-#        try:
-#            fromdate = dateutil.parser.parse(request.GET['from'])
-#            objects_to_sync = objects_to_sync.filter(digest_modified__gte=fromdate)
-#        except ValueError:
-#            # If we cannot parse the date string, act as if none was provided
-#            pass
-    for obj in objects_to_sync:
-        json_response[obj.identifier] = obj.get_digest_checksum()
-
-    # Create a StringIO object to make ZipFile write to response in python 2.7.9
-    response_stringio = StringIO(response)
-
-    with ZipFile(response_stringio, 'w') as outzip:
-        outzip.writestr('inventory.json', json.dumps(json_response))
-
-    #write the StringIO contents to response an return it
-    response.write(response_stringio.getvalue())
-    return response
+
+
+def _iter_inventory_items():
+    """
+    Yields the identifier and digest checksum pairs of the inventory.
+
+    The pairs are read in chunks of INVENTORY_CHUNK_SIZE so that neither the
+    storage objects themselves nor the complete result set need to be held in
+    memory.
+    """
+    objects_to_sync = _get_objects_to_sync().order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(objects_to_sync.filter(pk__gt=last_pk).values_list(
+            'pk', 'identifier', 'digest_checksum')[:INVENTORY_CHUNK_SIZE])
+        if not chunk:
+            return
+        for _, identifier, digest_checksum in chunk:
+            yield identifier, digest_checksum
+        last_pk = chunk[-1][0]
+
+
+def _open_inventory_snapshot(sync_protocol, sequence):
+    """
+    Returns an open file with the zipped full inventory for the given sync
+    protocol as of the given inventory change log sequence number.
+
+    The zipped inventory is kept as a snapshot in SYNC_INVENTORY_CACHE_DIR and
+    only recreated when the sequence number changes, i.e., when a storage
+    object of the inventory has changed.
+    """
+    cache_dir = settings.SYNC_INVENTORY_CACHE_DIR
+    prefix = 'inventory-{0}-'.format(sync_protocol)
+    snapshot_path = os.path.join(cache_dir, '{0}{1}.zip'.format(prefix, sequence))
+    try:
+        return open(snapshot_path, 'rb')
+    except IOError:
+        pass
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created concurrently by another process
+            pass
+    # the JSON is written to disk item by item, then compressed into a zip
+    # file which atomically replaces any concurrently created snapshot
+    json_fd, json_path = mkstemp(dir=cache_dir, suffix='.json')
+    zip_fd, zip_path = mkstemp(dir=cache_dir, suffix='.zip')
+    try:
+        with os.fdopen(json_fd, 'wb') as json_out:
+            if sync_protocol == DELTA_SYNC_PROTOCOL:
+                json_out.write('{{"sequence":{0},"full":true,"inventory":'
+                               .format(sequence))
+            json_out.write('{')
+            separator = ''
+            for identifier, digest_checksum in _iter_inventory_items():
+                json_out.write('{0}{1}:{2}'.format(separator,
+                    json.dumps(identifier), json.dumps(digest_checksum)))
+                separator = ','
+            json_out.write('}')
+            if sync_protocol == DELTA_SYNC_PROTOCOL:
+                json_out.write('}')
+        with os.fdopen(zip_fd, 'wb') as zip_out:
+            with ZipFile(zip_out, 'w', ZIP_DEFLATED) as outzip:
+                outzip.write(json_path, arcname='inventory.json')
+        # the snapshot is opened before it is published so that a concurrent
+        # cleanup cannot remove it in between
+        snapshot = open(zip_path, 'rb')
+        os.rename(zip_path, snapshot_path)
+    finally:
+        os.remove(json_path)
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+    for _file in os.listdir(cache_dir):
+        if _file.startswith(prefix) and _file != os.path.basename(snapshot_path):
+            try:
+                os.remove(os.path.join(cache_dir, _file))
+            except OSError:
+                pass
+    return snapshot
+
+
+def _get_delta_inventory(since, sequence):
+    """
+    Collects the changes of the inventory after sequence number `since` up to
+    the given current sequence number, including deleted resources.
+
+    If `since` is not a sequence number previously returned by this node, the
+    full inventory is collected instead.
+    """
+    if since > sequence:
+        # not a known sequence number (e.g., the change log has been reset)
+        return {
+            'sequence': sequence,
+            'full': True,
+            'inventory': dict(_iter_inventory_items()),
+        }
+    changed, deleted = get_inventory_changes(since, sequence)
+    return {
+        'sequence': sequence,
+        'full': False,
+        'changed': changed,
+        'deleted': deleted,
+    }
+
 
 def full_metadata(request, resource_uuid):
     if settings.SYNC_NEEDS_AUTHENTICATION and not request.user.has_perm('storage.can_sync'):
@@ -70,18 +213,215 @@ def full_metadata(request, resource_uuid):
     if storage_object.copy_status == REMOTE:
         return HttpResponse("Forbidden: the specified resource is a `REMOTE` " \
             "resource and cannot be distributed by this node.", status=403)
-    response = HttpResponse(status=200, content_type='application/zip')
-    response['Metashare-Version'] = settings.METASHARE_VERSION
-    response['Content-Disposition'] = 'attachment; filename="full-metadata.zip"'
     if storage_object.digest_checksum is None:
         storage_object.update_storage()
     #if storage_object.digest_checksum is None: # still no digest? something is very wrong here:
     #    raise Exception("Object {0} has no digest".format(resource_uuid))
-    zipfilename = "{0}/resource.zip".format(storage_object._storage_folder())
-    with open(zipfilename, 'rb') as inzip:
-        zipfiledata = inzip.read()
-        response.write(zipfiledata)
-#    with ZipFile(response, 'w') as outzip:
-#        outzip.writestr('storage-global.json', str(storage_object.identifier))
-#        outzip.writestr('metadata.xml', storage_object.metadata.encode('utf-8'))
+    zipfilename = storage_object.get_digest_archive()
+
+    # the digest checksum and its modification date identify the content of
+    # the digest zip archive, so they are used as cache validators
+    etag = quote_etag(storage_object.digest_checksum)
+    last_modified = None
+    if storage_object.digest_modified:
+        last_modified = _get_timestamp(storage_object.digest_modified)
+    if _is_not_modified(request, storage_object.digest_checksum, last_modified):
+        response = HttpResponseNotModified()
+    elif settings.SYNC_SENDFILE_HEADER:
+        # let the web server send the file (including any range handling)
+        response = HttpResponse(status=200, content_type='application/zip')
+        response[settings.SYNC_SENDFILE_HEADER] = zipfilename
+    else:
+        response = _get_file_response(request, zipfilename, etag)
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # caches may keep the archive but have to revalidate it for every request,
+    # which also makes sure that the sync permission is always checked
+    response['Cache-Control'] = 'no-cache'
+    response['Metashare-Version'] = settings.METASHARE_VERSION
+    if response.status_code != 304:
+        response['Content-Disposition'] = 'attachment; filename="full-metadata.zip"'
+    return response
+
+
+def _is_not_modified(request, checksum, last_modified):
+    """
+    Returns whether the conditional headers of the given request show that
+    the client already has the representation with the given (unquoted) ETag
+    and last modification timestamp.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        etags = parse_etags(if_none_match)
+        return '*' in etags or checksum in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None \
+            and last_modified <= if_modified_since
+    return False
+
+
+def _get_timestamp(value):
+    """
+    Returns the given datetime as seconds since the epoch; a naive datetime is
+    taken to be in the time zone of the server.
+    """
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return calendar.timegm(value.utctimetuple())
+
+
+def _get_file_response(request, filename, etag):
+    """
+    Returns a streamed response with the content of the given file.
+
+    A request for a single byte range is answered with the requested part of
+    the file, unless an If-Range header shows that the client's partial copy
+    is outdated.
+    """
+    size = os.path.getsize(filename)
+    inzip = open(filename, 'rb')
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if 'HTTP_RANGE' in request.META and (not if_range or if_range == etag):
+        byte_range = _parse_byte_range(request.META['HTTP_RANGE'], size)
+        if byte_range == (None, None):
+            inzip.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+
+    if byte_range:
+        start, end = byte_range
+        inzip.seek(start)
+        response = StreamingHttpResponse(
+            _iter_file_part(inzip, end - start + 1),
+            status=206, content_type='application/zip')
+        response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = StreamingHttpResponse(FileWrapper(inzip), status=200,
+                                         content_type='application/zip')
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _parse_byte_range(header, size):
+    """
+    Parses the value of a Range header for a file of the given size.
+
+    Returns a pair of the first and last byte position of a single satisfiable
+    range, (None, None) for an unsatisfiable range, or None if the header is
+    not a single byte range (in which case the whole file is sent).
+    """
+    match = BYTE_RANGE.match(header)
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        # suffix range with the number of bytes at the end of the file
+        if not last or int(last) == 0:
+            return (None, None)
+        return (max(size - int(last), 0), size - 1)
+    first = int(first)
+    if first >= size:
+        return (None, None)
+    if last:
+        if int(last) < first:
+            return None
+        return (first, min(int(last), size - 1))
+    return (first, size - 1)
+
+
+def _iter_file_part(infile, length):
+    """
+    Yields the next `length` bytes of the given open file in blocks and closes
+    the file afterwards.
+    """
+    try:
+        while length > 0:
+            chunk = infile.read(min(length, FILE_BLOCK_SIZE))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        infile.close()
+
+
+def bulk_metadata(request):
+    """
+    Returns the full metadata of all resources whose identifiers are POSTed as
+    `resource` parameters in a single zip archive.
+
+    The archive contains the digest zip archive of each resource as
+    `<identifier>.zip`; requested resources which cannot be distributed by
+    this node are silently left out.
+    """
+    if settings.SYNC_NEEDS_AUTHENTICATION and not request.user.has_perm('storage.can_sync'):
+        return HttpResponse("Forbidden: only synchronization users can access this page.", status=403)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    identifiers = request.POST.getlist('resource')
+    if len(identifiers) > settings.SYNC_MAX_BATCH_SIZE:
+        return HttpResponse("Bad request: at most {0} resources can be " \
+            "requested at once.".format(settings.SYNC_MAX_BATCH_SIZE), status=400)
+    storage_objects = _get_objects_to_sync().filter(identifier__in=identifiers)
+    response = StreamingHttpResponse(_stream_metadata_archive(storage_objects),
+        status=200, content_type='application/zip')
+    response['Metashare-Version'] = settings.METASHARE_VERSION
+    response['Content-Disposition'] = 'attachment; filename="bulk-metadata.zip"'
     return response
+
+
+class _ZipStreamBuffer(object):
+    """
+    A minimal write-only file-like object for `ZipFile` which keeps the
+    written data only until it is consumed, so that a zip archive can be
+    streamed while it is created.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def consume(self):
+        """
+        Returns and forgets all data written since the last call.
+        """
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _stream_metadata_archive(storage_objects):
+    """
+    Yields a zip archive with the digest zip archives of the given storage
+    objects, one resource at a time.
+    """
+    buf = _ZipStreamBuffer()
+    # the digest zip archives are already compressed
+    with ZipFile(buf, 'w', ZIP_STORED) as outzip:
+        for storage_object in storage_objects:
+            if storage_object.digest_checksum is None:
+                storage_object.update_storage()
+            zipfilename = storage_object.get_digest_archive()
+            with open(zipfilename, 'rb') as inzip:
+                outzip.writestr('{0}.zip'.format(storage_object.identifier),
+                                inzip.read())
+            yield buf.consume()
+    yield buf.consume()
+
@@ -18,6 +18,10 @@ def _run_custom_test_db_setup():
     """
     # from now on, redirect any search index access to the test index
     MetashareRouter.in_test_mode = True
+    # tests expect search index updates to be visible immediately
+    settings.SEARCH_INDEX_QUEUE_ENABLED = False
+    # tests expect statistics to be visible immediately
+    settings.STATS_BUFFER_ENABLED = False
     # clear the test index
     clear_index.Command().handle(interactive=False,
                                  using=[settings.TEST_MODE_NAME,])
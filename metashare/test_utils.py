@@ -22,7 +22,8 @@ from metashare.settings import LOGIN_URL
 from metashare.storage.models import PUBLISHED, MASTER, StorageObject, INTERNAL
 from metashare.xml_utils import import_from_file
 import os
-from metashare.stats.models import LRStats, UsageStats, QueryStats
+from metashare.stats.models import LRStats, UsageStats, QueryStats, \
+    LRStatsDaily, QueryStatsDaily
 from haystack.management.commands import update_index
 
 TEST_STORAGE_PATH = '{0}/test-tmp'.format(settings.ROOT_PATH)
@@ -62,7 +63,7 @@ def clean_resources_db():
     for tgm in TogetherManager.objects.all():
         tgm.delete()
     # delete object cache used for duplicate recognition in import
-    supermodel.OBJECT_XML_CACHE = {}
+    supermodel.OBJECT_XML_CACHE.clear()
 
 def clean_user_db():
     """
@@ -85,8 +86,10 @@ def clean_stats():
     Deletes all static entities from the database.
     """
     LRStats.objects.all().delete()
+    LRStatsDaily.objects.all().delete()
     UsageStats.objects.all().delete()
     QueryStats.objects.all().delete()
+    QueryStatsDaily.objects.all().delete()
 
 def clean_storage():
     """
@@ -3,10 +3,13 @@ This file holds globally useful utility classes and functions, i.e., classes and
 functions that are generic enough not to be specific to one app.
 '''
 import logging
+import multiprocessing
 import os
 import re
 import sys
+import threading
 from datetime import tzinfo, timedelta
+from multiprocessing.pool import Pool
 
 from django.conf import settings
 
@@ -114,6 +117,74 @@ class Lock():
         if self.handle:
             self.handle.close()
 
+class _LogRecordQueueHandler(logging.Handler):
+    """
+    Hands the log records of a worker process over to the process which has
+    created it, see `WorkerPool`.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # the arguments and the exception information may not be
+            # picklable, so they are formatted right away
+            if record.exc_info:
+                record.exc_text = \
+                    settings.LOG_FORMATTER.formatException(record.exc_info)
+                record.exc_info = None
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put(record)
+        # pylint: disable-msg=W0703
+        except Exception:
+            self.handleError(record)
+
+
+def _init_worker_logging(queue):
+    """
+    Makes the shared log handler of a new worker process of a `WorkerPool`
+    hand all log records over to the given queue.
+    """
+    # the handler is replaced in place, as it is shared by all loggers,
+    # including the ones of modules which the worker only imports later on
+    settings.LOG_HANDLER.emit = _LogRecordQueueHandler(queue).emit
+
+
+class WorkerPool(Pool):
+    """
+    A pool of worker processes which do not write to the log file themselves
+    but hand their log records over to the process which has created the
+    pool, as several processes writing to the same (rotating) log file would
+    garble it.
+    """
+    def __init__(self, processes=None):
+        self._log_queue = multiprocessing.Queue()
+        Pool.__init__(self, processes, _init_worker_logging,
+                      (self._log_queue,))
+        self._log_thread = threading.Thread(target=self._write_log_records)
+        self._log_thread.daemon = True
+        self._log_thread.start()
+
+    def _write_log_records(self):
+        """
+        Writes the log records of the worker processes until it gets None.
+        """
+        while True:
+            record = self._log_queue.get()
+            if record is None:
+                break
+            settings.LOG_HANDLER.handle(record)
+
+    def join(self):
+        Pool.join(self)
+        # all worker processes have exited, so all of their log records have
+        # been queued
+        self._log_queue.put(None)
+        self._log_thread.join()
+
+
 class SimpleTimezone(tzinfo):
     """
     A fixed offset timezone with an unknown name and an unknown DST adjustment.
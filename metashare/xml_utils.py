@@ -3,12 +3,16 @@
 Call the external program xdiff to compare two XML files
 
 """
+import json
 import logging
+from itertools import chain
 from lxml import etree
 
 import os
 import re
 import sys
+from datetime import datetime
+from hashlib import md5
 from subprocess import call, STDOUT
 from zipfile import is_zipfile, ZipFile
 
@@ -17,9 +21,11 @@ from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import force_unicode
 
+from metashare import settings
 from metashare.repository.models import User
 from metashare.settings import LOG_HANDLER, XDIFF_LOCATION
 from metashare.stats.model_utils import saveLRStats, UPDATE_STAT
+from metashare.utils import WorkerPool
 from xml.etree import ElementTree
 
 
@@ -31,6 +37,10 @@ LOGGER.addHandler(LOG_HANDLER)
 
 CONSOLE = "/dev/null"
 
+# the maximum number of records of a file which are read and parsed at once by
+# a worker process during a bulk import
+IMPORT_READ_BATCH_SIZE = 10
+
 XML_DECL = re.compile(r'\s*<\?xml version=".+" encoding=".+"\?>\s*\n?',
   re.I|re.S|re.U)
 # same as above, but using using ' quotes for attributes
@@ -77,10 +87,31 @@ def import_from_string(xml_string, targetstatus, copy_status, owner_id=None):
     Import a single resource from a string representation of its XML tree, 
     and save it with the given target status.
     
+    Returns the imported resource object on success, raises and Exception on failure.
+    """
+    resource = _import_record(ElementTree.fromstring(xml_string), targetstatus,
+                              copy_status, owner_id)
+
+    # explicitly write metadata XML and storage object to the storage folder
+    resource.storage_object.update_storage()
+
+    # Update statistics
+    saveLRStats(resource, UPDATE_STAT)
+
+    return resource
+
+
+def _import_record(element_tree, targetstatus, copy_status, owner_id=None):
+    """
+    Creates the database objects of a single resource from its parsed XML
+    tree with the given target status, but neither serializes the resource to
+    the storage folder nor updates the statistics.
+    
     Returns the imported resource object on success, raises and Exception on failure.
     """
     from metashare.repository.models import resourceInfoType_model
-    result = resourceInfoType_model.import_from_string(xml_string, copy_status=copy_status)
+    result = resourceInfoType_model.import_from_elementtree(element_tree,
+                                                           copy_status=copy_status)
     
     if not result[0]:
         msg = u''
@@ -105,9 +136,6 @@ def import_from_string(xml_string, targetstatus, copy_status, owner_id=None):
     else:
         resource.storage_object.save()
 
-    # explicitly write metadata XML and storage object to the storage folder
-    resource.storage_object.update_storage()
-
     # Create log ADDITION message for the new object, but only if we have a user:
     if owner_id:
         LogEntry.objects.log_action(
@@ -118,9 +146,6 @@ def import_from_string(xml_string, targetstatus, copy_status, owner_id=None):
             action_flag     = ADDITION
         )
 
-    # Update statistics
-    saveLRStats(resource, UPDATE_STAT)
-
     return resource
     
     
@@ -185,6 +210,383 @@ def import_from_file(filehandle, descriptor, targetstatus, copy_status, owner_id
     return imported_resources, erroneous_descriptors
 
 
+def bulk_import_from_files(filenames, targetstatus, copy_status, owner_id=None,
+                           workers=None, chunk_size=None, progress=None):
+    """
+    Import the xml metadata records contained in the given XML files and zip
+    archives of XML files in bulk.
+
+    The import runs in three phases:
+    - the records are read and parsed by a pool of worker processes in
+      batches of records of the same file while the database objects of the
+      already parsed records are created; the records are written in one
+      transaction per chunk of records, with a savepoint per record so that an
+      erroneous record does not affect the others;
+    - the metadata XML and storage objects of all imported resources are
+      serialized to the storage folder by the worker processes; resources
+      which cannot be serialized are reported as erroneous;
+    - the statistics and search index entries of all imported resources are
+      updated in batches; the search index entries are not updated if the
+      caller has disabled indexing with DISABLE_INDEXING_DURING_IMPORT.
+
+    workers (optional): the number of worker processes; defaults to
+        MAINTENANCE_WORKERS.
+    chunk_size (optional): the number of records written per transaction;
+        defaults to MAINTENANCE_CHUNK_SIZE.
+    progress (optional): a callable which is called with the name of the
+        current phase, the number of processed records and the total number
+        of records of the phase.
+
+    The other arguments and the result are the same as for import_from_file().
+    """
+    from metashare.repository.search_indexes import update_lr_index_entries
+    from metashare.storage.maintenance import run_maintenance
+    if workers is None:
+        workers = settings.MAINTENANCE_WORKERS
+    if chunk_size is None:
+        chunk_size = settings.MAINTENANCE_CHUNK_SIZE
+    imported_resources = []
+    erroneous_descriptors = []
+
+    batches = []
+    total = 0
+    for filename in filenames:
+        if is_zipfile(filename):
+            with ZipFile(filename) as temp_zip:
+                _names = [_name for _name in temp_zip.namelist()
+                          if not _name.endswith('/')
+                          and not _name.endswith('\\')]
+            batches.extend((filename, _names[i:i + IMPORT_READ_BATCH_SIZE])
+                           for i in range(0, len(_names),
+                                          IMPORT_READ_BATCH_SIZE))
+            total += len(_names)
+        else:
+            batches.append((filename, None))
+            total += 1
+    # the descriptors of the imported resources by their storage object ids
+    descriptors = {}
+
+    # the index entries are only updated once all records are in the database
+    # and storage folder
+    indexing_disabled = os.environ.get('DISABLE_INDEXING_DURING_IMPORT')
+    os.environ['DISABLE_INDEXING_DURING_IMPORT'] = 'True'
+    try:
+        pool = None
+        if workers > 1 and len(batches) > 1:
+            # the worker processes must not share the database connections of
+            # this process
+            for _conn in db.connections.all():
+                _conn.close()
+            pool = WorkerPool(processes=workers)
+            parsed = chain.from_iterable(pool.imap(_read_records, batches))
+        else:
+            parsed = chain.from_iterable(_read_records(batch)
+                                         for batch in batches)
+        try:
+            processed = 0
+            while processed < total:
+                _chunk = [parsed.next()
+                          for _ in range(min(chunk_size, total - processed))]
+                with db.transaction.atomic():
+                    for descriptor, element_tree, problem in _chunk:
+                        if problem is None:
+                            try:
+                                with db.transaction.atomic():
+                                    resource = _import_record(element_tree,
+                                        targetstatus, copy_status, owner_id)
+                                imported_resources.append(resource)
+                                descriptors[resource.storage_object_id] = \
+                                    descriptor
+                            # pylint: disable-msg=W0703
+                            except Exception as problem:
+                                LOGGER.warn('Caught an exception while '
+                                    'importing %s:', descriptor, exc_info=True)
+                        if problem is not None:
+                            erroneous_descriptors.append((descriptor, problem))
+                processed += len(_chunk)
+                if progress:
+                    progress('import', processed, total)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            _close_read_archive()
+
+        def _storage_progress(_processed, _total):
+            if progress:
+                progress('storage', _processed, _total)
+        _failed = []
+        run_maintenance(_update_imported_storage,
+            [_res.storage_object_id for _res in imported_resources],
+            workers=workers, chunk_size=chunk_size,
+            progress=_storage_progress, failures=_failed)
+        if _failed:
+            _failed = set(_failed)
+            LOGGER.warn('{0} imported resources could not be serialized to '
+                        'the storage folder.'.format(len(_failed)))
+            erroneous_descriptors.extend((descriptors[_id], Exception(
+                    u'The imported resource could not be serialized to the '
+                    u'storage folder.'))
+                for _id in sorted(_failed, key=lambda _id: descriptors[_id]))
+            imported_resources = [_res for _res in imported_resources
+                                  if _res.storage_object_id not in _failed]
+    finally:
+        if indexing_disabled is None:
+            del os.environ['DISABLE_INDEXING_DURING_IMPORT']
+        else:
+            os.environ['DISABLE_INDEXING_DURING_IMPORT'] = indexing_disabled
+
+    resource_ids = [_res.id for _res in imported_resources]
+    _batch_size = settings.SEARCH_INDEX_QUEUE_BATCH_SIZE
+    for i in range(0, len(imported_resources), _batch_size):
+        for resource in imported_resources[i:i + _batch_size]:
+            saveLRStats(resource, UPDATE_STAT)
+        update_lr_index_entries(resource_ids[i:i + _batch_size])
+        if progress:
+            progress('index', min(i + _batch_size, len(resource_ids)),
+                     len(resource_ids))
+    return imported_resources, erroneous_descriptors
+
+
+# the zip archive from which the current process has read records last, as a
+# pair of its file name and the opened `ZipFile`; the batches of an archive
+# are read one after the other, so each process opens each archive only once
+_READ_ARCHIVE = [None, None]
+
+
+def _get_read_archive(filename):
+    """
+    Returns the opened `ZipFile` of the zip archive with the given file name,
+    reusing the archive from which records have been read last if possible.
+    """
+    if _READ_ARCHIVE[0] != filename:
+        _close_read_archive()
+        _READ_ARCHIVE[1] = ZipFile(filename)
+        _READ_ARCHIVE[0] = filename
+    return _READ_ARCHIVE[1]
+
+
+def _close_read_archive():
+    """
+    Closes the zip archive from which records have been read last, if any.
+    """
+    if _READ_ARCHIVE[1] is not None:
+        _READ_ARCHIVE[1].close()
+    _READ_ARCHIVE[:] = [None, None]
+
+
+def _read_records(batch):
+    """
+    Reads and parses the xml metadata records identified by the given pair of
+    a file name and a list of names of zip archive members (or `None` for XML
+    files).
+
+    Returns a list of triples of the descriptor of a record, its parsed XML
+    tree and the problem which occurred when reading the record, if any.
+    """
+    filename, xml_names = batch
+    if xml_names is None:
+        return [_read_record(filename, None, filename)]
+    try:
+        temp_zip = _get_read_archive(filename)
+    # pylint: disable-msg=W0703
+    except Exception as problem:
+        LOGGER.warn('Caught an exception while opening %s:', filename,
+                    exc_info=True)
+        # exceptions are not necessarily picklable
+        return [(u'{0}:{1}'.format(filename, _name), None,
+                 Exception(u'{0}'.format(problem))) for _name in xml_names]
+    return [_read_record(temp_zip, _name,
+                         u'{0}:{1}'.format(filename, _name))
+            for _name in xml_names]
+
+
+def _read_record(source, xml_name, descriptor):
+    """
+    Reads and parses the xml metadata record with the given descriptor from
+    the given XML file name or, if an archive member name is given, from the
+    given `ZipFile`.
+
+    Returns a triple of the descriptor of the record, its parsed XML tree and
+    the problem which occurred when reading the record, if any.
+    """
+    try:
+        if xml_name:
+            xml_string = source.read(xml_name)
+        else:
+            with open(source, 'rb') as xml_file:
+                xml_string = xml_file.read()
+        element_tree = ElementTree.fromstring(xml_string)
+    # pylint: disable-msg=W0703
+    except Exception as problem:
+        LOGGER.warn('Caught an exception while reading %s:', descriptor,
+                    exc_info=True)
+        # exceptions are not necessarily picklable
+        return descriptor, None, Exception(u'{0}'.format(problem))
+    return descriptor, element_tree, None
+
+
+def _update_imported_storage(storage_object, dry_run):
+    """
+    Serializes the metadata XML and the given storage object of an imported
+    resource to the storage folder.
+    """
+    if not dry_run:
+        storage_object.update_storage()
+    return True
+
+
+def bulk_export_to_archive(filename, workers=None, chunk_size=None,
+                           manifest_filename=None, previous_manifest=None,
+                           use_stored_metadata=True, progress=None):
+    """
+    Export the xml metadata records of all resources which are not marked as
+    deleted to the zip archive with the given file name, one XML file per
+    resource named after the identifier of its storage object.
+
+    The records are serialized by a pool of worker processes in chunks of
+    resources while this process writes them to the archive as they arrive.
+
+    workers (optional): the number of worker processes; defaults to
+        MAINTENANCE_WORKERS.
+    chunk_size (optional): the number of resources handed to a worker at
+        once; defaults to MAINTENANCE_CHUNK_SIZE.
+    manifest_filename (optional): the name of a JSON file to which the
+        manifest of the export is written; the manifest lists the archive, the
+        file name, the MD5 checksum of the file and the digest checksum of
+        each exported resource, and the identifiers of the resources which
+        have been deleted since the previous export.
+    previous_manifest (optional): the name of the manifest file of a previous
+        export; if given, only the resources whose digest checksum has changed
+        since that export are written to the archive and the manifest entries
+        of the other resources are taken over from the previous manifest.
+        Resources without a digest checksum, e.g., internal ones, are always
+        exported.
+    use_stored_metadata (optional): if True (the default), the metadata XML
+        kept in the storage object of a resource is written instead of
+        exporting the resource again, unless any metadata has been changed
+        since the stored XML has been checked; see
+        metashare.repository.metadata_access.get_metadata_xml().  If False,
+        all resources are exported.
+    progress (optional): a callable which is called with the number of
+        processed resources and the total number of resources to export.
+
+    Returns a pair of the number of exported resources and the list of the
+    ids of the resources which could not be exported.
+    """
+    from metashare.repository.models import resourceInfoType_model
+    if workers is None:
+        workers = settings.MAINTENANCE_WORKERS
+    if chunk_size is None:
+        chunk_size = settings.MAINTENANCE_CHUNK_SIZE
+    _previous = {}
+    if previous_manifest:
+        with open(previous_manifest, 'rb') as _file:
+            _previous = json.load(_file)['resources']
+
+    _archive = os.path.basename(filename)
+    _entries = {}
+    _identifiers = {}
+    resource_ids = []
+    for _id, _identifier, _digest in resourceInfoType_model.objects \
+            .filter(storage_object__deleted=False).order_by('pk') \
+            .values_list('id', 'storage_object__identifier',
+                         'storage_object__digest_checksum'):
+        _identifiers[_id] = (_identifier, _digest)
+        _entry = _previous.get(_identifier)
+        if _digest and _entry and _entry['digest_checksum'] == _digest:
+            _entries[_identifier] = _entry
+        else:
+            resource_ids.append(_id)
+    total = len(resource_ids)
+    chunks = [(resource_ids[i:i + chunk_size], use_stored_metadata)
+              for i in range(0, total, chunk_size)]
+
+    pool = None
+    if workers > 1 and len(chunks) > 1:
+        # the worker processes must not share the database connections of
+        # this process
+        for _conn in db.connections.all():
+            _conn.close()
+        pool = WorkerPool(processes=workers)
+        results = pool.imap_unordered(_export_chunk, chunks)
+    else:
+        results = (_export_chunk(chunk) for chunk in chunks)
+    processed = 0
+    exported = 0
+    erroneous_ids = []
+    try:
+        with ZipFile(filename, 'w') as out:
+            for _records in results:
+                for _id, xml_string in _records:
+                    if xml_string is None:
+                        erroneous_ids.append(_id)
+                        continue
+                    _identifier, _digest = _identifiers[_id]
+                    _name = u'resource-{0}.xml'.format(_identifier)
+                    out.writestr(_name, xml_string)
+                    _entries[_identifier] = {
+                        'archive': _archive,
+                        'file': _name,
+                        'md5': md5(xml_string).hexdigest(),
+                        'digest_checksum': _digest,
+                    }
+                    exported += 1
+                processed += len(_records)
+                if progress:
+                    progress(processed, total)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if manifest_filename:
+        _manifest = {
+            'archive': _archive,
+            'created': datetime.now().isoformat(),
+            'incremental': bool(previous_manifest),
+            'resources': _entries,
+            'deleted': sorted(set(_previous) - set(_identifier
+                for _identifier, _ in _identifiers.itervalues())),
+        }
+        with open(manifest_filename, 'wb') as _file:
+            json.dump(_manifest, _file, indent=1, sort_keys=True)
+    return exported, erroneous_ids
+
+
+def _export_chunk(args):
+    """
+    Serializes the metadata records of the resources with the given ids, either
+    by exporting them or by taking the stored metadata XML if requested and
+    up-to-date.
+
+    Returns a list of pairs of resource ids and UTF-8 encoded XML strings, or
+    None instead of the XML string if the resource could not be exported.
+    """
+    from metashare.repository.metadata_access import get_metadata_xml
+    from metashare.repository.models import resourceInfoType_model
+    resource_ids, use_stored_metadata = args
+    records = []
+    for resource in resourceInfoType_model.objects \
+            .filter(pk__in=resource_ids).select_related('storage_object'):
+        try:
+            if use_stored_metadata:
+                # the stored XML uses character entities for all non-ASCII
+                # characters
+                xml_string = get_metadata_xml(resource).encode('utf-8')
+            else:
+                xml_string = to_xml_string(resource.export_to_elementtree(),
+                                           encoding="utf-8").encode('utf-8')
+        # pylint: disable-msg=W0703
+        except Exception:
+            LOGGER.error('Could not export resource id={0}!'
+                         .format(resource.id), exc_info=True)
+            xml_string = None
+        records.append((resource.id, xml_string))
+    db.reset_queries()
+    return records
+
+
 def to_xml_string(node, encoding="ASCII"):
     """
     Serialize the given XML node as Unicode string using the given encoding.